@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Benchmark the memcache cache backends
+
+Compares pylibmc-in-a-thread (AsyncMultipartMemcache)
+with the asyncio-native client (AsyncMultipartAioMemcache)
+by running concurrent get/set of nbviewer-sized values.
+
+Requires a running memcached, e.g.:
+
+    docker run --rm -p 11211:11211 memcached
+    python benchmarks/memcache_bench.py --servers localhost:11211
+"""
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nbviewer.cache import AsyncMultipartAioMemcache
+from nbviewer.cache import AsyncMultipartMemcache
+from nbviewer.cache import pylibmc
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+async def run(cache, n, concurrency, value):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        key = "bench-%i" % (i % 100)
+        async with semaphore:
+            tic = time.perf_counter()
+            if i % 10 == 0:
+                await cache.set(key, value)
+            else:
+                await cache.get(key)
+            latencies.append(time.perf_counter() - tic)
+
+    # populate before timing
+    await asyncio.gather(*(cache.set("bench-%i" % i, value) for i in range(100)))
+    tic = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    elapsed = time.perf_counter() - tic
+    return elapsed, latencies
+
+
+def report(name, n, elapsed, latencies):
+    print(
+        "{:10} {:8.0f} ops/s  p50 {:7.2f} ms  p99 {:7.2f} ms".format(
+            name,
+            n / elapsed,
+            1e3 * percentile(latencies, 50),
+            1e3 * percentile(latencies, 99),
+        )
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--servers", default=os.environ.get("MEMCACHE_SERVERS", "localhost:11211")
+    )
+    parser.add_argument("-n", type=int, default=5000, help="number of operations")
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("--size", type=int, default=100000, help="value size (bytes)")
+    parser.add_argument("--mc-threads", type=int, default=1)
+    parser.add_argument("--pool-size", type=int, default=2)
+    args = parser.parse_args()
+
+    servers = args.servers.split(",")
+    # half-compressible values, like rendered html
+    value = os.urandom(args.size // 2) + b"x" * (args.size - args.size // 2)
+
+    backends = []
+    if pylibmc:
+        backends.append(
+            (
+                "pylibmc",
+                AsyncMultipartMemcache(
+                    servers, pool=ThreadPoolExecutor(args.mc_threads)
+                ),
+            )
+        )
+    else:
+        print("pylibmc not installed, skipping")
+    backends.append(
+        ("asyncio", AsyncMultipartAioMemcache(servers, pool_size=args.pool_size))
+    )
+
+    print(
+        "%i ops, %i concurrent, %i B values, 10%% sets"
+        % (args.n, args.concurrency, args.size)
+    )
+    for name, cache in backends:
+        elapsed, latencies = await run(cache, args.n, args.concurrency, value)
+        report(name, args.n, elapsed, latencies)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
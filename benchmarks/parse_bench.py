@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Benchmark parsing and validating notebooks
+
+Parses every notebook given (files, or directories searched for .ipynb files)
+with the json module and with orjson (if installed),
+then with each NBViewer.notebook_validation mode,
+and reports the time per notebook, summed over the corpus.
+The cached mode is timed on a second pass, when the verdicts are cached.
+
+    python benchmarks/parse_bench.py ~/notebooks --n 5
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+from nbviewer import render
+from nbviewer.render import parse_notebook
+from nbviewer.render import validation_modes
+
+
+def load_corpus(paths):
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                glob.glob(os.path.join(path, "**", "*.ipynb"), recursive=True)
+            )
+        else:
+            files = [path]
+        for filename in files:
+            with open(filename, "rb") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def timed(f, corpus, n):
+    """Best time of n passes over the corpus"""
+    best = None
+    for i in range(n):
+        tic = time.perf_counter()
+        for json_notebook in corpus:
+            f(json_notebook)
+        elapsed = time.perf_counter() - tic
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="notebooks or directories")
+    parser.add_argument("--n", type=int, default=3, help="passes over the corpus")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.paths)
+    if not corpus:
+        parser.error("no notebooks found")
+    size = sum(len(json_notebook) for json_notebook in corpus)
+    print("%i notebooks, %.1f MB" % (len(corpus), size / 2**20))
+
+    results = [("json.loads", timed(json.loads, corpus, args.n))]
+    if render.orjson is not None:
+        results.append(("orjson.loads", timed(render.orjson.loads, corpus, args.n)))
+    for mode in validation_modes:
+        # the first pass of the cached mode fills the cache
+        results.append(
+            (
+                "parse, validation=%s" % mode,
+                timed(lambda nb: parse_notebook(nb, mode), corpus, args.n),
+            )
+        )
+
+    for name, elapsed in results:
+        print(
+            "%-28s %8.2f ms/notebook  %6.0f MB/s"
+            % (name, 1000 * elapsed / len(corpus), size / 2**20 / elapsed)
+        )
+
+
+if __name__ == "__main__":
+    main()
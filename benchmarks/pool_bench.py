@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmark passing large payloads to render workers
+
+Compares pickling payloads through the worker pipes (share_threshold=0)
+with passing them through files in shared memory,
+by sending notebook-sized strings to SupervisedProcessPool workers
+and getting page-sized strings back, as renders do.
+
+    python benchmarks/pool_bench.py --size 20 --n 50
+"""
+import argparse
+import time
+
+from nbviewer.pool import SupervisedProcessPool
+
+
+def fake_render(json_notebook):
+    """Return a page about as large as the notebook, without the cost of rendering"""
+    return json_notebook[::-1], {"download_name": "notebook.ipynb"}
+
+
+def run(pool, payload, n, concurrency):
+    # start the workers before timing
+    list(pool.map(fake_render, ["warm"] * concurrency))
+    tic = time.perf_counter()
+    futures = [pool.submit(fake_render, payload) for i in range(n)]
+    for future in futures:
+        future.result()
+    return time.perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=20, help="payload size (MB)")
+    parser.add_argument("--n", type=int, default=50, help="number of renders")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    payload = "x" * int(args.size * 2**20)
+    for name, threshold in [("pipe", 0), ("shared memory", 2**16)]:
+        pool = SupervisedProcessPool(args.workers, share_threshold=threshold)
+        try:
+            elapsed = run(pool, payload, args.n, args.workers)
+        finally:
+            pool.shutdown()
+        print(
+            "%-14s %6.1f ms/render  %6.0f MB/s"
+            % (
+                name,
+                1000 * elapsed / args.n,
+                2 * args.size * args.n / elapsed,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,14 +7,17 @@
 import io
 import json
 import logging
+import multiprocessing
 import os
-from concurrent.futures import ProcessPoolExecutor
+import time
+import uuid
 from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from html import escape
 from urllib.parse import urlparse
 
 import markdown
+import statsd  # type: ignore
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
 from jupyter_server.base.handlers import FileFindHandler  # type: ignore
@@ -31,14 +34,24 @@ from traitlets import Any
 from traitlets import Bool
 from traitlets import default
 from traitlets import Dict
+from traitlets import Enum
+from traitlets import Float
 from traitlets import Int
 from traitlets import List
 from traitlets import Set
 from traitlets import Unicode
 from traitlets.config import Application
 
+from .cache import AsyncLayeredCache
+from .cache import AsyncLRUCache
+from .cache import AsyncMultipartAioMemcache
 from .cache import AsyncMultipartMemcache
-from .cache import DummyAsyncCache
+from .cache import AsyncSQLiteCache
+from .cache import backend_stats
+from .cache import cache_codecs
+from .cache import CacheStats
+from .cache import get_codec
+from .cache import InstrumentedCache
 from .cache import MockCache
 from .cache import pylibmc
 from .client import NBViewerAsyncHTTPClient as HTTPClientClass
@@ -46,12 +59,24 @@ from .formats import default_formats
 from .handlers import init_handlers
 from .index import NoSearch
 from .log import log_request
+from .pool import SupervisedProcessPool
 from .providers import default_providers
 from .providers import default_rewrites
 from .ratelimit import RateLimiter
+from .render import validation_modes
+from .render import warm_up
+from .scheduler import RenderScheduler
+from .singleflight import SingleFlight
+from .utils import available_content_encodings
+from .utils import EmptyClass
 from .utils import git_info
 from .utils import jupyter_info
+from .utils import LoopLagMonitor
 from .utils import url_path_join
+from .warmer import CacheWarmer
+from .warmer import read_url_list
+from .warmer import top_access_log_uris
+from .warmer import WarmApp
 
 # -----------------------------------------------------------------------------
 # Code
@@ -87,20 +112,36 @@ class NBViewer(Application):
         {
             "base-url": "NBViewer.base_url",
             "binder-base-url": "NBViewer.binder_base_url",
+            "cache-codec": "NBViewer.cache_codec",
+            "cache-content-encodings": "NBViewer.cache_content_encodings",
+            "cache-disk-limit": "NBViewer.cache_disk_limit",
             "cache-expiry-max": "NBViewer.cache_expiry_max",
             "cache-expiry-min": "NBViewer.cache_expiry_min",
+            "cache-l1-expiry": "NBViewer.cache_l1_expiry",
+            "cache-l1-memory-limit": "NBViewer.cache_l1_memory_limit",
+            "cache-max-entries": "NBViewer.cache_max_entries",
+            "cache-memory-limit": "NBViewer.cache_memory_limit",
+            "cache-path": "NBViewer.cache_path",
+            "cache-stale-if-error": "NBViewer.cache_stale_if_error",
+            "cache-stats-interval": "NBViewer.cache_stats_interval",
+            "cache-stale-while-revalidate": "NBViewer.cache_stale_while_revalidate",
             "config-file": "NBViewer.config_file",
             "content-security-policy": "NBViewer.content_security_policy",
             "default-format": "NBViewer.default_format",
             "frontpage": "NBViewer.frontpage",
             "host": "NBViewer.host",
+            "inline-render-max-bytes": "NBViewer.inline_render_max_bytes",
             "ipywidgets-base-url": "NBViewer.ipywidgets_base_url",
             "jupyter-js-widgets-version": "NBViewer.jupyter_js_widgets_version",
             "jupyter-widgets-html-manager-version": "NBViewer.jupyter_widgets_html_manager_version",
             "localfiles": "NBViewer.localfiles",
             "log-level": "Application.log_level",
+            "loop-lag-interval": "NBViewer.loop_lag_interval",
             "mathjax-url": "NBViewer.mathjax_url",
             "mc-threads": "NBViewer.mc_threads",
+            "memcache-client": "NBViewer.memcache_client",
+            "notebook-validation": "NBViewer.notebook_validation",
+            "output-extract-threshold": "NBViewer.output_extract_threshold",
             "port": "NBViewer.port",
             "processes": "NBViewer.processes",
             "provider-rewrites": "NBViewer.provider_rewrites",
@@ -109,7 +150,16 @@ class NBViewer(Application):
             "proxy-port": "NBViewer.proxy_port",
             "rate-limit": "NBViewer.rate_limit",
             "rate-limit-interval": "NBViewer.rate_limit_interval",
+            "render-cache-expiry": "NBViewer.render_cache_expiry",
+            "render-failure-expiry": "NBViewer.render_failure_expiry",
+            "render-kill-timeout": "NBViewer.render_kill_timeout",
+            "render-lock-lease": "NBViewer.render_lock_lease",
+            "render-lock-poll-interval": "NBViewer.render_lock_poll_interval",
+            "render-memory-limit": "NBViewer.render_memory_limit",
+            "render-queue-max-wait": "NBViewer.render_queue_max_wait",
+            "render-queue-size": "NBViewer.render_queue_size",
             "render-timeout": "NBViewer.render_timeout",
+            "render-worker-max-tasks": "NBViewer.render_worker_max_tasks",
             "sslcert": "NBViewer.sslcert",
             "sslkey": "NBViewer.sslkey",
             "static-path": "NBViewer.static_path",
@@ -117,8 +167,23 @@ class NBViewer(Application):
             "statsd-host": "NBViewer.statsd_host",
             "statsd-port": "NBViewer.statsd_port",
             "statsd-prefix": "NBViewer.statsd_prefix",
+            "stream-renders": "NBViewer.stream_renders",
             "template-path": "NBViewer.template_path",
+            "thread-render-max-bytes": "NBViewer.thread_render_max_bytes",
+            "thread-render-max-cells": "NBViewer.thread_render_max_cells",
             "threads": "NBViewer.threads",
+            "warm-access-log": "NBViewer.warm_access_log",
+            "warm-interval": "NBViewer.warm_interval",
+            "warm-urls-file": "NBViewer.warm_urls_file",
+        }
+    )
+
+    subcommands = Dict(  # type: ignore
+        {
+            "warm": (
+                WarmApp,
+                "Render pages in a running nbviewer so that they are cached.",
+            ),
         }
     )
 
@@ -204,6 +269,18 @@ class NBViewer(Application):
         help="The Tornado handler to use for viewing directory containing all of a user's Gists",
     ).tag(config=True)
 
+    admin_token = Unicode(
+        help="""Token for administrative requests, sent as `Authorization: token <admin_token>`.
+
+        Requests with this token (e.g. from the cache warmer) are exempt from rate limiting,
+        and may read cache statistics at /_stats/cache. Random by default.
+        """,
+    ).tag(config=True)
+
+    @default("admin_token")
+    def _default_admin_token(self):
+        return uuid.uuid4().hex
+
     answer_yes = Bool(
         default_value=False,
         help="Answer yes to any questions (e.g. confirm overwrite).",
@@ -219,6 +296,28 @@ class NBViewer(Application):
         help="URL base for binder notebook execution service.",
     ).tag(config=True)
 
+    cache_codec = Enum(
+        sorted(cache_codecs),
+        default_value="zlib",
+        help="Compression codec for values stored in memcache. zstd and lz4 require the zstandard and lz4 packages.",
+    ).tag(config=True)
+
+    cache_content_encodings = List(
+        trait=Unicode(),
+        default_value=["br", "zstd", "gzip"],
+        help="""HTTP content encodings to store cached pages in, in order of preference.
+
+        Pages are compressed once when they are cached, and cache hits are sent
+        in the best encoding the client accepts, without compressing them again.
+        br and zstd are skipped if the brotli and zstandard packages are not installed.
+        """,
+    ).tag(config=True)
+
+    cache_disk_limit = Int(
+        default_value=1024 * 1024 * 1024,
+        help="Maximum total size (bytes) of values stored in the disk cache (cache_path).",
+    ).tag(config=True)
+
     cache_expiry_max = Int(
         default_value=2 * 60 * 60, help="Maximum cache expiry (seconds)."
     ).tag(config=True)
@@ -227,6 +326,53 @@ class NBViewer(Application):
         default_value=10 * 60, help="Minimum cache expiry (seconds)."
     ).tag(config=True)
 
+    cache_l1_expiry = Int(
+        default_value=5 * 60,
+        help="How long (seconds) entries fetched from memcache or the disk cache are kept in the in-process L1 cache.",
+    ).tag(config=True)
+
+    cache_l1_memory_limit = Int(
+        default_value=64 * 1024 * 1024,
+        help="Maximum total size (bytes) of the in-process L1 cache in front of memcache or the disk cache (0 to disable).",
+    ).tag(config=True)
+
+    cache_max_entries = Int(
+        default_value=0,
+        help="Maximum number of entries in the in-process cache (0 for no limit).",
+    ).tag(config=True)
+
+    cache_memory_limit = Int(
+        default_value=256 * 1024 * 1024,
+        help="Maximum total size (bytes) of values held in the in-process cache, used when memcache is not available.",
+    ).tag(config=True)
+
+    cache_path = Unicode(
+        default_value="",
+        help="""Path of a persistent SQLite cache, used instead of the in-memory cache when memcache is not available.
+
+        Rendered pages survive restarts, so put this on local disk.
+        """,
+    ).tag(config=True)
+
+    cache_stale_if_error = Int(
+        default_value=60 * 60,
+        help="""How long (seconds) after expiry a cached page is served when refreshing it fails because upstream is unavailable or rate-limited.
+
+        Pages are kept in the cache this long after expiry (or cache_stale_while_revalidate, if longer),
+        so longer windows keep every page in the cache longer.
+        """,
+    ).tag(config=True)
+
+    cache_stale_while_revalidate = Int(
+        default_value=60 * 60,
+        help="How long (seconds) after expiry a cached page is served immediately while it is refreshed in the background.",
+    ).tag(config=True)
+
+    cache_stats_interval = Float(
+        default_value=60,
+        help="Interval (in seconds) at which cache statistics are sent to statsd as gauges (0 to disable).",
+    ).tag(config=True)
+
     client = Any().tag(config=True)
 
     @default("client")
@@ -285,6 +431,15 @@ class NBViewer(Application):
             indexer = NoSearch()
         return indexer
 
+    inline_render_max_bytes = Int(
+        default_value=2**16,
+        help="""Maximum size (bytes) of notebooks rendered in the event loop, in formats with inline_render (e.g. script).
+
+        Parsing and rendering blocks the event loop for about 20ms per MB,
+        so larger notebooks are rendered in the render pool. 0 means never in the event loop.
+        """,
+    ).tag(config=True)
+
     ipywidgets_base_url = Unicode(
         default_value="https://unpkg.com/", help="URL base for ipywidgets JS package."
     ).tag(config=True)
@@ -313,6 +468,11 @@ class NBViewer(Application):
         help="Allow to serve local files under /localfile/* this can be a security risk.",
     ).tag(config=True)
 
+    loop_lag_interval = Float(
+        default_value=1.0,
+        help="Interval (in seconds) for measuring event loop lag, reported to statsd as loop.lag (0 to disable).",
+    ).tag(config=True)
+
     mathjax_url = Unicode(
         default_value="https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/",
         help="URL base for mathjax package.",
@@ -333,12 +493,52 @@ class NBViewer(Application):
         default_value=1, help="Number of threads to use for Async Memcache."
     ).tag(config=True)
 
+    memcache_client = Enum(
+        ["pylibmc", "asyncio"],
+        default_value="pylibmc",
+        help="""Memcache client implementation.
+
+        'pylibmc' runs pylibmc in a thread pool (see mc_threads),
+        'asyncio' speaks the memcached text protocol on the event loop,
+        and is used when pylibmc is not installed.
+        With MEMCACHIER_USERNAME and MEMCACHIER_PASSWORD, pylibmc authenticates with SASL,
+        while 'asyncio' uses memcached's ASCII auth (memcached -Y),
+        which SASL-only servers such as MemCachier don't support.
+        """,
+    ).tag(config=True)
+
+    memcache_pool_size = Int(
+        default_value=2,
+        help="Number of connections per memcache server for the asyncio memcache client.",
+    ).tag(config=True)
+
     no_cache = Bool(default_value=False, help="Do not cache results.").tag(config=True)
 
     no_check_certificate = Bool(
         default_value=False, help="Do not validate SSL certificates."
     ).tag(config=True)
 
+    notebook_validation = Enum(
+        validation_modes,
+        default_value="cached",
+        help="""When to validate notebooks against the nbformat schema, which only logs errors.
+
+        always: on every render. cached: once per notebook content, per render process.
+        never: not at all.
+        """,
+    ).tag(config=True)
+
+    output_extract_threshold = Int(
+        default_value=0,
+        help="""Size (bytes) above which images in rendered notebooks are served separately (0 to disable).
+
+        Larger images, which nbconvert inlines as base64, are replaced by lazy-loaded links to /_outputs/<sha256>,
+        so pages are smaller and identical images are stored once.
+        The images are cached for as long as pages linking to them,
+        but like pages they can be evicted early from a cache that is full.
+        """,
+    ).tag(config=True)
+
     port = Int(help="Run on the given port.").tag(config=True)
 
     @default("port")
@@ -374,11 +574,89 @@ class NBViewer(Application):
         default_value=600, help="Interval (in seconds) for rate limiting."
     ).tag(config=True)
 
+    render_cache_expiry = Int(
+        default_value=24 * 60 * 60,
+        help="""How long (seconds) nbconvert output is cached by notebook content (0 to disable).
+
+        The same notebook reached through different URLs (GitHub, raw URLs, gists)
+        is converted only once.
+        """,
+    ).tag(config=True)
+
+    render_failure_expiry = Int(
+        default_value=300,
+        help="""How long (seconds) to remember that a notebook's render was killed.
+
+        Requests for the notebook fail right away in the meantime, instead of rendering it again.
+        See render_kill_timeout and render_memory_limit.
+        """,
+    ).tag(config=True)
+
+    render_kill_timeout = Int(
+        default_value=300,
+        help="""Time (seconds) after which a render is killed, with its worker process.
+
+        Only with processes > 0. 0 means never.
+        """,
+    ).tag(config=True)
+
+    render_lock_lease = Int(
+        help="""How long (seconds) a process may hold the shared lock on rendering a page.
+
+        While one process renders a page, other processes sharing the cache wait for its result
+        instead of rendering the same page. 0 disables the shared lock.
+        Defaults to a minute more than render_kill_timeout (at least 5 minutes),
+        so that a render doesn't outlive its lease.
+        """,
+    ).tag(config=True)
+
+    @default("render_lock_lease")
+    def _default_render_lock_lease(self):
+        return max(self.render_kill_timeout, 240) + 60
+
+    render_lock_poll_interval = Float(
+        default_value=0.5,
+        help="Interval (in seconds) at which processes waiting on another process's render check the cache.",
+    ).tag(config=True)
+
+    render_memory_limit = Int(
+        default_value=0,
+        help="""Resident memory (MB) above which a render is killed, with its worker process.
+
+        Only with processes > 0, on Linux. 0 means no limit.
+        """,
+    ).tag(config=True)
+
+    render_queue_max_wait = Float(
+        default_value=60,
+        help="""Refuse renders (503, or the stale page) expected to wait for longer than this (seconds) in the render queue.
+
+        The wait is estimated from recent render times. 0 means no limit.
+        """,
+    ).tag(config=True)
+
+    render_queue_size = Int(
+        default_value=100,
+        help="""Maximum number of renders waiting for the render pool.
+
+        When the queue is full, the most expensive waiting render is refused
+        to make room for a cheaper one. 0 means no limit.
+        """,
+    ).tag(config=True)
+
     render_timeout = Int(
         default_value=15,
         help="Time to wait for a render to complete before showing the 'Working...' page.",
     ).tag(config=True)
 
+    render_worker_max_tasks = Int(
+        default_value=1000,
+        help="""Number of renders after which a render process is replaced by a new one, to contain memory growth.
+
+        Only with processes > 0. 0 means never.
+        """,
+    ).tag(config=True)
+
     sslcert = Unicode(help="Path to ssl .crt file.").tag(config=True)
 
     sslkey = Unicode(help="Path to ssl .key file.").tag(config=True)
@@ -411,15 +689,68 @@ class NBViewer(Application):
         help="Prefix to use for naming metrics sent to statsd.",
     ).tag(config=True)
 
+    stream_renders = Bool(
+        default_value=False,
+        help="""Send the page around a notebook before the notebook is rendered.
+
+        The browser can fetch the page's styles and scripts while the notebook is converted.
+        An error while converting is then shown inside the page, with a 200 status,
+        so streamed responses are sent with Cache-Control: no-cache.
+        """,
+    ).tag(config=True)
+
     template_path = Unicode(
         default_value=os.environ.get("NBVIEWER_TEMPLATE_PATH", ""),
         help="Custom template path for the nbviewer app (not rendered notebooks).",
     ).tag(config=True)
 
+    thread_render_max_bytes = Int(
+        default_value=100000,
+        help="""With processes > 0, notebooks up to this size (bytes of JSON) are rendered in a pool of `threads` threads.
+
+        Small renders don't pay for sending the notebook to a process and back,
+        while large ones don't hold the GIL of the process serving requests.
+        0 means all renders use processes.
+        """,
+    ).tag(config=True)
+
+    thread_render_max_cells = Int(
+        default_value=100,
+        help="Notebooks with more cells than this are rendered in processes, whatever their size (see thread_render_max_bytes). 0 means no limit.",
+    ).tag(config=True)
+
     threads = Int(default_value=1, help="Number of threads to use for rendering.").tag(
         config=True
     )
 
+    warm_access_log = Unicode(
+        default_value="",
+        help="Path to an access log. The most requested pages in it are warmed periodically (see warm_interval).",
+    ).tag(config=True)
+
+    warm_concurrency = Int(
+        default_value=2, help="Number of pages to warm at the same time."
+    ).tag(config=True)
+
+    warm_interval = Int(
+        default_value=0,
+        help="""Interval (in seconds) at which to warm the frontpage links and other warmed pages (0 to disable).
+
+        Pages that aren't cached are rendered, and cached pages that would expire
+        before the next round are re-rendered. Others are left as they are.
+        """,
+    ).tag(config=True)
+
+    warm_top = Int(
+        default_value=100,
+        help="Number of most requested pages from warm_access_log to warm.",
+    ).tag(config=True)
+
+    warm_urls_file = Unicode(
+        default_value="",
+        help="Path to a file of pages to warm periodically, one per line (see warm_interval).",
+    ).tag(config=True)
+
     # prefer the JupyterHub defined service prefix over the CLI
     @cached_property
     def _base_url(self):
@@ -427,6 +758,10 @@ class NBViewer(Application):
 
     @cached_property
     def cache(self):
+        return InstrumentedCache(self.cache_backend, self.cache_stats)
+
+    @cached_property
+    def cache_backend(self):
         memcache_urls = os.environ.get(
             "MEMCACHIER_SERVERS", os.environ.get("MEMCACHE_SERVERS")
         )
@@ -436,11 +771,39 @@ class NBViewer(Application):
             memcache_urls = tcp_memcache.split("tcp://")[1]
         if self.no_cache:
             self.log.info("Not using cache")
-            cache = MockCache()
-        elif pylibmc and memcache_urls:
+            return MockCache()
+
+        if not memcache_urls and not self.cache_path:
+            self.log.info("Using in-memory cache")
+            return AsyncLRUCache(
+                max_bytes=self.cache_memory_limit, max_entries=self.cache_max_entries
+            )
+
+        if not memcache_urls:
+            self.log.info("Using disk cache at %s", self.cache_path)
+            cache = AsyncSQLiteCache(self.cache_path, max_bytes=self.cache_disk_limit)
+        elif self.memcache_client == "asyncio" or not pylibmc:
+            username = os.environ.get("MEMCACHIER_USERNAME", "")
+            password = os.environ.get("MEMCACHIER_PASSWORD", "")
+            if username and password:
+                if not pylibmc:
+                    self.log.warning(
+                        "pylibmc is not installed, using memcached ASCII auth instead of SASL"
+                    )
+                self.log.info("Using asyncio memcache with ASCII auth")
+            else:
+                self.log.info("Using asyncio memcache")
+            cache = AsyncMultipartAioMemcache(
+                memcache_urls.split(","),
+                codec=get_codec(self.cache_codec),
+                pool_size=self.memcache_pool_size,
+                username=username or None,
+                password=password or None,
+            )
+        else:
             # setup memcache
             mc_pool = ThreadPoolExecutor(self.mc_threads)
-            kwargs = dict(pool=mc_pool)
+            kwargs = dict(pool=mc_pool, codec=get_codec(self.cache_codec))
             username = os.environ.get("MEMCACHIER_USERNAME", "")
             password = os.environ.get("MEMCACHIER_PASSWORD", "")
             if username and password:
@@ -452,12 +815,51 @@ class NBViewer(Application):
                 self.log.info("Using plain memcache")
 
             cache = AsyncMultipartMemcache(memcache_urls.split(","), **kwargs)
-        else:
-            self.log.info("Using in-memory cache")
-            cache = DummyAsyncCache()
 
+        if self.cache_l1_memory_limit:
+            self.log.info(
+                "Using %i MB in-process L1 cache",
+                self.cache_l1_memory_limit // (1024 * 1024),
+            )
+            cache = AsyncLayeredCache(
+                cache,
+                max_bytes=self.cache_l1_memory_limit,
+                max_entries=self.cache_max_entries,
+                l1_expiry=self.cache_l1_expiry,
+            )
         return cache
 
+    @cached_property
+    def counter_cache(self):
+        """Cache for rate limit counters and render locks
+
+        The shared cache, except for the disk cache,
+        where every add and incr would be a commit on its single thread:
+        they are kept in memory instead, per process.
+        """
+        backend = getattr(self.cache_backend, "l2", self.cache_backend)
+        if isinstance(backend, AsyncSQLiteCache):
+            return AsyncLRUCache(max_bytes=16 * 1024 * 1024)
+        return self.cache
+
+    @cached_property
+    def cache_stats(self):
+        return CacheStats()
+
+    def report_cache_stats(self):
+        self.cache_stats.report(self.statsd, backend_stats(self.cache_backend))
+
+    @cached_property
+    def content_encodings(self):
+        encodings = available_content_encodings(self.cache_content_encodings)
+        for name in self.cache_content_encodings:
+            if name not in encodings:
+                self.log.warning(
+                    "Not storing %s encoded pages, its compression package is not installed",
+                    name,
+                )
+        return encodings
+
     @cached_property
     def default_endpoint(self):
         # check if JupyterHub service options are available to use as defaults
@@ -558,10 +960,25 @@ class NBViewer(Application):
         """Exclude date from default date format"""
         return "%Y-%m-%d %H:%M:%S"
 
+    @cached_property
+    def loop_lag_monitor(self):
+        return LoopLagMonitor(self.loop_lag_interval, self.statsd, self.log)
+
     @cached_property
     def pool(self):
         if self.processes:
-            pool = ProcessPoolExecutor(self.processes)
+            # workers are forked from a server that has imported what they need
+            multiprocessing.set_forkserver_preload(["nbviewer.render"])
+            pool = SupervisedProcessPool(
+                self.processes,
+                timeout=self.render_kill_timeout,
+                max_rss=self.render_memory_limit * 2**20,
+                initializer=warm_up,
+                initargs=(self.formats, self.config),
+                max_tasks=self.render_worker_max_tasks,
+                statsd=self.statsd,
+                log=self.log,
+            )
         else:
             pool = ThreadPoolExecutor(self.threads)
         return pool
@@ -569,10 +986,107 @@ class NBViewer(Application):
     @cached_property
     def rate_limiter(self):
         rate_limiter = RateLimiter(
-            limit=self.rate_limit, interval=self.rate_limit_interval, cache=self.cache
+            limit=self.rate_limit,
+            interval=self.rate_limit_interval,
+            cache=self.counter_cache,
+            exempt_token=self.admin_token,
         )
         return rate_limiter
 
+    @cached_property
+    def render_scheduler(self):
+        return RenderScheduler(
+            concurrency=self.processes or self.threads,
+            max_queue=self.render_queue_size,
+            max_wait=self.render_queue_max_wait,
+            statsd=self.statsd,
+        )
+
+    @cached_property
+    def thread_pool(self):
+        """Threads for small renders, alongside the process pool"""
+        if self.processes and self.thread_render_max_bytes:
+            return ThreadPoolExecutor(self.threads)
+
+    def warm_render_pools(self):
+        """Wait for the render pools (and the event loop) to load exporters and compile templates
+
+        so that the first renders are as fast as the following ones.
+        """
+        tic = time.monotonic()
+        for pool in (self.pool, self.thread_pool):
+            if isinstance(pool, SupervisedProcessPool):
+                # workers warm up as they start
+                pool.wait_ready()
+            elif pool is not None:
+                # exporters are shared by threads
+                pool.submit(warm_up, self.formats, self.config).result()
+        if self.inline_render_max_bytes:
+            # and the event loop, for formats rendered there
+            warm_up(
+                {
+                    name: format
+                    for name, format in self.formats.items()
+                    if format.get("inline_render")
+                },
+                self.config,
+            )
+        self.log.info("Render pools ready in %.1fs", time.monotonic() - tic)
+
+    @cached_property
+    def thread_render_scheduler(self):
+        if self.thread_pool is not None:
+            return RenderScheduler(
+                concurrency=self.threads,
+                max_queue=self.render_queue_size,
+                max_wait=self.render_queue_max_wait,
+                statsd=self.statsd,
+            )
+
+    @cached_property
+    def single_flight(self):
+        single_flight = SingleFlight(
+            cache=self.counter_cache,
+            lease=self.render_lock_lease,
+            poll_interval=self.render_lock_poll_interval,
+        )
+        return single_flight
+
+    @cached_property
+    def warmer(self):
+        url = "http://%s:%i" % (
+            "127.0.0.1" if self.host in ("", "0.0.0.0") else self.host,
+            self.port,
+        )
+        return CacheWarmer(
+            url_path_join(url, self._base_url),
+            concurrency=self.warm_concurrency,
+            token=self.admin_token,
+            # pages that would expire before the next round
+            refresh=self.warm_interval,
+            log=self.log,
+        )
+
+    def get_warm_uris(self):
+        """The pages to keep warm: frontpage links, warm_urls_file, and warm_access_log"""
+        uris = sorted(self.max_cache_uris)
+        if self.warm_urls_file:
+            uris.extend(read_url_list(self.warm_urls_file))
+        if self.warm_access_log:
+            with open(self.warm_access_log, errors="replace") as f:
+                uris.extend(top_access_log_uris(f, self.warm_top, self._base_url))
+        return uris
+
+    @cached_property
+    def statsd(self):
+        if self.statsd_host:
+            return statsd.StatsClient(
+                self.statsd_host, self.statsd_port, self.statsd_prefix
+            )
+        else:
+            # return an empty mock object!
+            return EmptyClass()
+
     @cached_property
     def static_paths(self):
         default_static_path = pjoin(here, "static")
@@ -662,13 +1176,17 @@ class NBViewer(Application):
 
         # input traitlets to settings
         settings = dict(
+            admin_token=self.admin_token,
             # Allow FileFindHandler to load static directories from e.g. a Docker container
             allow_remote_access=True,
             base_url=self._base_url,
             binder_base_url=self.binder_base_url,
             cache=self.cache,
+            cache_content_encodings=self.content_encodings,
             cache_expiry_max=self.cache_expiry_max,
             cache_expiry_min=self.cache_expiry_min,
+            cache_stale_if_error=self.cache_stale_if_error,
+            cache_stale_while_revalidate=self.cache_stale_while_revalidate,
             client=self.client,
             config=self.config,
             content_security_policy=self.content_security_policy,
@@ -683,6 +1201,7 @@ class NBViewer(Application):
             hub_api_url=os.getenv("JUPYTERHUB_API_URL"),
             hub_base_url=os.getenv("JUPYTERHUB_BASE_URL"),
             index=self.index,
+            inline_render_max_bytes=self.inline_render_max_bytes,
             ipywidgets_base_url=self.ipywidgets_base_url,
             jinja2_env=self.env,
             jupyter_js_widgets_version=self.jupyter_js_widgets_version,
@@ -694,11 +1213,17 @@ class NBViewer(Application):
             log_function=log_request,
             mathjax_url=self.mathjax_url,
             max_cache_uris=self.max_cache_uris,
+            notebook_validation=self.notebook_validation,
+            output_extract_threshold=self.output_extract_threshold,
             pool=self.pool,
             provider_rewrites=self.provider_rewrites,
             providers=self.providers,
             rate_limiter=self.rate_limiter,
+            render_cache_expiry=self.render_cache_expiry,
+            render_failure_expiry=self.render_failure_expiry,
+            render_scheduler=self.render_scheduler,
             render_timeout=self.render_timeout,
+            single_flight=self.single_flight,
             static_handler_class=StaticFileHandler,
             # FileFindHandler expects list of static paths, so self.static_path*s* is correct
             static_path=self.static_paths,
@@ -706,6 +1231,11 @@ class NBViewer(Application):
             statsd_host=self.statsd_host,
             statsd_port=self.statsd_port,
             statsd_prefix=self.statsd_prefix,
+            stream_renders=self.stream_renders,
+            thread_pool=self.thread_pool,
+            thread_render_max_bytes=self.thread_render_max_bytes,
+            thread_render_max_cells=self.thread_render_max_cells,
+            thread_render_scheduler=self.thread_render_scheduler,
         )
 
         if self.localfiles:
@@ -790,12 +1320,17 @@ class NBViewer(Application):
         # Inherited method from traitlets.config.Application
         self.load_config_file(self.config_file)
         self.init_logging()
+        if self.subapp is not None:
+            # e.g. `nbviewer warm`, which doesn't serve anything
+            return
         self.init_tornado_application()
 
 
 def main(argv=None):
     # create and start the app
     nbviewer = NBViewer()
+    if nbviewer.subapp is not None:
+        return nbviewer.subapp.start()
     app = nbviewer.tornado_application
 
     # load ssl options
@@ -811,7 +1346,21 @@ def main(argv=None):
         app.settings["base_url"],
     )
 
+    # don't accept requests before renders are fast
+    nbviewer.warm_render_pools()
     http_server.listen(nbviewer.port, nbviewer.host)
+
+    if nbviewer.loop_lag_interval:
+        nbviewer.loop_lag_monitor.start()
+
+    if nbviewer.cache_stats_interval and nbviewer.statsd_host:
+        ioloop.PeriodicCallback(
+            nbviewer.report_cache_stats, 1e3 * nbviewer.cache_stats_interval
+        ).start()
+
+    if nbviewer.warm_interval:
+        nbviewer.warmer.start(nbviewer.get_warm_uris, nbviewer.warm_interval)
+
     try:
         ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
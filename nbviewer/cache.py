@@ -5,22 +5,185 @@
 #  the file COPYING, distributed as part of this software.
 # -----------------------------------------------------------------------------
 import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import sqlite3
+import struct
+import sys
+import time
+import uuid
 import zlib
 from asyncio import Future
+from collections import defaultdict
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from time import monotonic
 
 from tornado.log import app_log
 
+from .memcache import _decode_value
+from .memcache import _encode_value
+from .memcache import AioMemcacheClient
+
 try:
     import pylibmc  # type: ignore
 except ModuleNotFoundError:
     pylibmc = None  # type: ignore
 
+try:
+    import zstandard  # type: ignore
+except ModuleNotFoundError:
+    zstandard = None  # type: ignore
+
+try:
+    import lz4.frame  # type: ignore
+except ModuleNotFoundError:
+    lz4 = None  # type: ignore
+
 # -----------------------------------------------------------------------------
 # Code
 # -----------------------------------------------------------------------------
 
+# memcached treats expiry values larger than 30 days as unix timestamps
+_MAX_RELATIVE_EXPIRY = 30 * 24 * 60 * 60
+
+
+class ZlibCodec(object):
+    """Compress cache values with zlib"""
+
+    name = "zlib"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    @staticmethod
+    def matches(data):
+        # zlib header: deflate with 32K window, checksum of the first two bytes
+        return len(data) > 1 and data[0] == 0x78 and (data[0] * 256 + data[1]) % 31 == 0
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCodec(object):
+    """Compress cache values with zstandard (requires the zstandard package)"""
+
+    name = "zstd"
+    magic = b"\x28\xb5\x2f\xfd"
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise ValueError("zstd cache codec requires the zstandard package")
+        self.level = level
+
+    @classmethod
+    def matches(cls, data):
+        return data[:4] == cls.magic
+
+    def compress(self, data):
+        # compressor objects are not thread-safe, make one per call
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class LZ4Codec(object):
+    """Compress cache values with lz4 (requires the lz4 package)"""
+
+    name = "lz4"
+    magic = b"\x04\x22\x4d\x18"
+
+    def __init__(self):
+        if lz4 is None:
+            raise ValueError("lz4 cache codec requires the lz4 package")
+
+    @classmethod
+    def matches(cls, data):
+        return data[:4] == cls.magic
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+cache_codecs = {codec.name: codec for codec in (ZlibCodec, ZstdCodec, LZ4Codec)}
+
+
+def get_codec(name):
+    """Return a codec instance by name ('zlib', 'zstd' or 'lz4')"""
+    try:
+        codec_cls = cache_codecs[name]
+    except KeyError:
+        raise ValueError("Unknown cache codec: %r" % name)
+    return codec_cls()
+
+
+def decompress(data, codec=None):
+    """Decompress data, detecting the codec from its header
+
+    so that values written with a previously configured codec can still be read.
+    """
+    for codec_cls in cache_codecs.values():
+        if codec_cls.matches(data):
+            if codec is None or codec.name != codec_cls.name:
+                codec = codec_cls()
+            return codec.decompress(data)
+    raise ValueError("Unrecognized compressed data")
+
+
+# -----------------------------------------------------------------------------
+# Record format
+# -----------------------------------------------------------------------------
+
+# cached pages and upstream responses are stored as:
+#   magic (4 bytes) | version (1 byte) | header length (4 bytes, big-endian)
+#   | header (utf8 JSON) | body (raw bytes)
+# the magic can't start a pickle, so entries pickled by older versions are told apart
+# (and treated as cache misses)
+RECORD_MAGIC = b"NBVR"
+RECORD_VERSION = 1
+_record_prefix = struct.Struct(">4sBI")
+
+
+def pack_record(header, body):
+    """Pack a JSON-able header dict and a body (bytes or str) into a cache record"""
+    if isinstance(body, str):
+        body = body.encode("utf8")
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf8")
+    return b"".join(
+        [
+            _record_prefix.pack(RECORD_MAGIC, RECORD_VERSION, len(header_bytes)),
+            header_bytes,
+            body,
+        ]
+    )
+
+
+def unpack_record(data):
+    """Unpack a cache record into (header, body)
+
+    body is a memoryview on `data`, so it is not copied.
+    Returns None if data is not a record (e.g. a pickle written by an older nbviewer),
+    which is never unpickled.
+    """
+    if data[: len(RECORD_MAGIC)] != RECORD_MAGIC:
+        return None
+    magic, version, header_length = _record_prefix.unpack_from(data)
+    if version != RECORD_VERSION:
+        raise ValueError("Unsupported cache record version %i" % version)
+    view = memoryview(data)
+    start = _record_prefix.size
+    header = json.loads(bytes(view[start : start + header_length]))
+    return header, view[start + header_length :]
+
 
 class MockCache(object):
     """Mock Cache. Just stores nothing and always return None on get."""
@@ -48,68 +211,446 @@ class MockCache(object):
         f.set_result(None)
         return await f
 
+    async def delete(self, key):
+        f = Future()
+        f.set_result(False)
+        return await f
 
-class DummyAsyncCache(object):
-    """Dummy Async Cache. Just stores things in a dict of fixed size."""
 
-    def __init__(self, limit=10):
-        self._cache = {}
-        self._cache_order = []
-        self.limit = limit
+def _expiry_deadline(expires):
+    """Convert a memcache-style expiry to a deadline on the monotonic clock
+
+    Following memcached, 0 means never expire,
+    values up to 30 days are relative seconds,
+    and anything larger is an absolute unix timestamp.
+    """
+    if not expires:
+        return None
+    if expires > _MAX_RELATIVE_EXPIRY:
+        expires = expires - time.time()
+    return monotonic() + expires
+
+
+def _sizeof(value):
+    """Approximate size in bytes of a cached value"""
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUStore(object):
+    """Synchronous in-process LRU store, bounded by the total size of its values
+
+    Recency is tracked by an OrderedDict, so get/set/evict are O(1).
+    Expiry deadlines are kept in a heap, so expired entries are purged
+    without scanning the whole store.
+    """
+
+    def __init__(self, max_bytes=0, max_entries=0):
+        # 0 means unbounded
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.nbytes = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key: (value, size, deadline)
+        self._deadlines = []  # heap of (deadline, key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        self.purge_expired()
+        return key in self._data
+
+    def purge_expired(self):
+        """Drop every entry whose deadline has passed"""
+        now = monotonic()
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(deadlines)
+            entry = self._data.get(key)
+            # heap entries are not removed when a key is overwritten or deleted,
+            # so only drop the key if this deadline is still its own
+            if entry is not None and entry[2] == deadline:
+                self._remove(key)
+
+    def get(self, key):
+        self.purge_expired()
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value, expires=0):
+        """Store a value, evicting least-recently-used entries to make room
+
+        Returns False if the value alone is larger than the whole store.
+        """
+        self.purge_expired()
+        size = _sizeof(value)
+        if key in self._data:
+            self._remove(key)
+        if self.max_bytes and size > self.max_bytes:
+            return False
+
+        deadline = _expiry_deadline(expires)
+        self._data[key] = (value, size, deadline)
+        self.nbytes += size
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (deadline, key))
+            if len(self._deadlines) > 2 * len(self._data) + 64:
+                self._compact_deadlines()
+
+        while (self.max_bytes and self.nbytes > self.max_bytes) or (
+            self.max_entries and len(self._data) > self.max_entries
+        ):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+        return True
+
+    def add(self, key, value, expires=0):
+        """Store a value only if the key is not already present"""
+        if key in self:
+            return False
+        return self.set(key, value, expires)
+
+    def incr(self, key, delta=1):
+        """Increment an integer value in place, without touching its expiry"""
+        self.purge_expired()
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, size, deadline = entry
+        value = value + delta
+        self._data[key] = (value, size, deadline)
+        return value
+
+    def delete(self, key):
+        self.purge_expired()
+        if key not in self._data:
+            return False
+        self._remove(key)
+        return True
+
+    def _remove(self, key):
+        value, size, deadline = self._data.pop(key)
+        self.nbytes -= size
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+    def _compact_deadlines(self):
+        """Rebuild the deadline heap without entries for overwritten keys"""
+        self._deadlines = [
+            (deadline, key)
+            for key, (value, size, deadline) in self._data.items()
+            if deadline is not None
+        ]
+        heapq.heapify(self._deadlines)
+
+
+class AsyncLRUCache(object):
+    """In-process async cache backed by an LRUStore
+
+    Bounded by the total size of stored values (max_bytes)
+    and optionally by entry count (max_entries).
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_entries=0):
+        self.store = LRUStore(max_bytes=max_bytes, max_entries=max_entries)
 
     async def get(self, key):
-        f = Future()
-        f.set_result(self._get(key))
-        return await f
+        return self.store.get(key)
 
-    def _get(self, key):
-        value, deadline = self._cache.get(key, (None, None))
-        if deadline and deadline < monotonic():
-            self._cache.pop(key)
-            self._cache_order.remove(key)
-        else:
+    async def set(self, key, value, expires=0):
+        return self.store.set(key, value, expires)
+
+    async def add(self, key, value, expires=0):
+        return self.store.add(key, value, expires)
+
+    async def incr(self, key):
+        return self.store.incr(key)
+
+    async def delete(self, key):
+        return self.store.delete(key)
+
+    def stats(self):
+        return self.store.stats()
+
+
+class DummyAsyncCache(AsyncLRUCache):
+    """Dummy Async Cache. Just stores things in a dict of fixed size.
+
+    Kept for backward-compatibility, prefer AsyncLRUCache.
+    """
+
+    def __init__(self, limit=10):
+        super().__init__(max_bytes=0, max_entries=limit)
+
+
+class AsyncLayeredCache(object):
+    """Two-tier cache: a bounded in-process L1 in front of a shared L2 cache
+
+    Reads are served from L1 when possible and fall through to L2 on a miss,
+    populating L1 on the way back.
+    Writes go to both tiers, with the expiry passed to `set`.
+    Values filled from L2 have no known expiry,
+    so they are only kept in L1 for `l1_expiry` seconds.
+
+    `add` and `incr` are used for shared counters (e.g. rate limits),
+    so they always go straight to L2.
+    """
+
+    def __init__(self, l2, max_bytes=64 * 1024 * 1024, max_entries=0, l1_expiry=60):
+        self.l1 = LRUStore(max_bytes=max_bytes, max_entries=max_entries)
+        self.l2 = l2
+        self.l1_expiry = l1_expiry
+        self.l1_hits = 0
+        self.l1_misses = 0
+
+    async def get(self, key, *args, **kwargs):
+        value = self.l1.get(key)
+        if value is not None:
+            self.l1_hits += 1
             return value
+        self.l1_misses += 1
+        value = await self.l2.get(key, *args, **kwargs)
+        if value is not None:
+            self.l1.set(key, value, self.l1_expiry)
+        return value
 
-    async def set(self, key, value, expires=0):
-        if key in self._cache and self._cache_order[-1] != key:
-            idx = self._cache_order.index(key)
-            del self._cache_order[idx]
-            self._cache_order.append(key)
-        else:
-            if len(self._cache) >= self.limit:
-                oldest = self._cache_order.pop(0)
-                self._cache.pop(oldest)
-            self._cache_order.append(key)
+    async def refresh(self, key, *args, **kwargs):
+        """Get a value from L2, replacing the L1 copy
+
+        For values that may have changed in another process,
+        e.g. a page rendered elsewhere while this process waited for it.
+        """
+        self.l1.delete(key)
+        return await self.get(key, *args, **kwargs)
+
+    async def set(self, key, value, expires=0, *args, **kwargs):
+        self.l1.set(key, value, expires)
+        return await self.l2.set(key, value, expires, *args, **kwargs)
+
+    async def add(self, key, value, *args, **kwargs):
+        self.l1.delete(key)
+        return await self.l2.add(key, value, *args, **kwargs)
+
+    async def incr(self, key, *args, **kwargs):
+        self.l1.delete(key)
+        return await self.l2.incr(key, *args, **kwargs)
+
+    async def delete(self, key, *args, **kwargs):
+        self.l1.delete(key)
+        return await self.l2.delete(key, *args, **kwargs)
+
+    def stats(self):
+        l1 = dict(self.l1.stats(), hits=self.l1_hits, misses=self.l1_misses)
+        return {"l1": l1, "l2": backend_stats(self.l2)}
+
+
+class AsyncSQLiteCache(object):
+    """Persistent cache in a local SQLite database
+
+    Survives restarts, so a freshly deployed instance can serve
+    rendered pages from local disk instead of re-rendering everything.
 
+    All database access happens on a single background thread,
+    so the event loop never blocks on disk I/O.
+
+    Expiry follows memcache semantics, stored as unix timestamps
+    so that it remains meaningful across restarts.
+    When the total size of stored values exceeds `max_bytes`,
+    least-recently-read entries are evicted down to `low_water` of the limit.
+    Read times are only written when older than `atime_granularity` seconds,
+    so that hot entries don't cost a write on every read.
+    """
+
+    def __init__(
+        self, path, max_bytes=1024 * 1024 * 1024, low_water=0.9, atime_granularity=60
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.atime_granularity = atime_granularity
+        self.nbytes = 0
+        self.evictions = 0
+        self.pool = ThreadPoolExecutor(1)
+        self._db = None
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                flags INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL,
+                atime REAL NOT NULL
+            )"""
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+        db.commit()
+        self._db = db
+        self._purge_expired()
+        self.nbytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[
+            0
+        ]
+        app_log.info(
+            "Opened disk cache %s with %i entries (%i MB)",
+            self.path,
+            db.execute("SELECT COUNT(*) FROM cache").fetchone()[0],
+            self.nbytes // (1024 * 1024),
+        )
+        return db
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.pool, func, *args)
+
+    @staticmethod
+    def _expires_at(expires):
         if not expires:
-            deadline = None
-        else:
-            deadline = monotonic() + expires
+            return None
+        if expires > _MAX_RELATIVE_EXPIRY:
+            return expires
+        return time.time() + expires
 
-        self._cache[key] = (value, deadline)
-        f = Future()
-        f.set_result(True)
-        return await f
+    def _purge_expired(self):
+        db = self._db
+        size = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache WHERE expires <= ?",
+            (time.time(),),
+        ).fetchone()[0]
+        db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        db.commit()
+        self.nbytes -= size
+
+    def _evict(self):
+        """Drop expired entries, then least-recently-read entries until under budget"""
+        self._purge_expired()
+        if self.nbytes <= self.max_bytes:
+            return
+        db = self._db
+        target = self.nbytes - self.max_bytes * self.low_water
+        freed = 0
+        evicted = []
+        for key, size in db.execute("SELECT key, size FROM cache ORDER BY atime"):
+            evicted.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        db.executemany("DELETE FROM cache WHERE key = ?", evicted)
+        db.commit()
+        self.nbytes -= freed
+        self.evictions += len(evicted)
+        app_log.info(
+            "Evicted %i entries (%i kB) from disk cache", len(evicted), freed // 1024
+        )
+
+    def _get(self, key):
+        db = self._connect()
+        row = db.execute(
+            "SELECT value, flags, expires, atime FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, flags, expires, atime = row
+        now = time.time()
+        if expires is not None and expires <= now:
+            return None
+        if now - atime >= self.atime_granularity:
+            db.execute("UPDATE cache SET atime = ? WHERE key = ?", (now, key))
+            db.commit()
+        return _decode_value(value, flags)
+
+    def _set(self, key, value, expires=0, only_new=False):
+        db = self._connect()
+        data, flags = _encode_value(value)
+        size = len(data)
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        row = db.execute(
+            "SELECT size, expires FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            old_size, old_expires = row
+            if only_new and (old_expires is None or old_expires > time.time()):
+                return False
+            self.nbytes -= old_size
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, flags, size, expires, atime)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (key, data, flags, size, self._expires_at(expires), now),
+        )
+        db.commit()
+        self.nbytes += size
+        if self.max_bytes and self.nbytes > self.max_bytes:
+            self._evict()
+        return True
+
+    def _incr(self, key, delta=1):
+        value = self._get(key)
+        if value is None:
+            return None
+        value = value + delta
+        db = self._db
+        data, flags = _encode_value(value)
+        (old_size,) = db.execute(
+            "SELECT size FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        db.execute(
+            "UPDATE cache SET value = ?, flags = ?, size = ? WHERE key = ?",
+            (data, flags, len(data), key),
+        )
+        db.commit()
+        self.nbytes += len(data) - old_size
+        return value
+
+    def _delete(self, key):
+        db = self._connect()
+        row = db.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        db.execute("DELETE FROM cache WHERE key = ?", (key,))
+        db.commit()
+        self.nbytes -= row[0]
+        return True
+
+    async def get(self, key):
+        return await self._run(self._get, key)
+
+    async def set(self, key, value, expires=0):
+        return await self._run(self._set, key, value, expires)
 
     async def add(self, key, value, expires=0):
-        f = Future()
-        if self._get(key) is not None:
-            f.set_result(False)
-        else:
-            await self.set(key, value, expires)
-            f.set_result(True)
-        return await f
+        return await self._run(self._set, key, value, expires, True)
 
-    async def incr(self, key):
-        f = Future()
-        if self._get(key) is not None:
-            value, deadline = self._cache[key]
-            value = value + 1
-            self._cache[key] = (value, deadline)
-        else:
-            value = None
-        f.set_result(value)
-        return await f
+    async def incr(self, key, delta=1):
+        return await self._run(self._incr, key, delta)
+
+    async def delete(self, key):
+        return await self._run(self._delete, key)
+
+    def stats(self):
+        return {
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
 
 
 class AsyncMemcache(object):
@@ -154,45 +695,340 @@ class AsyncMemcache(object):
     async def incr(self, *args, **kwargs):
         return await self._call_in_thread("incr", *args, **kwargs)
 
+    async def delete(self, *args, **kwargs):
+        return await self._call_in_thread("delete", *args, **kwargs)
 
-class AsyncMultipartMemcache(AsyncMemcache):
-    """subclass of AsyncMemcache that splits large files into multiple chunks
+    async def get_multi(self, *args, **kwargs):
+        return await self._call_in_thread("get_multi", *args, **kwargs)
 
-    because memcached limits record size to 1MB
+    async def set_multi(self, *args, **kwargs):
+        return await self._call_in_thread("set_multi", *args, **kwargs)
+
+
+class MultipartMixin(object):
+    """Mixin for memcache clients that splits large values into multiple chunks
+
+    because memcached limits record size to 1MB.
+
+    Each value is stored as a small manifest under its own key,
+    recording a version id, the codec, and the checksum and keys of its chunks.
+    Chunks are content-addressed (keyed by their sha1),
+    so identical chunks are shared between entries and versions,
+    and a reader can never stitch together chunks from different versions.
+    Chunks are written before the manifest that references them,
+    and reads are all-or-nothing: a missing chunk or bad checksum is a miss.
+
+    Values are compressed with a pluggable codec (zlib by default).
+    Values larger than `offload_threshold` are compressed and decompressed
+    in `codec_pool`, so large notebooks don't block the event loop.
+
+    The client class must provide async get_multi and set_multi.
     """
 
     def __init__(self, *args, **kwargs):
         self.chunk_size = kwargs.pop("chunk_size", 950000)
         self.max_chunks = kwargs.pop("max_chunks", 16)
+        self.codec = kwargs.pop("codec", None) or ZlibCodec()
+        self.codec_pool = kwargs.pop("codec_pool", None) or ThreadPoolExecutor(2)
+        self.offload_threshold = kwargs.pop("offload_threshold", 64 * 1024)
         super().__init__(*args, **kwargs)
+        self.chunk_stats = dict.fromkeys(
+            (
+                "values_written",
+                "chunks_written",
+                "compressed_bytes_written",
+                "chunks_read",
+                "missing_chunks",
+                "corrupt",
+            ),
+            0,
+        )
+
+    async def _run_codec(self, func, data, *args):
+        if len(data) < self.offload_threshold:
+            return func(data, *args)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.codec_pool, func, data, *args
+        )
+
+    def _compress(self, value):
+        """Compress a value and split it into content-addressed chunks
+
+        Returns (manifest, {chunk_key: chunk}).
+        """
+        compressed = self.codec.compress(value)
+        chunk_keys = []
+        chunks = {}
+        for offset in range(0, len(compressed), self.chunk_size):
+            chunk = compressed[offset : offset + self.chunk_size]
+            chunk_key = "chunk:%s" % hashlib.sha1(chunk).hexdigest()
+            chunk_keys.append(chunk_key)
+            chunks[chunk_key.encode("ascii")] = chunk
+        manifest = {
+            "version": uuid.uuid4().hex,
+            "codec": self.codec.name,
+            "size": len(compressed),
+            "checksum": hashlib.sha1(compressed).hexdigest(),
+            "chunks": chunk_keys,
+        }
+        return manifest, chunks
+
+    def _decompress(self, compressed, manifest):
+        if hashlib.sha1(compressed).hexdigest() != manifest["checksum"]:
+            raise ValueError("checksum mismatch for version %s" % manifest["version"])
+        return decompress(compressed, self.codec)
 
     async def get(self, key, *args, **kwargs):
-        keys = [("%s.%i" % (key, idx)).encode() for idx in range(self.max_chunks)]
-        values = await self._call_in_thread("get_multi", keys, *args, **kwargs)
-        parts = []
-        for key in keys:
-            if key not in values:
-                break
-            parts.append(values[key])
-        if parts:
-            compressed = b"".join(parts)
-            try:
-                result = zlib.decompress(compressed)
-            except zlib.error as e:
-                app_log.error("zlib decompression of %s failed: %s", key, e)
-            else:
-                return result
+        manifest_key = key.encode() if isinstance(key, str) else key
+        values = await self.get_multi([manifest_key], *args, **kwargs)
+        if manifest_key not in values:
+            return None
+        try:
+            manifest = json.loads(values[manifest_key])
+            chunk_keys = [key.encode("ascii") for key in manifest["chunks"]]
+        except (ValueError, KeyError, TypeError) as e:
+            app_log.error("Invalid cache manifest for %s: %s", key, e)
+            return None
+
+        chunks = await self.get_multi(sorted(set(chunk_keys)), *args, **kwargs)
+        missing = [chunk_key for chunk_key in chunk_keys if chunk_key not in chunks]
+        self.chunk_stats["chunks_read"] += len(chunks)
+        if missing:
+            self.chunk_stats["missing_chunks"] += len(missing)
+            app_log.info(
+                "%i/%i chunks of %s (version %s) missing",
+                len(missing),
+                len(chunk_keys),
+                key,
+                manifest["version"],
+            )
+            return None
+        compressed = b"".join(chunks[chunk_key] for chunk_key in chunk_keys)
+        try:
+            return await self._run_codec(self._decompress, compressed, manifest)
+        except Exception as e:
+            self.chunk_stats["corrupt"] += 1
+            app_log.error("decompression of %s failed: %s", key, e)
 
     async def set(self, key, value, *args, **kwargs):
-        chunk_size = self.chunk_size
-        compressed = zlib.compress(value)
-        offsets = range(0, len(compressed), chunk_size)
-        app_log.debug("storing %s in %i chunks", key, len(offsets))
-        if len(offsets) > self.max_chunks:
-            raise ValueError("file is too large: %sB" % len(compressed))
-        values = {}
-        for idx, offset in enumerate(offsets):
-            values[("%s.%i" % (key, idx)).encode()] = compressed[
-                offset : offset + chunk_size
-            ]
-        return await self._call_in_thread("set_multi", values, *args, **kwargs)
+        manifest, chunks = await self._run_codec(self._compress, value)
+        app_log.debug(
+            "storing %s version %s in %i chunks",
+            key,
+            manifest["version"],
+            len(manifest["chunks"]),
+        )
+        if len(manifest["chunks"]) > self.max_chunks:
+            raise ValueError("file is too large: %i chunks" % len(manifest["chunks"]))
+        # chunks first, so the manifest never references missing chunks
+        failed = await self.set_multi(chunks, *args, **kwargs)
+        if failed:
+            app_log.error("Failed to store %i chunks of %s", len(failed), key)
+            return False
+        manifest_key = key.encode() if isinstance(key, str) else key
+        failed = await self.set_multi(
+            {manifest_key: json.dumps(manifest).encode("utf8")}, *args, **kwargs
+        )
+        self.chunk_stats["values_written"] += 1
+        self.chunk_stats["chunks_written"] += len(chunks)
+        self.chunk_stats["compressed_bytes_written"] += manifest["size"]
+        return not failed
+
+    def stats(self):
+        return dict(self.chunk_stats, codec=self.codec.name)
+
+
+class AsyncMultipartMemcache(MultipartMixin, AsyncMemcache):
+    """subclass of AsyncMemcache that splits large files into multiple chunks
+
+    because memcached limits record size to 1MB
+    """
+
+
+class AsyncMultipartAioMemcache(MultipartMixin, AioMemcacheClient):
+    """asyncio-native memcache client that splits large files into multiple chunks
+
+    Unlike AsyncMultipartMemcache, no thread pool is involved:
+    requests are pipelined on a pool of connections on the event loop.
+    """
+
+
+# -----------------------------------------------------------------------------
+# Statistics
+# -----------------------------------------------------------------------------
+
+
+def cache_namespace(key):
+    """The namespace of a cache key, e.g. 'page' for 'page:<hash>'"""
+    if isinstance(key, bytes):
+        key = key.decode("utf8", "replace")
+    namespace, sep, rest = key.partition(":")
+    return namespace if sep else "other"
+
+
+class LatencyHistogram(object):
+    """Counts of latencies in fixed buckets (upper bounds, in seconds)"""
+
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def to_dict(self):
+        labels = ["<=%gms" % (1e3 * bound) for bound in self.buckets] + [
+            ">%gms" % (1e3 * self.buckets[-1])
+        ]
+        return {
+            "count": self.count,
+            "mean_ms": 1e3 * self.total / self.count if self.count else 0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class NamespaceStats(object):
+    """Counters for the cache keys in one namespace"""
+
+    counters = (
+        "hits",
+        "misses",
+        "sets",
+        "not_stored",
+        "errors",
+        "bytes_read",
+        "bytes_written",
+    )
+
+    def __init__(self):
+        for name in self.counters:
+            setattr(self, name, 0)
+        self.get_latency = LatencyHistogram()
+        self.set_latency = LatencyHistogram()
+
+    def to_dict(self):
+        d = {name: getattr(self, name) for name in self.counters}
+        lookups = self.hits + self.misses
+        d["hit_ratio"] = self.hits / lookups if lookups else 0
+        d["get_latency"] = self.get_latency.to_dict()
+        d["set_latency"] = self.set_latency.to_dict()
+        return d
+
+
+class CacheStats(object):
+    """Cache statistics, by key namespace (page, upstream, rate-limit, ...)"""
+
+    def __init__(self):
+        self.namespaces = defaultdict(NamespaceStats)
+
+    def record_get(self, key, value, seconds):
+        stats = self.namespaces[cache_namespace(key)]
+        stats.get_latency.observe(seconds)
+        if value is None:
+            stats.misses += 1
+        else:
+            stats.hits += 1
+            stats.bytes_read += _sizeof(value)
+
+    def record_set(self, key, value, stored, seconds):
+        stats = self.namespaces[cache_namespace(key)]
+        stats.set_latency.observe(seconds)
+        if stored is False:
+            stats.not_stored += 1
+        else:
+            stats.sets += 1
+            stats.bytes_written += _sizeof(value)
+
+    def record_error(self, key):
+        self.namespaces[cache_namespace(key)].errors += 1
+
+    def to_dict(self):
+        return {
+            namespace: stats.to_dict()
+            for namespace, stats in sorted(self.namespaces.items())
+        }
+
+    def report(self, statsd, backend_stats=None):
+        """Send the counters as statsd gauges"""
+        for namespace, stats in self.namespaces.items():
+            for name in stats.counters:
+                statsd.gauge("cache.%s.%s" % (namespace, name), getattr(stats, name))
+        for name, value in _flatten(backend_stats or {}, "cache.backend"):
+            statsd.gauge(name, value)
+
+
+def _flatten(d, prefix):
+    """Yield (dotted.name, value) for the numbers in a nested dict"""
+    for key, value in d.items():
+        name = "%s.%s" % (prefix, key)
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def backend_stats(cache):
+    """Statistics a cache backend tracks itself (size, evictions, chunks, ...)"""
+    stats = getattr(cache, "stats", None)
+    if stats is None:
+        return {}
+    return dict(stats(), type=type(cache).__name__)
+
+
+class InstrumentedCache(object):
+    """Wrap a cache backend to record statistics by namespace
+
+    Records hits, misses, sets, errors, bytes and get/set latency in a CacheStats.
+    Errors are recorded and re-raised.
+    """
+
+    def __init__(self, cache, stats=None):
+        self.cache = cache
+        self.cache_stats = stats or CacheStats()
+
+    def __getattr__(self, name):
+        # anything else (e.g. backend attributes) goes to the backend
+        return getattr(self.cache, name)
+
+    async def get(self, key, *args, **kwargs):
+        tic = monotonic()
+        try:
+            value = await self.cache.get(key, *args, **kwargs)
+        except Exception:
+            self.cache_stats.record_error(key)
+            raise
+        self.cache_stats.record_get(key, value, monotonic() - tic)
+        return value
+
+    async def _set(self, method, key, value, *args, **kwargs):
+        tic = monotonic()
+        try:
+            stored = await method(key, value, *args, **kwargs)
+        except Exception:
+            self.cache_stats.record_error(key)
+            raise
+        self.cache_stats.record_set(key, value, stored, monotonic() - tic)
+        return stored
+
+    async def set(self, key, value, *args, **kwargs):
+        return await self._set(self.cache.set, key, value, *args, **kwargs)
+
+    async def add(self, key, value, *args, **kwargs):
+        return await self._set(self.cache.add, key, value, *args, **kwargs)
+
+    async def incr(self, key, *args, **kwargs):
+        return await self.cache.incr(key, *args, **kwargs)
+
+    async def delete(self, key, *args, **kwargs):
+        return await self.cache.delete(key, *args, **kwargs)
+
+    def stats(self):
+        return {
+            "namespaces": self.cache_stats.to_dict(),
+            "backend": backend_stats(self.cache),
+        }
@@ -8,12 +8,16 @@
 # Distributed under the terms of the Modified BSD License.
 import asyncio
 import hashlib
-import pickle
 import time
+from io import BytesIO
 
 from tornado.curl_httpclient import CurlAsyncHTTPClient
 from tornado.httpclient import HTTPRequest
+from tornado.httpclient import HTTPResponse
+from tornado.httputil import HTTPHeaders
 
+from nbviewer.cache import pack_record
+from nbviewer.cache import unpack_record
 from nbviewer.utils import time_block
 
 # -----------------------------------------------------------------------------
@@ -75,7 +79,7 @@ class NBViewerAsyncHTTPClient(object):
 
         # look for a cached response
         cached_response = None
-        cache_key = hashlib.sha256(request.url.encode("utf8")).hexdigest()
+        cache_key = "upstream:" + hashlib.sha256(request.url.encode("utf8")).hexdigest()
         cached_response = await self._get_cached_response(cache_key, name)
         toc = time.time()
         self.log.info("Upstream cache get %s %.2f ms", name, 1e3 * (toc - tic))
@@ -102,10 +106,24 @@ class NBViewerAsyncHTTPClient(object):
         if not self.cache:
             return
         try:
-            cached_pickle = await self.cache.get(cache_key)
-            if cached_pickle:
-                self.log.info("Type of self.cache is: %s", type(self.cache))
-                return pickle.loads(cached_pickle)
+            cache_data = await self.cache.get(cache_key)
+            if cache_data:
+                record = unpack_record(cache_data)
+                if record is None:
+                    # e.g. pickled by an older nbviewer, not worth trusting
+                    return None
+                header, body = record
+                headers = HTTPHeaders()
+                for key, value in header["headers"]:
+                    headers.add(key, value)
+                return HTTPResponse(
+                    HTTPRequest(header["url"]),
+                    header["code"],
+                    headers=headers,
+                    buffer=BytesIO(body),
+                    effective_url=header["effective_url"],
+                    reason=header["reason"],
+                )
         except Exception:
             self.log.error("Upstream cache get failed %s", name, exc_info=True)
 
@@ -116,7 +134,14 @@ class NBViewerAsyncHTTPClient(object):
         with time_block("Upstream cache set %s" % name, logger=self.log):
             # cache the response
             try:
-                pickle_response = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
-                await self.cache.set(cache_key, pickle_response)
+                header = {
+                    "url": response.request.url,
+                    "code": response.code,
+                    "reason": response.reason,
+                    "effective_url": response.effective_url,
+                    # list of pairs, to keep repeated headers
+                    "headers": list(response.headers.get_all()),
+                }
+                await self.cache.set(cache_key, pack_record(header, response.body))
             except Exception:
                 self.log.error("Upstream cache failed %s" % name, exc_info=True)
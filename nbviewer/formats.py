@@ -4,6 +4,117 @@
 #  Distributed under the terms of the BSD License.  The full license is in
 #  the file COPYING, distributed as part of this software.
 # -----------------------------------------------------------------------------
+from nbconvert.exporters import ScriptExporter  # type: ignore
+from nbconvert.filters import comment_lines  # type: ignore
+from nbconvert.filters import ipython2python
+
+
+def test_slides(nb, json):
+    """Determines if at least one cell has a non-blank or "-" as its
+    metadata.slideshow.slide_type value.
+
+    Parameters
+    ----------
+    nb: nbformat.notebooknode.NotebookNode
+        Top of the parsed notebook object model
+    json: str
+        JSON source of the notebook, unused
+
+    Returns
+    -------
+    bool
+    """
+    for cell in nb.cells:
+        if (
+            "metadata" in cell
+            and "slideshow" in cell.metadata
+            and cell.metadata.slideshow.get("slide_type", "-") != "-"
+        ):
+            return True
+    return False
+
+
+class CodeExporter(ScriptExporter):
+    """ScriptExporter without the template
+
+    Writes the code of Python notebooks, and of notebooks in languages
+    without a script exporter of their own, as nbconvert's python and script templates do,
+    but straight from the cells, without copying the notebook, preprocessing it
+    and rendering a template. It is cheap enough to run in the event loop (see inline_render).
+
+    Other notebooks, and configured exporters or preprocessors,
+    go through ScriptExporter.
+    """
+
+    # config sections that could change the output
+    config_sections = [
+        "Exporter",
+        "TemplateExporter",
+        "ScriptExporter",
+        "PythonExporter",
+        "CodeExporter",
+        "TagRemovePreprocessor",
+        "RegexRemovePreprocessor",
+    ]
+
+    def configured(self):
+        """Whether the output could be configured, e.g. by preprocessors or templates"""
+        for section in self.config_sections:
+            if section in self.config:
+                # extra_template_basedirs is set by NBViewer.configure_formats,
+                # for other templates, and the preprocessors are enabled by default,
+                # but do nothing unless configured
+                keys = set(self.config[section]) - {
+                    "extra_template_basedirs",
+                    "enabled",
+                }
+                if keys:
+                    return True
+        return False
+
+    def from_notebook_node(self, nb, resources=None, **kw):
+        langinfo = nb.metadata.get("language_info", {})
+        exporter_name = langinfo.get("nbconvert_exporter")
+        python = exporter_name == "python"
+        if (
+            self.configured()
+            or (exporter_name and exporter_name not in {"python", "script"})
+            or (
+                not python
+                and langinfo.get("name")
+                and self._get_language_exporter(langinfo["name"]) is not None
+            )
+        ):
+            return super().from_notebook_node(nb, resources, **kw)
+
+        if python:
+            mimetype = "text/x-python"
+            chunks = ["#!/usr/bin/env python\n# coding: utf-8\n"]
+        else:
+            mimetype = langinfo.get("mimetype", "text/plain")
+            chunks = []
+        for cell in nb.cells:
+            if cell.get("metadata", {}).get("transient", {}).get("remove_source"):
+                continue
+            if cell.cell_type == "code":
+                if python:
+                    count = cell.get("execution_count") or " "
+                    chunks.append("\n# In[%s]:\n\n" % count)
+                    chunks.append("\n%s\n" % ipython2python(cell.source))
+                else:
+                    chunks.append("\n%s\n" % cell.source)
+            elif cell.cell_type == "markdown":
+                if python:
+                    chunks.append("\n%s\n" % comment_lines(cell.source))
+            elif cell.cell_type == "raw":
+                if cell.get("metadata", {}).get("raw_mimetype", "").lower() in {
+                    mimetype,
+                    "",
+                }:
+                    chunks.append(cell.source)
+
+        resources = dict(resources or {}, output_mimetype=mimetype)
+        return "".join(chunks).lstrip("\r\n"), resources
 
 
 def default_formats():
@@ -21,41 +132,36 @@ def default_formats():
     - test:
         a function(notebook_object, notebook_json)
         conditionally offer a format based on content if truthy. see
-        `RenderingHandler.filter_exporters`
+        `RenderingHandler.filter_formats`.
+        It runs in the render pool, so it must be importable with processes > 0.
     - postprocess:
         a function(html, resources)
         perform any modifications to html and resources after nbconvert
     - content_Type:
         a string specifying the Content-Type of the response from this format.
         Defaults to  text/html; charset=UTF-8
+    - cell_cache:
+        if truthy, cells are rendered and cached separately,
+        so that only changed cells are rendered again when a notebook changes.
+        Requires a template that renders cells independently of each other
+        and outputs raw cells as they are (e.g. lab or classic, but not slides).
+    - thread_render:
+        if truthy, the format is cheap to render,
+        so it is always rendered in the thread pool when there is a process pool too
+        (see NBViewer.thread_render_max_bytes).
+    - inline_render:
+        if truthy, the format is so cheap to render (e.g. with CodeExporter)
+        that notebooks up to NBViewer.inline_render_max_bytes are rendered
+        in the event loop, without waiting for the render queue and pool.
     """
 
-    def test_slides(nb, json):
-        """Determines if at least one cell has a non-blank or "-" as its
-        metadata.slideshow.slide_type value.
-
-        Parameters
-        ----------
-        nb: nbformat.notebooknode.NotebookNode
-            Top of the parsed notebook object model
-        json: str
-            JSON source of the notebook, unused
-
-        Returns
-        -------
-        bool
-        """
-        for cell in nb.cells:
-            if (
-                "metadata" in cell
-                and "slideshow" in cell.metadata
-                and cell.metadata.slideshow.get("slide_type", "-") != "-"
-            ):
-                return True
-        return False
-
     return {
-        "html": {"nbconvert_template": "lab", "label": "Notebook", "icon": "book"},
+        "html": {
+            "nbconvert_template": "lab",
+            "label": "Notebook",
+            "icon": "book",
+            "cell_cache": True,
+        },
         "slides": {
             # "nbconvert_template": "slides_reveal",
             "label": "Slides",
@@ -65,6 +171,9 @@ def default_formats():
         "script": {
             "label": "Code",
             "icon": "code",
+            "exporter": CodeExporter,
             "content_type": "text/plain; charset=UTF-8",
+            "inline_render": True,
+            "thread_render": True,
         },
     }
@@ -4,8 +4,11 @@
 #  Distributed under the terms of the BSD License.  The full license is in
 #  the file COPYING, distributed as part of this software.
 # -----------------------------------------------------------------------------
+import json
+
 from tornado import web
 
+from .cache import unpack_record
 from .providers import _load_handler_from_location
 from .providers import provider_handlers
 from .providers import provider_uri_rewrites
@@ -77,6 +80,55 @@ class CreateHandler(BaseHandler):
         return self.uri_rewrite_list
 
 
+class CacheStatsHandler(BaseHandler):
+    """Cache statistics as JSON
+
+    Requires the admin token: `Authorization: token <admin_token>`
+    """
+
+    def get(self):
+        if not self.is_admin:
+            raise web.HTTPError(403)
+        stats = getattr(self.cache, "stats", None)
+        if stats is None:
+            raise web.HTTPError(404, "Cache statistics are not available")
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(json.dumps(stats(), indent=1))
+
+
+class OutputHandler(BaseHandler):
+    """Images extracted from rendered notebooks, by the sha256 of their content
+
+    see NBViewer.output_extract_threshold
+    """
+
+    async def get(self, sha):
+        try:
+            cache_data = await self.cache.get("output:" + sha)
+        except Exception:
+            self.log.error("Exception getting output %s from cache", sha, exc_info=True)
+            cache_data = None
+        if cache_data is None:
+            raise web.HTTPError(404)
+        header, body = unpack_record(cache_data)
+        self.set_header("Content-Type", header["content_type"])
+        # never changes
+        self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.set_header("Etag", '"%s"' % sha)
+        # no scripts in SVGs opened directly
+        self.set_header(
+            "Content-Security-Policy",
+            "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+        )
+        self.set_header("X-Content-Type-Options", "nosniff")
+        if self.check_etag_header():
+            self.set_status(304)
+        else:
+            self.write(bytes(body))
+        self.finish()
+
+
 # -----------------------------------------------------------------------------
 # Default handler URL mapping
 # -----------------------------------------------------------------------------
@@ -128,6 +180,8 @@ def init_handlers(formats, providers, base_url, localfiles, **handler_kwargs):
         ("/index.html", index_handler, {}),
         (r"/faq/?", faq_handler, {}),
         (r"/create/?", create_handler, {}),
+        (r"/_stats/cache", CacheStatsHandler, {}),
+        (r"/_outputs/([0-9a-f]{64})(?:\.\w+)?", OutputHandler, {}),
         # don't let super old browsers request data-uris
         (r".*/data:.*;base64,.*", custom404_handler, {}),
     ]
@@ -7,6 +7,7 @@
 """
 Classes for Indexing Notebooks
 """
+import json
 import uuid
 
 from tornado.log import app_log
@@ -14,6 +15,7 @@ from tornado.log import app_log
 
 class Indexer(object):
     def index_notebook(self, notebook_url, notebook_contents):
+        """Index a notebook, `notebook_contents` is its JSON"""
         raise NotImplementedError("index_notebook not implemented")
 
 
@@ -37,7 +39,7 @@ class ElasticSearch(Indexer):
 
         # Notebooks API Model
         # https://github.com/ipython/ipython/wiki/IPEP-16%3A-Notebook-multi-directory-dashboard-and-URL-mapping#notebooks-api
-        body = {"content": notebook_contents, "public": public}
+        body = {"content": json.loads(notebook_contents), "public": public}
 
         resp = self.elasticsearch.index(
             index="notebooks", doc_type="ipynb", body=body, id=notebook_id.hex
@@ -0,0 +1,366 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+"""asyncio-native memcached client
+
+Speaks the memcached text protocol directly on the event loop:
+
+- a small pool of connections per server
+- requests are pipelined on each connection, replies are matched in order
+- multi-get is batched into one ``get`` command per server
+- authentication uses memcached's ASCII auth (``memcached -Y <authfile>``),
+  since SASL is only available in the binary protocol.
+  Servers that only support SASL (e.g. MemCachier) need pylibmc.
+- values are flagged as pylibmc flags them, so both clients can share a cache
+"""
+import asyncio
+import pickle
+import zlib
+from collections import deque
+
+from tornado.log import app_log
+
+# -----------------------------------------------------------------------------
+# Code
+# -----------------------------------------------------------------------------
+
+DEFAULT_PORT = 11211
+
+# value flags, for values that are not bytes, as used by pylibmc
+FLAG_BYTES = 0
+FLAG_PICKLE = 1
+FLAG_BOOL = 2
+FLAG_INT = 4
+FLAG_ZLIB = 8
+FLAG_STR = 16
+
+
+class MemcacheError(Exception):
+    pass
+
+
+def _encode_key(key):
+    if isinstance(key, str):
+        key = key.encode("utf8")
+    if len(key) > 250 or any(c <= 32 or c == 127 for c in key):
+        raise ValueError("Invalid memcache key: %r" % key)
+    return key
+
+
+def _encode_value(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value), FLAG_BYTES
+    if isinstance(value, bool):
+        return b"1" if value else b"0", FLAG_BOOL
+    if isinstance(value, int):
+        # stored as ascii digits, so that incr works
+        return str(value).encode("ascii"), FLAG_INT
+    if isinstance(value, str):
+        return value.encode("utf8"), FLAG_STR
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL), FLAG_PICKLE
+
+
+def _decode_value(data, flags):
+    if flags & FLAG_ZLIB:
+        # compressed by pylibmc (min_compress_len)
+        data = zlib.decompress(data)
+        flags &= ~FLAG_ZLIB
+    if flags == FLAG_BOOL:
+        return data == b"1"
+    if flags == FLAG_INT:
+        return int(data)
+    if flags == FLAG_STR:
+        return data.decode("utf8")
+    if flags == FLAG_PICKLE:
+        return pickle.loads(data)
+    return data
+
+
+async def _read_line(reader):
+    line = await reader.readuntil(b"\r\n")
+    line = line[:-2]
+    if line == b"ERROR" or line.startswith((b"CLIENT_ERROR", b"SERVER_ERROR")):
+        raise MemcacheError(line.decode("utf8", "replace"))
+    return line
+
+
+async def _read_values(reader):
+    """Read VALUE lines up to END, return {key: (data, flags)}"""
+    values = {}
+    while True:
+        line = await _read_line(reader)
+        if line == b"END":
+            return values
+        parts = line.split()
+        if parts[0] != b"VALUE":
+            raise MemcacheError("Unexpected reply: %r" % line)
+        key, flags, size = parts[1], int(parts[2]), int(parts[3])
+        data = await reader.readexactly(size + 2)
+        values[key] = (data[:-2], flags)
+
+
+async def _read_stored(reader):
+    return (await _read_line(reader)) == b"STORED"
+
+
+async def _read_deleted(reader):
+    return (await _read_line(reader)) == b"DELETED"
+
+
+async def _read_number(reader):
+    line = await _read_line(reader)
+    if line == b"NOT_FOUND":
+        return None
+    return int(line)
+
+
+class _Connection(object):
+    """A single pipelined connection to a memcached server
+
+    Commands are written immediately and their reply parsers queued,
+    so many requests can be in flight on one socket.
+    A single reader task consumes replies in order.
+    """
+
+    def __init__(self, host, port, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.reader = self.writer = None
+        self.closed = False
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+        self._connecting = None
+        self._read_task = None
+
+    @property
+    def depth(self):
+        """Number of requests awaiting a reply"""
+        return len(self._pending)
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self._read_task = asyncio.ensure_future(self._read_loop())
+        if self.username:
+            # ASCII auth: a set command whose data is "username password"
+            credentials = ("%s %s" % (self.username, self.password)).encode("utf8")
+            stored = await self._send(
+                b"set auth 0 0 %i\r\n%s\r\n" % (len(credentials), credentials),
+                _read_stored,
+            )
+            if not stored:
+                raise MemcacheError("memcache authentication failed")
+
+    def _send(self, command, parser):
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((future, parser))
+        self._wakeup.set()
+        self.writer.write(command)
+        return future
+
+    async def request(self, command, parser):
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        try:
+            await self._connecting
+        except Exception as e:
+            self.close(e)
+            raise MemcacheError(
+                "Could not connect to memcache %s:%i: %s" % (self.host, self.port, e)
+            )
+        if self.closed:
+            raise MemcacheError(
+                "memcache connection %s:%i closed" % (self.host, self.port)
+            )
+        future = self._send(command, parser)
+        await self.writer.drain()
+        return await future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                while not self._pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                future, parser = self._pending[0]
+                try:
+                    result = await parser(self.reader)
+                except MemcacheError as e:
+                    # error replies don't break the stream
+                    result = e
+                self._pending.popleft()
+                if future.done():
+                    # the caller gave up (e.g. timeout), but the reply is consumed
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.close(e)
+
+    def close(self, exc=None):
+        if self.closed:
+            return
+        self.closed = True
+        if exc is not None:
+            app_log.warning(
+                "memcache connection %s:%i lost: %s", self.host, self.port, exc
+            )
+        while self._pending:
+            future, parser = self._pending.popleft()
+            if not future.done():
+                future.set_exception(
+                    MemcacheError("memcache connection lost: %s" % exc)
+                )
+        if self.writer is not None:
+            self.writer.close()
+        if (
+            self._read_task is not None
+            and self._read_task is not asyncio.current_task()
+        ):
+            self._read_task.cancel()
+
+
+class _Server(object):
+    """A pool of connections to one memcached server"""
+
+    def __init__(self, address, pool_size=2, username=None, password=None):
+        host, _, port = address.partition(":")
+        self.host = host
+        self.port = int(port or DEFAULT_PORT)
+        self.pool_size = pool_size
+        self.username = username
+        self.password = password
+        self.connections = []
+
+    def connection(self):
+        """Pick the least busy open connection, opening new ones up to pool_size"""
+        self.connections = [c for c in self.connections if not c.closed]
+        idle = [c for c in self.connections if not c.depth]
+        if idle:
+            return idle[0]
+        if len(self.connections) < self.pool_size:
+            conn = _Connection(self.host, self.port, self.username, self.password)
+            self.connections.append(conn)
+            return conn
+        return min(self.connections, key=lambda c: c.depth)
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+
+class AioMemcacheClient(object):
+    """asyncio memcached client
+
+    API mirrors the subset of pylibmc.Client used by nbviewer:
+    get, get_multi, set, set_multi, add, incr, delete.
+
+    Keys are distributed across servers by crc32 modulo the number of servers.
+    """
+
+    def __init__(self, servers, pool_size=2, username=None, password=None, timeout=10):
+        if isinstance(servers, str):
+            servers = servers.split(",")
+        self.servers = [
+            _Server(s.strip(), pool_size, username, password) for s in servers
+        ]
+        self.timeout = timeout
+
+    def _server_for(self, key):
+        if len(self.servers) == 1:
+            return self.servers[0]
+        return self.servers[zlib.crc32(key) % len(self.servers)]
+
+    async def _request(self, server, command, parser):
+        conn = server.connection()
+        future = conn.request(command, parser)
+        if self.timeout:
+            return await asyncio.wait_for(future, self.timeout)
+        return await future
+
+    async def get(self, key):
+        key = _encode_key(key)
+        values = await self._request(
+            self._server_for(key), b"get %s\r\n" % key, _read_values
+        )
+        if key in values:
+            return _decode_value(*values[key])
+
+    async def get_multi(self, keys):
+        """Get many keys, with one pipelined get command per server
+
+        Returns a dict of the keys that were found (as bytes).
+        """
+        by_server = {}
+        for key in keys:
+            key = _encode_key(key)
+            by_server.setdefault(self._server_for(key), []).append(key)
+        replies = await asyncio.gather(
+            *(
+                self._request(server, b"get %s\r\n" % b" ".join(keys), _read_values)
+                for server, keys in by_server.items()
+            )
+        )
+        result = {}
+        for values in replies:
+            for key, (data, flags) in values.items():
+                result[key] = _decode_value(data, flags)
+        return result
+
+    def _storage_command(self, cmd, key, value, expires):
+        data, flags = _encode_value(value)
+        return b"%s %s %i %i %i\r\n%s\r\n" % (
+            cmd,
+            key,
+            flags,
+            int(expires),
+            len(data),
+            data,
+        )
+
+    async def _store(self, cmd, key, value, expires=0):
+        key = _encode_key(key)
+        command = self._storage_command(cmd, key, value, expires)
+        return await self._request(self._server_for(key), command, _read_stored)
+
+    async def set(self, key, value, expires=0):
+        return await self._store(b"set", key, value, expires)
+
+    async def add(self, key, value, expires=0):
+        return await self._store(b"add", key, value, expires)
+
+    async def set_multi(self, mapping, expires=0):
+        """Set many keys, pipelined
+
+        Returns the list of keys that failed to store, like pylibmc.
+        """
+        keys = list(mapping)
+        results = await asyncio.gather(
+            *(self._store(b"set", key, mapping[key], expires) for key in keys)
+        )
+        return [key for key, stored in zip(keys, results) if not stored]
+
+    async def incr(self, key, delta=1):
+        key = _encode_key(key)
+        return await self._request(
+            self._server_for(key), b"incr %s %i\r\n" % (key, delta), _read_number
+        )
+
+    async def delete(self, key):
+        key = _encode_key(key)
+        return await self._request(
+            self._server_for(key), b"delete %s\r\n" % key, _read_deleted
+        )
+
+    def close(self):
+        for server in self.servers:
+            server.close()
@@ -0,0 +1,409 @@
+"""Process pool for rendering, with hard limits on each render"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import glob
+import itertools
+import mmap
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import Executor
+from concurrent.futures import Future
+
+from tornado.log import app_log
+
+from .utils import EmptyClass
+
+
+class RenderKilled(Exception):
+    """A render's worker was killed, or died, before returning a result
+
+    `reason` is 'timeout', 'memory' or 'died'
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class RemoteTraceback(Exception):
+    """Traceback of an exception raised in a worker, attached as its cause"""
+
+    def __init__(self, tb):
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def rss(pid):
+    """Resident memory of a process in bytes, or None if it can't be read"""
+    try:
+        with open("/proc/%i/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# large payloads are passed through files here, rather than pickled through pipes
+shared_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_task_ids = itertools.count()
+
+
+class SharedPayload(object):
+    """Handle to a str or bytes in a file in shared_dir, sent through a pipe in its place"""
+
+    def __init__(self, path, text):
+        self.path = path
+        self.text = text
+
+    @classmethod
+    def put(cls, path, value):
+        text = isinstance(value, str)
+        with open(path, "wb") as f:
+            f.write(value.encode("utf8", "surrogatepass") if text else value)
+        return cls(path, text)
+
+    def get(self):
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if self.text:
+                    return str(m, "utf8", "surrogatepass")
+                return bytes(m)
+
+
+def share(values, prefix, threshold, statsd=None):
+    """Replace large str and bytes in `values` with SharedPayloads
+
+    The files are named `prefix` + index.
+    Values that can't be written (e.g. /dev/shm is full, as it often is in containers)
+    are left as they are, to be pickled through the pipe.
+    """
+    shared = []
+    for i, value in enumerate(values):
+        if isinstance(value, (str, bytes)) and len(value) >= threshold:
+            path = prefix + str(i)
+            try:
+                value = SharedPayload.put(path, value)
+            except OSError as e:
+                app_log.warning(
+                    "Passing %i B render payload through pipe: %s", len(value), e
+                )
+                (statsd or EmptyClass()).incr("rendering.pool.share_failed", 1)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        shared.append(value)
+    return shared
+
+
+def unshare(values):
+    return [
+        value.get() if isinstance(value, SharedPayload) else value for value in values
+    ]
+
+
+def _share_result(result, prefix, threshold):
+    """Share a str or bytes result, or the str and bytes in a tuple result"""
+    if isinstance(result, tuple):
+        return tuple(share(result, prefix, threshold))
+    return share([result], prefix, threshold)[0]
+
+
+def _unshare_result(result):
+    if isinstance(result, tuple):
+        return tuple(unshare(result))
+    return unshare([result])[0]
+
+
+def _worker(conn, initializer, initargs):
+    """Run tasks received on `conn` until it receives None or is closed
+
+    Sends "ready" first, once `initializer` has run.
+    """
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception:
+            app_log.error("Render worker initializer failed", exc_info=True)
+    conn.send("ready")
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if task is None:
+            return
+        fn, args, kwargs, prefix, threshold = task
+        try:
+            result = fn(*unshare(args), **kwargs)
+            if threshold:
+                result = _share_result(result, prefix, threshold)
+            reply = ("result", result, None)
+        except BaseException as e:
+            reply = ("error", e, traceback.format_exc())
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # e.g. unpicklable result or exception
+            conn.send(("error", RuntimeError(repr(e)), traceback.format_exc()))
+
+
+class SupervisedProcessPool(Executor):
+    """Process pool where each render has a wall-clock and a memory limit
+
+    Each worker process is supervised by a thread, which sends it one task at a time.
+    A worker running a task for longer than `timeout` seconds,
+    or using more than `max_rss` bytes of resident memory, is killed and replaced,
+    and the task's future fails with RenderKilled.
+    So does the future of a task whose worker crashed.
+    0 disables either limit.
+
+    Memory is checked every `check_interval` seconds (only on Linux).
+
+    Arguments and results (or items of tuple results) that are str or bytes
+    of at least `share_threshold` bytes are passed through files in shared memory
+    (/dev/shm, where available), instead of being pickled through the worker's pipe.
+    The files of a task are removed when it is done, whatever the outcome.
+    Payloads that can't be written there (e.g. shared memory is full) go through the pipe.
+    0 disables sharing.
+
+    Workers are started with the pool, and run `initializer(*initargs)`
+    (e.g. render.warm_up) before their first task. `ready` is set once they all have.
+    A worker that isn't initialized within `start_timeout` seconds is killed,
+    as if it had died while starting.
+    A worker is replaced by a new one, started and initialized right away,
+    when it is killed or after `max_tasks` tasks (0 for no limit).
+
+    Workers are started from supervisor threads at any time, so they are not forked
+    from this process, whose other threads may hold locks (e.g. logging's),
+    but from a forkserver (or spawned, where there is none; see `start_method`).
+    Tasks and the initializer must be importable functions.
+    """
+
+    def __init__(
+        self,
+        max_workers,
+        timeout=0,
+        max_rss=0,
+        check_interval=0.5,
+        share_threshold=2**16,
+        initializer=None,
+        initargs=(),
+        max_tasks=0,
+        start_timeout=60,
+        start_method=None,
+        statsd=None,
+        log=None,
+    ):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.check_interval = check_interval
+        self.share_threshold = share_threshold
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_tasks = max_tasks
+        self.start_timeout = start_timeout
+        self.ready = threading.Event()
+        self._starting = max_workers
+        self.statsd = statsd or EmptyClass()
+        self.log = log or app_log
+        if start_method is None:
+            start_method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+        self._context = multiprocessing.get_context(start_method)
+        self._tasks = queue.SimpleQueue()
+        self._shutdown = False
+        self._shutdown_lock = threading.Lock()
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(
+                target=self._supervise, name="render-supervisor-%i" % i, daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new renders after shutdown")
+            future = Future()
+            self._tasks.put((future, fn, args, kwargs))
+            return future
+
+    def wait_ready(self, timeout=None):
+        """Wait for all workers to be initialized, return whether they are"""
+        return self.ready.wait(timeout)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._shutdown_lock:
+            self._shutdown = True
+            if cancel_futures:
+                while True:
+                    try:
+                        task = self._tasks.get_nowait()
+                    except queue.Empty:
+                        break
+                    task[0].cancel()
+            for thread in self._threads:
+                self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _start_worker(self):
+        """Start a worker and wait for it to be initialized
+
+        Returns (None, None) if it died, or timed out, while initializing.
+        """
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker,
+            args=(child_conn, self.initializer, self.initargs),
+            name="nbviewer-render",
+            daemon=True,
+        )
+        tic = time.monotonic()
+        process.start()
+        child_conn.close()
+        try:
+            ready = conn.poll(self.start_timeout or None) and conn.recv()
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            self.log.error("Render worker %i died or hung while starting", process.pid)
+            self.statsd.incr("rendering.pool.killed.died", 1)
+            self._kill(process, conn)
+            return None, None
+        self.statsd.timing("rendering.pool.start", 1000 * (time.monotonic() - tic))
+        return process, conn
+
+    def _stop_worker(self, process, conn):
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(self.check_interval)
+        if process.is_alive():
+            self._kill(process, conn)
+        else:
+            conn.close()
+
+    def _kill(self, process, conn):
+        process.kill()
+        process.join()
+        conn.close()
+
+    def _supervise(self):
+        process, conn = self._start_worker()
+        with self._shutdown_lock:
+            self._starting -= 1
+            if not self._starting:
+                self.ready.set()
+        tasks = 0
+        while True:
+            if process is not None and self.max_tasks and tasks >= self.max_tasks:
+                self.log.info("Recycling render worker %i", process.pid)
+                self.statsd.incr("rendering.pool.recycled", 1)
+                self._stop_worker(process, conn)
+                process = None
+            if process is None:
+                process, conn = self._start_worker()
+                tasks = 0
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            if process is None:
+                process, conn = self._start_worker()
+                if process is None:
+                    future.set_exception(
+                        RenderKilled("died", "Render worker died while starting")
+                    )
+                    continue
+            tasks += 1
+            prefix = os.path.join(
+                shared_dir, "nbviewer-%i-%i-" % (os.getpid(), next(_task_ids))
+            )
+            try:
+                status, value, tb = self._run(process, conn, task, prefix)
+            except RenderKilled as e:
+                self.log.error("Render worker %i: %s", process.pid, e)
+                self.statsd.incr("rendering.pool.killed.%s" % e.reason, 1)
+                process = conn = None
+                future.set_exception(e)
+                continue
+            except Exception as e:
+                # e.g. an unpicklable task, or a reply that can't be unpickled
+                future.set_exception(e)
+                continue
+            if status == "result":
+                future.set_result(value)
+            else:
+                value.__cause__ = RemoteTraceback(tb)
+                future.set_exception(value)
+
+        if process is not None:
+            self._stop_worker(process, conn)
+
+    def _run(self, process, conn, task, prefix):
+        """Run a task in a worker, sharing large arguments and results"""
+        future, fn, args, kwargs = task
+        try:
+            if self.share_threshold:
+                args = share(args, prefix + "in-", self.share_threshold, self.statsd)
+            conn.send((fn, args, kwargs, prefix + "out-", self.share_threshold))
+            try:
+                status, value, tb = self._wait(process, conn)
+            except RenderKilled:
+                # before removing its files, which it may still be writing
+                self._kill(process, conn)
+                raise
+            if status == "result":
+                value = _unshare_result(value)
+            return status, value, tb
+        finally:
+            # including files left by a worker that died
+            for path in glob.glob(glob.escape(prefix) + "*"):
+                os.remove(path)
+
+    def _wait(self, process, conn):
+        """Wait for the worker's reply, enforcing the limits"""
+        start = time.monotonic()
+        while True:
+            interval = self.check_interval
+            if self.timeout:
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    raise RenderKilled(
+                        "timeout", "Render took longer than %ss" % self.timeout
+                    )
+                interval = min(interval, remaining)
+            try:
+                if conn.poll(interval):
+                    return conn.recv()
+            except (EOFError, OSError):
+                process.join(self.check_interval)
+                raise RenderKilled(
+                    "died", "Render worker died (exit code %s)" % process.exitcode
+                )
+            if self.max_rss:
+                used = rss(process.pid)
+                if used is not None and used > self.max_rss:
+                    raise RenderKilled(
+                        "memory",
+                        "Render used more than %i MB of memory"
+                        % (self.max_rss // 2**20),
+                    )
@@ -6,35 +6,50 @@
 # -----------------------------------------------------------------------------
 import asyncio
 import hashlib
-import pickle
+import hmac
+import json
 import time
+import uuid
 from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
 from functools import wraps
 from html import escape
 from http.client import responses
 from urllib.parse import quote
+from urllib.parse import parse_qsl
 from urllib.parse import urlencode
 from urllib.parse import urlparse
 from urllib.parse import urlunparse
 
+import nbconvert  # type: ignore
 import statsd  # type: ignore
-from nbformat import current_nbformat  # type:ignore
-from nbformat import reads
+from nbformat import from_dict  # type:ignore
 from tornado import httpclient
 from tornado import web
 from tornado.concurrent import Future
 from tornado.escape import url_escape
 from tornado.escape import url_unescape
 from tornado.escape import utf8
+from tornado.httputil import url_concat
 from tornado.ioloop import IOLoop
 
+from ..cache import pack_record
+from ..cache import unpack_record
+from ..pool import RenderKilled
 from ..render import NbFormatError
 from ..render import render_notebook
+from ..render import render_notebook_cells
+from ..render import summarize_notebook
+from ..scheduler import count_cells
+from ..scheduler import render_cost
+from ..utils import compress_content
 from ..utils import EmptyClass
+from ..utils import negotiate_encoding
 from ..utils import parse_header_links
 from ..utils import time_block
 from ..utils import url_path_join
+from ..warmer import refresh_header
 
 try:
     import pycurl
@@ -48,6 +63,9 @@ except ModuleNotFoundError:
 
 format_prefix = "/format/"
 
+# where the notebook goes in a page that is streamed, see finish_notebook
+stream_marker = "<!-- nbviewer-stream-%s -->" % uuid.uuid4().hex
+
 
 class BaseHandler(web.RequestHandler):
     """Base Handler class with common utilities"""
@@ -143,6 +161,10 @@ class BaseHandler(web.RequestHandler):
     def cache(self):
         return self.settings["cache"]
 
+    @property
+    def cache_content_encodings(self):
+        return self.settings.setdefault("cache_content_encodings", [])
+
     @property
     def cache_expiry_max(self):
         return self.settings.setdefault("cache_expiry_max", 120)
@@ -151,6 +173,14 @@ class BaseHandler(web.RequestHandler):
     def cache_expiry_min(self):
         return self.settings.setdefault("cache_expiry_min", 60)
 
+    @property
+    def cache_stale_if_error(self):
+        return self.settings.setdefault("cache_stale_if_error", 0)
+
+    @property
+    def cache_stale_while_revalidate(self):
+        return self.settings.setdefault("cache_stale_while_revalidate", 0)
+
     @property
     def client(self):
         return self.settings["client"]
@@ -195,6 +225,13 @@ class BaseHandler(web.RequestHandler):
     def index(self):
         return self.settings["index"]
 
+    @property
+    def is_admin(self):
+        """Whether the request has the admin token: `Authorization: token <admin_token>`"""
+        token = self.settings.get("admin_token")
+        auth = self.request.headers.get("Authorization", "")
+        return bool(token) and hmac.compare_digest(auth, "token " + token)
+
     @property
     def ipywidgets_base_url(self):
         return self.settings["ipywidgets_base_url"]
@@ -235,6 +272,23 @@ class BaseHandler(web.RequestHandler):
     def rate_limiter(self):
         return self.settings["rate_limiter"]
 
+    @property
+    def refresh_within(self):
+        """Seconds before expiry within which a cached page is refreshed
+
+        Set by the cache warmer (see warmer.CacheWarmer), 0 for other requests.
+        """
+        if not self.is_admin:
+            return 0
+        try:
+            return max(0, float(self.request.headers.get(refresh_header, 0)))
+        except ValueError:
+            return 0
+
+    @property
+    def single_flight(self):
+        return self.settings["single_flight"]
+
     @property
     def static_url_prefix(self):
         return self.settings["static_url_prefix"]
@@ -360,6 +414,13 @@ class BaseHandler(web.RequestHandler):
         elif exc.code >= 500:
             # 5XX, server error, but not this server
             code = 502
+        elif exc.code == 429 or (
+            exc.code == 403
+            and exc.response is not None
+            and exc.response.headers.get("X-RateLimit-Remaining") == "0"
+        ):
+            # upstream rate limit, not the client's fault
+            code = 503
         else:
             # client-side error, blame our client
             if exc.code == 404:
@@ -415,6 +476,16 @@ class BaseHandler(web.RequestHandler):
             response = await self.client.fetch(url, **kw)
         return response
 
+    async def head(self, *args, **kwargs):
+        """HEAD requests for cached pages are handled by GET
+
+        The cached decorator answers them from the cached page's header,
+        and with 405 when the page isn't cached, rather than rendering it.
+        """
+        if not getattr(self.get, "cached", False):
+            raise web.HTTPError(405)
+        await self.get(*args, **kwargs)
+
     def write_error(self, status_code: int, **kwargs):
         """render custom error pages"""
         exc_info = kwargs.get("exc_info")
@@ -466,27 +537,37 @@ class BaseHandler(web.RequestHandler):
     _cache_key = None
     _cache_key_attr = "uri"
 
+    # stale page to serve if rendering fails, set by the cached decorator
+    stale_fallback = None
+
     @property
     def cache_key(self):
         """Use checksum for cache key because cache has size limit on keys"""
 
         if self._cache_key is None:
             to_hash = utf8(getattr(self.request, self._cache_key_attr))
-            self._cache_key = hashlib.sha1(to_hash).hexdigest()
+            self._cache_key = "page:" + hashlib.sha1(to_hash).hexdigest()
         return self._cache_key
 
+    @property
+    def meta_cache_key(self):
+        """Key of the cached page's header, without the body"""
+        return "page-meta:" + self.cache_key.split(":", 1)[1]
+
     def truncate(self, s, limit=256):
         """Truncate long strings"""
         if len(s) > limit:
             s = "{}...{}".format(s[: limit // 2], s[limit // 2 :])
         return s
 
-    async def cache_and_finish(self, content=""):
+    async def cache_and_finish(self, content="", streamed=False):
         """finish a request and cache the result
 
         currently only works if:
 
-        - result is not written in multiple chunks
+        - result is not written in multiple chunks,
+          unless it has already been written and flushed (`streamed`),
+          in which case content is the whole page, to be cached
         - custom headers are not used
         """
         request_time = self.request.request_time()
@@ -501,34 +582,269 @@ class BaseHandler(web.RequestHandler):
             # if it's a link from the front page, cache for a long time
             expiry = self.cache_expiry_max
 
-        if expiry > 0:
+        if expiry > 0 and not streamed:
             self.set_header("Cache-Control", "max-age=%i" % expiry)
 
-        self.write(content)
-        self.finish()
+        body = utf8(content)
+        if streamed:
+            self.finish()
+        encodings = await self.compress_page(body)
+        # strong validator for the page, compressed variants get their own
+        # (see set_cached_headers)
+        etag = hashlib.sha1(body).hexdigest()
+        if not streamed:
+            # serve the page the same way as a cache hit
+            self.write_cached(
+                {
+                    "headers": self.cache_headers,
+                    "etag": etag,
+                    "body": body,
+                    "encodings": encodings,
+                }
+            )
+            self.finish()
 
         short_url = self.truncate(self.request.path)
-        cache_data = pickle.dumps(
-            {"headers": self.cache_headers, "body": content}, pickle.HIGHEST_PROTOCOL
-        )
+        # expiry is when the page becomes stale,
+        # it is kept in the cache for as long as a stale copy may be served
+        expires = time.time() + expiry
+        header = {
+            "headers": self.cache_headers,
+            "expires": expires,
+            "etag": etag,
+            "length": len(body),
+        }
+        if encodings:
+            # the record body is the page followed by each compressed variant
+            header["encodings"] = {"identity": len(body)}
+            for name, data in encodings.items():
+                header["encodings"][name] = len(data)
+            body = b"".join([body] + list(encodings.values()))
+        cache_data = pack_record(header, body)
+        stale_expiry = max(self.cache_stale_while_revalidate, self.cache_stale_if_error)
         log = self.log.info if expiry > self.cache_expiry_min else self.log.debug
-        log("Caching (expiry=%is) %s", expiry, short_url)
+        log("Caching (expiry=%is, stale=%is) %s", expiry, stale_expiry, short_url)
         try:
             with time_block("Cache set %s" % short_url, logger=self.log):
                 await self.cache.set(
-                    self.cache_key, cache_data, int(time.time() + expiry)
+                    self.cache_key, cache_data, int(expires + stale_expiry)
+                )
+                # the header alone, for conditional and HEAD requests
+                await self.cache.set(
+                    self.meta_cache_key,
+                    pack_record(header, b""),
+                    int(expires + stale_expiry),
                 )
         except Exception:
             self.log.error("Cache set for %s failed", short_url, exc_info=True)
         else:
             self.log.debug("Cache set finished %s", short_url)
 
+    async def compress_page(self, body):
+        """Compress a page with each of cache_content_encodings
+
+        Compression runs once per render, in worker threads,
+        so cache hits can be sent without compressing them again.
+        Returns a dict of encoding: compressed body,
+        empty if the page is too small or not compressible.
+        """
+        ctype = self._headers.get("Content-Type", "").split(";")[0]
+        if (
+            not self.cache_content_encodings
+            or len(body) < web.GZipContentEncoding.MIN_LENGTH
+            or not (
+                ctype.startswith("text/")
+                or ctype in web.GZipContentEncoding.CONTENT_TYPES
+            )
+        ):
+            return {}
+        loop = IOLoop.current()
+        short_url = self.truncate(self.request.path)
+        try:
+            with time_block("Compressing %s" % short_url, logger=self.log):
+                compressed = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(None, compress_content, body, name)
+                        for name in self.cache_content_encodings
+                    )
+                )
+        except Exception:
+            self.log.error("Compressing %s failed", short_url, exc_info=True)
+            return {}
+        return {
+            name: data
+            for name, data in zip(self.cache_content_encodings, compressed)
+            if len(data) < len(body)
+        }
+
+    async def get_cached(self, shared=False):
+        """Get the cached page for this request, or None
+
+        With `shared`, skip the in-process copy of a layered cache,
+        to see pages cached by other processes.
+        """
+        short_url = self.truncate(self.request.path)
+        get = self.cache.get
+        if shared:
+            get = getattr(self.cache, "refresh", get)
+        try:
+            with time_block("Cache get %s" % short_url, logger=self.log):
+                cache_data = await get(self.cache_key)
+            if cache_data is not None:
+                record = unpack_record(cache_data)
+                if record is None:
+                    # e.g. pickled by an older nbviewer, not worth trusting
+                    return None
+                header, body = record
+                cached = dict(header, body=body)
+                if "encodings" in header:
+                    # split the page from its precompressed variants
+                    variants = {}
+                    start = 0
+                    for name, length in header["encodings"].items():
+                        variants[name] = body[start : start + length]
+                        start += length
+                    cached["body"] = variants.pop("identity")
+                    cached["encodings"] = variants
+                return cached
+        except Exception:
+            self.log.error("Exception getting %s from cache", short_url, exc_info=True)
+        return None
+
+    async def get_fresh_cached(self, shared=False, within=0):
+        """Get the cached page for this request if it doesn't expire within `within` seconds, or None"""
+        cached = await self.get_cached(shared)
+        if (
+            cached is not None
+            and cached.get("expires", float("inf")) > time.time() + within
+        ):
+            return cached
+        return None
+
+    async def get_cached_meta(self):
+        """Get the header of the cached page for this request if it is fresh, or None
+
+        For answering conditional and HEAD requests without loading the page.
+        """
+        try:
+            cache_data = await self.cache.get(self.meta_cache_key)
+            if cache_data is not None:
+                header, body = unpack_record(cache_data)
+                if header["expires"] > time.time():
+                    return header
+        except Exception:
+            self.log.error(
+                "Exception getting %s from cache",
+                self.truncate(self.request.path),
+                exc_info=True,
+            )
+        return None
+
+    def cached_encoding(self, cached):
+        """The content encoding to send a cached page in, or None for the page itself"""
+        encodings = [
+            name for name in cached.get("encodings") or [] if name != "identity"
+        ]
+        return negotiate_encoding(
+            self.request.headers.get("Accept-Encoding", ""), encodings
+        )
+
+    def set_cached_headers(self, cached, encoding):
+        """Set the headers for a page from the cache, sent with `encoding`"""
+        for key, value in cached["headers"].items():
+            self.set_header(key, value)
+        if "expires" in cached and cached["expires"] > time.time():
+            self.set_header(
+                "Cache-Control", "max-age=%i" % (cached["expires"] - time.time())
+            )
+        # the gzip transform sets Vary itself
+        if cached.get("encodings") and not (
+            self.settings.get("gzip") or self.settings.get("compress_response")
+        ):
+            self.set_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            # Content-Encoding also stops the gzip transform from recompressing
+            self.set_header("Content-Encoding", encoding)
+        if "etag" in cached:
+            # each encoding is a different representation, with its own strong ETag
+            etag = cached["etag"]
+            if encoding is not None:
+                etag = "%s-%s" % (etag, encoding)
+            self.set_header("Etag", '"%s"' % etag)
+
+    def write_cached(self, cached):
+        """Write a page from the cache
+
+        Answers 304 Not Modified if the client has the same version.
+        """
+        encoding = self.cached_encoding(cached)
+        self.set_cached_headers(cached, encoding)
+        if "Etag" in self._headers and self.check_etag_header():
+            # finish() only checks ETags it computes itself
+            self.set_status(304)
+            return
+        if encoding is None:
+            body = cached["body"]
+        else:
+            body = cached["encodings"][encoding]
+        self.write(bytes(body))
+
+    async def finish_from_meta(self):
+        """Answer a conditional or HEAD request from the cached page's header
+
+        Returns whether the request was finished,
+        False if there is no fresh cached page or the client's copy is outdated.
+        """
+        meta = await self.get_cached_meta()
+        if meta is None:
+            return False
+        encoding = self.cached_encoding(meta)
+        self.set_cached_headers(meta, encoding)
+        if self.check_etag_header():
+            self.set_status(304)
+        elif self.request.method == "HEAD":
+            if encoding is None:
+                self.set_header("Content-Length", meta["length"])
+            else:
+                self.set_header("Content-Length", meta["encodings"][encoding])
+        else:
+            # the full response sets its own headers
+            for name in ("Cache-Control", "Content-Encoding", "Etag", "Vary"):
+                self.clear_header(name)
+            return False
+        self.finish()
+        return True
+
+    def finish_stale(self, cached):
+        """Finish with a stale page from the cache
+
+        The rest of the request still runs to refresh the cache,
+        so output methods are short-circuited, as in finish_early.
+        """
+        self.write_cached(cached)
+        self.finish()
+        self.write = self.finish = self.flush = self.redirect = (
+            lambda *args, **kwargs: None
+        )
+
 
 def cached(method):
     """decorator for a cached page.
 
     This only handles getting from the cache, not writing to it.
     Writing to the cache must be handled in the decorated method.
+
+    Cached pages are fresh until their expiry.
+    For cache_stale_while_revalidate seconds after that,
+    the stale page is served immediately
+    and a single request per URL refreshes it in the background.
+    For cache_stale_if_error seconds after expiry,
+    the stale page is served if refreshing it fails
+    because upstream is unavailable or rate-limited.
+
+    Conditional (If-None-Match) and HEAD requests for fresh pages
+    are answered from the cached page's header, without loading the page.
+    HEAD requests for other pages fail with 405, instead of rendering them.
     """
 
     @wraps(method)
@@ -543,6 +859,61 @@ def cached(method):
             await method(self, *args, **kwargs)
             return
 
+        if self.request.method == "HEAD" or "If-None-Match" in self.request.headers:
+            if await self.finish_from_meta():
+                self.log.info("Cache hit (%i) %s", self.get_status(), short_url)
+                return
+            if self.request.method == "HEAD":
+                # not worth a render
+                raise web.HTTPError(405, "HEAD is only answered for cached pages")
+
+        cached = await self.get_cached()
+        if cached is not None:
+            # entries from before soft expiry have no 'expires' and are always fresh
+            stale_age = time.time() - cached.get("expires", float("inf"))
+            refresh_within = self.refresh_within
+            if stale_age <= -refresh_within:
+                self.log.info("Cache hit %s", short_url)
+                self.write_cached(cached)
+                return
+            if stale_age <= self.cache_stale_while_revalidate:
+                if stale_age <= 0:
+                    # the warmer refreshing a page about to expire
+                    self.log.info(
+                        "Cache hit (expiring in %is) %s", -stale_age, short_url
+                    )
+                else:
+                    self.log.info("Cache hit (stale %is) %s", stale_age, short_url)
+                    self.statsd.incr("cache.stale", 1)
+                self.finish_stale(cached)
+                if uri in self.pending:
+                    # already being refreshed
+                    return
+                future = self.pending[uri] = Future()
+                try:
+                    token = await self.single_flight.acquire(self.cache_key)
+                    if token is None:
+                        # being refreshed by another process
+                        return
+                    if (
+                        await self.get_fresh_cached(shared=True, within=refresh_within)
+                        is not None
+                    ):
+                        # just refreshed by another process
+                        await self.single_flight.release(self.cache_key, token)
+                        return
+                    self.log.info("Revalidating %s", short_url)
+                    try:
+                        await method(self, *args, **kwargs)
+                    finally:
+                        await self.single_flight.release(self.cache_key, token)
+                except Exception:
+                    self.log.error("Revalidating %s failed", short_url, exc_info=True)
+                finally:
+                    self.pending.pop(uri, None)
+                    future.set_result(None)
+                return
+
         pending_future = self.pending.get(uri, None)
         loop = IOLoop.current()
         if pending_future:
@@ -553,35 +924,63 @@ def cached(method):
             self.log.info(
                 "Waited %.3fs for concurrent request at %s", toc - tic, short_url
             )
-
+            fresh = await self.get_fresh_cached()
+            if fresh is not None:
+                self.log.info("Cache hit %s", short_url)
+                self.write_cached(fresh)
+                return
+
+        self.log.debug("Cache miss %s", short_url)
+        future = self.pending[uri] = Future()
+        token = None
         try:
-            with time_block("Cache get %s" % short_url, logger=self.log):
-                cached_pickle = await self.cache.get(self.cache_key)
-            if cached_pickle is not None:
-                cached = pickle.loads(cached_pickle)
-            else:
-                cached = None
-        except Exception:
-            self.log.error("Exception getting %s from cache", short_url, exc_info=True)
-            cached = None
-
-        if cached is not None:
-            self.log.info("Cache hit %s", short_url)
-            for key, value in cached["headers"].items():
-                self.set_header(key, value)
-            self.write(cached["body"])
-        else:
-            self.log.debug("Cache miss %s", short_url)
+            token = await self.single_flight.acquire(self.cache_key)
+            if token is None:
+                self.log.info("Waiting for render of %s in another process", short_url)
+                tic = loop.time()
+                fresh, token = await self.single_flight.wait(
+                    self.cache_key, partial(self.get_fresh_cached, shared=True)
+                )
+                self.log.info(
+                    "Waited %.3fs for render in another process at %s",
+                    loop.time() - tic,
+                    short_url,
+                )
+            if token is not None:
+                # rendered by another process since our cache lookup
+                fresh = await self.get_fresh_cached(shared=True)
+            if fresh is not None:
+                self.log.info("Cache hit %s", short_url)
+                self.write_cached(fresh)
+                return
             await self.rate_limiter.check(self)
-            future = self.pending[uri] = Future()
-            try:
-                # call the wrapped method
-                await method(self, *args, **kwargs)
-            finally:
-                self.pending.pop(uri, None)
-                # notify waiters
-                future.set_result(None)
-
+            if (
+                cached is not None
+                and time.time() - cached["expires"] <= self.cache_stale_if_error
+            ):
+                self.stale_fallback = cached
+            # call the wrapped method
+            await method(self, *args, **kwargs)
+        except web.HTTPError as e:
+            if (
+                self.stale_fallback is None
+                or self._finished
+                or not (e.status_code >= 500 or e.status_code == 429)
+            ):
+                raise
+            self.log.warning(
+                "Serving stale %s after error: %s", short_url, e.log_message
+            )
+            self.statsd.incr("cache.stale_if_error", 1)
+            self.write_cached(self.stale_fallback)
+        finally:
+            if token is not None:
+                await self.single_flight.release(self.cache_key, token)
+            self.pending.pop(uri, None)
+            # notify waiters
+            future.set_result(None)
+
+    cached_method.cached = True
     return cached_method
 
 
@@ -596,6 +995,240 @@ class RenderingHandler(BaseHandler):
         """0 render_timeout means never finish early"""
         return self.settings.setdefault("render_timeout", 0)
 
+    @property
+    def stream_renders(self):
+        return self.settings.setdefault("stream_renders", False)
+
+    @property
+    def should_stream(self):
+        """Whether to send the page around the notebook before rendering it
+
+        Not if the response is already finished (e.g. a stale page is being refreshed),
+        or if a stale page would be served in place of a failed render,
+        since the status and headers are sent with the start of the page.
+        """
+        return (
+            self.stream_renders and not self._finished and self.stale_fallback is None
+        )
+
+    def start_stream(self, head):
+        """Send the start of the page, before the notebook is rendered"""
+        if self.render_timeout:
+            # no 'waiting' page needed
+            IOLoop.current().remove_timeout(self.slow_timeout)
+        # the status is sent before rendering, which may still fail,
+        # so browsers and proxies must not cache the response
+        self.set_header("Cache-Control", "no-cache")
+        self.statsd.incr("rendering.streamed", 1)
+        self.write(head)
+        self.flush()
+
+    # whether the notebook being rendered goes to the thread pool, set by finish_notebook
+    render_in_thread = False
+
+    def should_render_in_thread(self, json_notebook, cells):
+        """Whether to render a notebook in the thread pool rather than the process pool
+
+        Cheap formats and small notebooks are (see NBViewer.thread_render_max_bytes).
+        """
+        if self.settings.get("thread_pool") is None:
+            return False
+        if self.formats[self.format].get("thread_render"):
+            return True
+        max_cells = self.settings["thread_render_max_cells"]
+        return len(json_notebook) <= self.settings["thread_render_max_bytes"] and (
+            not max_cells or cells <= max_cells
+        )
+
+    # whether the notebook being rendered is rendered in the event loop, set by finish_notebook
+    render_inline = False
+
+    def should_render_inline(self, json_notebook):
+        """Whether to render a notebook in the event loop, without the render queue and pool
+
+        Only for formats with `inline_render` (see NBViewer.inline_render_max_bytes).
+        """
+        return bool(self.formats[self.format].get("inline_render")) and len(
+            json_notebook
+        ) <= self.settings.setdefault("inline_render_max_bytes", 0)
+
+    async def run_in_render_pool(self, fn, *args):
+        """Run a function from render.py in the render pool, or right away if rendering inline"""
+        if self.render_inline:
+            return fn(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.render_pool, fn, *args)
+
+    @property
+    def render_pool(self):
+        if self.render_in_thread:
+            return self.settings["thread_pool"]
+        return self.pool
+
+    @property
+    def render_scheduler(self):
+        if self.render_in_thread:
+            return self.settings["thread_render_scheduler"]
+        return self.settings["render_scheduler"]
+
+    @property
+    def render_cache_expiry(self):
+        """0 render_cache_expiry means nbconvert output is not cached by content"""
+        return self.settings.setdefault("render_cache_expiry", 0)
+
+    @property
+    def output_extract_threshold(self):
+        """0 output_extract_threshold means images stay inlined in pages"""
+        return self.settings.setdefault("output_extract_threshold", 0)
+
+    @property
+    def outputs_url(self):
+        return self.from_base("/_outputs/")
+
+    @property
+    def render_format(self):
+        """The format passed to render functions"""
+        format = self.formats[self.format]
+        if self.output_extract_threshold:
+            format = dict(
+                format,
+                extract_outputs=self.output_extract_threshold,
+                outputs_url=self.outputs_url,
+            )
+        return format
+
+    async def cache_outputs(self, outputs):
+        """Cache outputs extracted from a rendered notebook, for OutputHandler
+
+        They are kept for as long as a page or cached render may link to them.
+        """
+        if not outputs:
+            return
+        expiry = (
+            self.render_cache_expiry
+            + self.cache_expiry_max
+            + max(self.cache_stale_while_revalidate, self.cache_stale_if_error)
+        )
+        try:
+            await asyncio.gather(
+                *(
+                    self.cache.set(
+                        "output:" + sha,
+                        pack_record({"content_type": mimetype}, data),
+                        expiry,
+                    )
+                    for sha, (mimetype, data) in outputs.items()
+                )
+            )
+        except Exception:
+            self.log.error("Cache set for outputs failed", exc_info=True)
+
+    @property
+    def render_cache_version(self):
+        """Hash of what affects nbconvert output other than the notebook
+
+        i.e. the nbconvert version and configuration (templates, exporter options),
+        and output extraction
+        """
+        if "render_cache_version" not in self.settings:
+            version = nbconvert.__version__
+            version += json.dumps(self.config, sort_keys=True, default=repr)
+            if self.output_extract_threshold:
+                version += "outputs %i %s" % (
+                    self.output_extract_threshold,
+                    self.outputs_url,
+                )
+            self.settings["render_cache_version"] = hashlib.sha1(
+                utf8(version)
+            ).hexdigest()
+        return self.settings["render_cache_version"]
+
+    def render_cache_key(self, json_notebook):
+        """Cache key of the nbconvert output for a notebook in the current format
+
+        Identical notebooks share it, whichever URL they were requested from.
+        """
+        h = hashlib.sha256()
+        h.update(utf8(self.render_cache_version))
+        h.update(utf8(self.format))
+        h.update(utf8(json_notebook))
+        return "render:" + h.hexdigest()
+
+    async def get_cached_render(self, key):
+        """Get cached nbconvert output, or None"""
+        if not self.render_cache_expiry:
+            return None
+        try:
+            cache_data = await self.cache.get(key)
+            if cache_data is not None:
+                header, body = unpack_record(cache_data)
+                return str(body, "utf8")
+        except Exception:
+            self.log.error("Exception getting render %s from cache", key, exc_info=True)
+        return None
+
+    async def cache_render(self, key, nbhtml):
+        """Cache nbconvert output by notebook content"""
+        if not self.render_cache_expiry:
+            return
+        try:
+            await self.cache.set(
+                key,
+                pack_record({"format": self.format}, nbhtml),
+                self.render_cache_expiry,
+            )
+        except Exception:
+            self.log.error("Cache set for render %s failed", key, exc_info=True)
+
+    # render cache key of the notebook being rendered, set by finish_notebook
+    render_key = None
+
+    @property
+    def render_failure_expiry(self):
+        """0 render_failure_expiry means killed renders are not remembered"""
+        return self.settings.setdefault("render_failure_expiry", 0)
+
+    @property
+    def render_failure_key(self):
+        return "render-failed:" + self.render_key.split(":", 1)[1]
+
+    async def check_render_failure(self):
+        """Fail right away if the notebook's last render was killed recently
+
+        so that a runaway notebook doesn't take up a worker on every request.
+        """
+        if not self.render_failure_expiry or self.render_key is None:
+            return
+        try:
+            cache_data = await self.cache.get(self.render_failure_key)
+        except Exception:
+            self.log.error(
+                "Exception getting render failure %s from cache",
+                self.render_failure_key,
+                exc_info=True,
+            )
+            return
+        if cache_data is not None:
+            header, body = unpack_record(cache_data)
+            self.statsd.incr("rendering.nbrender.failure_cache.hit", 1)
+            raise web.HTTPError(503, header["message"])
+
+    async def cache_render_failure(self, message):
+        if not self.render_failure_expiry or self.render_key is None:
+            return
+        try:
+            await self.cache.set(
+                self.render_failure_key,
+                pack_record({"message": message}, b""),
+                self.render_failure_expiry,
+            )
+        except Exception:
+            self.log.error(
+                "Cache set for render failure %s failed",
+                self.render_failure_key,
+                exc_info=True,
+            )
+
     def initialize(self, **kwargs):
         super().initialize(**kwargs)
         loop = IOLoop.current()
@@ -624,15 +1257,13 @@ class RenderingHandler(BaseHandler):
         """Generate a list of formats that can render the given nb json
 
         formats that do not provide a `test` method are assumed to work for
-        any notebook
+        any notebook.
+        Tests are run in the render pool, `nb` is the notebook's summary
+        (see render.summarize_notebook).
         """
         for name, format in self.formats.items():
-            test = format.get("test", None)
-            try:
-                if test is None or test(nb, raw):
-                    yield (name, format)
-            except Exception:
-                self.log.info("Failed to test %s: %s", self.request.uri, name)
+            if name in nb.formats:
+                yield (name, format)
 
     # empty methods to be implemented by subclasses to make GET requests more modular
     def get_notebook_data(self, **kwargs):
@@ -674,56 +1305,120 @@ class RenderingHandler(BaseHandler):
             default_format=self.default_format,
             format_prefix=format_prefix,
             formats=dict(self.filter_formats(nb, json_notebook)),
-            format_base=self.request.uri.replace(self.format_prefix, "").replace(
-                self.base_url, "/"
-            ),
+            format_base=self.format_base,
             date=datetime.utcnow().strftime(self.date_fmt),
             **namespace,
         )
 
-    async def finish_notebook(
-        self, json_notebook, download_url, msg=None, public=False, **namespace
-    ):
-        """Renders a notebook from its JSON body.
+    @property
+    def format_base(self):
+        """The URL of this page in other formats, without the format prefix
 
-        Parameters
-        ----------
-        json_notebook: str
-            Notebook document in JSON format
-        download_url: str
-            URL to download the notebook document
-        msg: str, optional
-            Extra information to log when rendering fails
-        public: bool, optional
-            True if the notebook is public and its access indexed, False if not
+        or flush_cache, so that it isn't in the links of cached pages.
         """
+        query = [
+            (name, value)
+            for name, value in parse_qsl(self.request.query, keep_blank_values=True)
+            if name != "flush_cache"
+        ]
+        return url_concat(
+            self.request.path.replace(self.format_prefix, "").replace(
+                self.base_url, "/"
+            ),
+            query,
+        )
 
-        if msg is None:
-            msg = download_url
+    async def render_nbhtml(self, nb, download_url, msg, json_notebook, parsed=None):
+        """Convert a notebook with nbconvert in the render pool
 
-        try:
-            parse_time = self.statsd.timer("rendering.parsing.time").start()
-            nb = reads(json_notebook, current_nbformat)
-            parse_time.stop()
-        except ValueError:
-            self.log.error("Failed to render %s", msg, exc_info=True)
-            self.statsd.incr("rendering.parsing.fail")
-            raise web.HTTPError(400, "Error reading JSON notebook")
+        `nb` is the notebook's summary, the notebook is parsed from its JSON in the pool,
+        unless it was `parsed` already (when rendering inline).
+
+        Formats with `cell_cache` reuse the HTML of cells that were already rendered
+        (e.g. in a previous version of the notebook), and only render the others.
+        """
+        if self.formats[self.format].get("cell_cache") and self.render_cache_expiry:
+            nbhtml = await self.render_cells(nb, json_notebook, download_url, msg)
+            if nbhtml is not None:
+                return nbhtml
+        self.log.info(
+            "Rendering %d B notebook from %s", len(json_notebook), download_url
+        )
+        nbhtml, config = await self.run_renderer(
+            render_notebook,
+            json_notebook if parsed is None else parsed,
+            download_url,
+            msg,
+        )
+        await self.cache_outputs(config.get("outputs"))
+        return nbhtml
 
+    async def render_cells(self, nb, json_notebook, download_url, msg):
+        """Render a notebook from cached cell fragments, rendering the missing cells
+
+        Fragments depend on the notebook metadata (e.g. language for highlighting),
+        which is hashed into every key, along with the render cache version.
+        Returns None if the cells couldn't be rendered separately.
+        """
+        prefix = hashlib.sha256()
+        prefix.update(utf8(self.render_cache_version))
+        prefix.update(utf8(self.format))
+        prefix.update(utf8(json.dumps(nb.metadata, sort_keys=True)))
+        frame_key = "render-frame:" + prefix.hexdigest()
+        keys = []
+        for cell_hash in nb.cell_hashes:
+            h = prefix.copy()
+            h.update(utf8(cell_hash))
+            keys.append("render-cell:" + h.hexdigest())
+
+        cached = await asyncio.gather(
+            *(self.get_cached_render(key) for key in [frame_key] + keys)
+        )
+        frame = cached[0]
+        fragments = cached[1:]
+        missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+        self.statsd.incr("rendering.cells.hit", len(keys) - len(missing))
+        self.statsd.incr("rendering.cells.miss", len(missing))
+        if frame is not None and not missing:
+            head, foot = json.loads(frame)
+            return "".join([head] + fragments + [foot])
+
+        self.log.info(
+            "Rendering %i/%i cells of notebook from %s",
+            len(missing),
+            len(keys),
+            download_url,
+        )
+        result = await self.run_renderer(
+            render_notebook_cells, json_notebook, download_url, msg, cells=missing
+        )
+        if result is None:
+            self.log.warning(
+                "Failed to render cells of %s separately, rendering the whole notebook",
+                download_url,
+            )
+            return None
+        head, rendered, foot, config = result
+        await self.cache_outputs(config.get("outputs"))
+        for i, fragment in zip(missing, rendered):
+            fragments[i] = fragment
+        await asyncio.gather(
+            self.cache_render(frame_key, json.dumps([head, foot])),
+            *(self.cache_render(keys[i], fragments[i]) for i in missing),
+        )
+        return "".join([head] + fragments + [foot])
+
+    async def run_renderer(self, renderer, nb, download_url, msg, **kwargs):
+        """Run a render function from render.py in the render pool"""
         try:
             self.log.debug("Requesting render of %s", download_url)
             with time_block(
                 "Rendered %s" % download_url, logger=self.log, debug_limit=0
             ):
-                self.log.info(
-                    "Rendering %d B notebook from %s", len(json_notebook), download_url
-                )
                 render_time = self.statsd.timer("rendering.nbrender.time").start()
-                loop = asyncio.get_event_loop()
-                nbhtml, config = await loop.run_in_executor(
-                    self.pool,
-                    render_notebook,
-                    self.formats[self.format],
+                result = await self.run_in_render_pool(
+                    partial(renderer, **kwargs),
+                    self.render_format,
                     nb,
                     download_url,
                     self.config,
@@ -733,6 +1428,11 @@ class RenderingHandler(BaseHandler):
             self.statsd.incr("rendering.nbrender.fail", 1)
             self.log.error("Invalid notebook %s: %s", msg, e)
             raise web.HTTPError(400, str(e))
+        except RenderKilled as e:
+            self.statsd.incr("rendering.nbrender.fail", 1)
+            self.log.error("Render of %s killed: %s", msg, e)
+            await self.cache_render_failure(str(e))
+            raise web.HTTPError(503, str(e))
         except Exception as e:
             self.statsd.incr("rendering.nbrender.fail", 1)
             self.log.error("Failed to render %s", msg, exc_info=True)
@@ -740,23 +1440,208 @@ class RenderingHandler(BaseHandler):
         else:
             self.statsd.incr("rendering.nbrender.success", 1)
             self.log.debug("Finished render of %s", download_url)
+        return result
 
-        html_time = self.statsd.timer("rendering.html.time").start()
-        html = self.render_notebook_template(
-            body=nbhtml,
-            nb=nb,
-            download_url=download_url,
-            json_notebook=json_notebook,
-            **namespace,
+    @property
+    def render_summary_key(self):
+        return "render-summary:" + self.render_key.split(":", 1)[1]
+
+    async def get_cached_summary(self):
+        """Get the cached summary of the notebook being rendered, or None"""
+        if not self.render_cache_expiry:
+            return None
+        try:
+            cache_data = await self.cache.get(self.render_summary_key)
+            if cache_data is not None:
+                header, body = unpack_record(cache_data)
+                return from_dict(header)
+        except Exception:
+            self.log.error(
+                "Exception getting summary %s from cache",
+                self.render_summary_key,
+                exc_info=True,
+            )
+        return None
+
+    async def summarize(self, json_notebook, msg, keep_notebook=False):
+        """Parse and validate a notebook in the render pool
+
+        Returns its summary (see render.summarize_notebook), which is cached with renders,
+        so that a notebook is parsed only when it is rendered.
+        If `keep_notebook`, returns (summary, parsed notebook).
+        """
+        tests = {name: format.get("test") for name, format in self.formats.items()}
+        try:
+            parse_time = self.statsd.timer("rendering.parsing.time").start()
+            nb = await self.run_in_render_pool(
+                summarize_notebook,
+                json_notebook,
+                tests,
+                # validation only logs errors, not worth blocking the event loop for
+                (
+                    "never"
+                    if self.render_inline
+                    else self.settings.setdefault("notebook_validation", "always")
+                ),
+                bool(self.formats[self.format].get("cell_cache")),
+                keep_notebook,
+            )
+            parse_time.stop()
+        except RenderKilled as e:
+            self.statsd.incr("rendering.parsing.fail")
+            self.log.error("Parsing %s killed: %s", msg, e)
+            await self.cache_render_failure(str(e))
+            raise web.HTTPError(503, str(e))
+        except Exception:
+            self.log.error("Failed to render %s", msg, exc_info=True)
+            self.statsd.incr("rendering.parsing.fail")
+            raise web.HTTPError(400, "Error reading JSON notebook")
+
+        if keep_notebook:
+            nb, parsed = nb
+        if self.render_cache_expiry:
+            try:
+                await self.cache.set(
+                    self.render_summary_key,
+                    pack_record(nb, b""),
+                    self.render_cache_expiry,
+                )
+            except Exception:
+                self.log.error(
+                    "Cache set for summary %s failed",
+                    self.render_summary_key,
+                    exc_info=True,
+                )
+        if keep_notebook:
+            return nb, parsed
+        return nb
+
+    async def finish_notebook(
+        self, json_notebook, download_url, msg=None, public=False, **namespace
+    ):
+        """Renders a notebook from its JSON body.
+
+        Parameters
+        ----------
+        json_notebook: str
+            Notebook document in JSON format
+        download_url: str
+            URL to download the notebook document
+        msg: str, optional
+            Extra information to log when rendering fails
+        public: bool, optional
+            True if the notebook is public and its access indexed, False if not
+        """
+
+        if msg is None:
+            msg = download_url
+
+        self.render_key = render_key = self.render_cache_key(json_notebook)
+        nbhtml, nb = await asyncio.gather(
+            self.get_cached_render(render_key), self.get_cached_summary()
         )
-        html_time.stop()
+        if nbhtml is None:
+            await self.check_render_failure()
+        self.render_inline = self.should_render_inline(json_notebook)
 
         if "content_type" in self.formats[self.format]:
             self.set_header("Content-Type", self.formats[self.format]["content_type"])
-        await self.cache_and_finish(html)
+
+        def render_page(body):
+            html_time = self.statsd.timer("rendering.html.time").start()
+            html = self.render_notebook_template(
+                body=body,
+                nb=nb,
+                download_url=download_url,
+                json_notebook=json_notebook,
+                **namespace,
+            )
+            html_time.stop()
+            return html
+
+        head = foot = None
+
+        def stream():
+            """Send the page around the notebook while it waits and renders"""
+            nonlocal head, foot
+            page = render_page(stream_marker) if self.should_stream else ""
+            if stream_marker in page:
+                head, foot = page.split(stream_marker, 1)
+                self.start_stream(head)
+
+        if nbhtml is not None:
+            self.log.info("Render cache hit %s", download_url)
+            self.statsd.incr("rendering.cache.hit", 1)
+            rendered = False
+        else:
+            rendered = True
+
+        if self.render_inline:
+            parsed = None
+            if nb is None and rendered:
+                # parsed once, for the summary and the render
+                nb, parsed = await self.summarize(
+                    json_notebook, msg, keep_notebook=True
+                )
+            elif nb is None:
+                nb = await self.summarize(json_notebook, msg)
+            if rendered:
+                self.statsd.incr("rendering.route.inline", 1)
+                nbhtml = await self.render_nbhtml(
+                    nb, download_url, msg, json_notebook, parsed
+                )
+        elif nb is None or rendered:
+            # parsing the notebook waits for a render slot too, along with rendering it
+            cells = (
+                nb.get("cell_count", len(nb.get("cell_hashes", [])))
+                if nb is not None
+                else count_cells(json_notebook)
+            )
+            self.render_in_thread = self.should_render_in_thread(json_notebook, cells)
+            if rendered and self.settings.get("thread_pool") is not None:
+                self.statsd.incr(
+                    "rendering.route.%s"
+                    % ("thread" if self.render_in_thread else "process"),
+                    1,
+                )
+            ticket = self.render_scheduler.schedule(
+                self.request.remote_ip,
+                render_cost(json_notebook, cells, summarize=nb is None),
+            )
+            with ticket:
+                if nb is not None:
+                    stream()
+                try:
+                    await ticket.wait()
+                    if nb is None:
+                        nb = await self.summarize(json_notebook, msg)
+                        if rendered:
+                            stream()
+                    if rendered:
+                        nbhtml = await self.render_nbhtml(
+                            nb, download_url, msg, json_notebook
+                        )
+                except web.HTTPError as e:
+                    if head is None:
+                        raise
+                    # too late for an error page
+                    self.finish(
+                        '<div class="alert alert-danger">%s</div>%s'
+                        % (escape(e.log_message or "Error rendering notebook"), foot)
+                    )
+                    return
+        if rendered:
+            await self.cache_render(render_key, nbhtml)
+
+        if head is None:
+            await self.cache_and_finish(render_page(nbhtml))
+        else:
+            self.write(nbhtml)
+            self.write(foot)
+            await self.cache_and_finish(head + nbhtml + foot, streamed=True)
 
         # Index notebook
-        self.index.index_notebook(download_url, nb, public)
+        self.index.index_notebook(download_url, json_notebook, public)
 
 
 class FilesRedirectHandler(BaseHandler):
@@ -3,6 +3,7 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 import hashlib
+import hmac
 
 from tornado.log import app_log
 from tornado.web import HTTPError
@@ -11,10 +12,12 @@ from tornado.web import HTTPError
 class RateLimiter(object):
     """Rate limit checking object"""
 
-    def __init__(self, limit, interval, cache):
+    def __init__(self, limit, interval, cache, exempt_token=""):
         self.limit = limit
         self.interval = interval
         self.cache = cache
+        # requests authorized with this token (e.g. the cache warmer) are not limited
+        self.exempt_token = exempt_token
 
     def key_for_handler(self, handler):
         """Identify a visitor.
@@ -37,6 +40,10 @@ class RateLimiter(object):
         """
         if not self.limit:
             return
+        if self.exempt_token:
+            auth = handler.request.headers.get("Authorization", "")
+            if hmac.compare_digest(auth, "token " + self.exempt_token):
+                return
         key = self.key_for_handler(handler)
         added = await self.cache.add(key, 1, self.interval)
         if not added:
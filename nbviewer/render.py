@@ -4,9 +4,36 @@
 #  Distributed under the terms of the BSD License.  The full license is in
 #  the file COPYING, distributed as part of this software.
 # -----------------------------------------------------------------------------
+import base64
+import binascii
+import hashlib
+import json
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
 from nbconvert.exporters import Exporter  # type: ignore
+from nbformat import convert  # type: ignore
+from nbformat import current_nbformat
+from nbformat import from_dict
+from nbformat import NBFormatError
+from nbformat import reader
+from nbformat import validate
+from nbformat import ValidationError
+from nbformat import versions
+from nbformat.v4 import new_code_cell  # type: ignore
+from nbformat.v4 import new_markdown_cell
+from nbformat.v4 import new_notebook
+from nbformat.v4 import new_output
+from nbformat.v4 import new_raw_cell
 from tornado.log import app_log
 
+try:
+    import orjson  # type: ignore
+except ModuleNotFoundError:
+    orjson = None  # type: ignore
+
 # -----------------------------------------------------------------------------
 #
 # -----------------------------------------------------------------------------
@@ -18,8 +45,143 @@ class NbFormatError(Exception):
 
 exporters = {}
 
+validation_modes = ["always", "cached", "never"]
 
-def render_notebook(format, nb, url=None, forced_theme=None, config=None):
+# sha256 of notebook JSON: validation error message, or None if valid
+validated = OrderedDict()
+validated_max_entries = 1024
+_validated_lock = threading.Lock()
+
+
+def loads_json(json_notebook):
+    """Parse JSON, with orjson if it is installed
+
+    Falls back on the json module for what orjson refuses
+    (NaN and Infinity, integers over 64 bits), which nbformat accepts.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(json_notebook)
+        except orjson.JSONDecodeError:
+            pass
+    try:
+        return json.loads(json_notebook)
+    except ValueError as e:
+        raise reader.NotJSONError("Notebook does not appear to be JSON") from e
+
+
+def read_notebook(json_notebook):
+    """nbformat.reader.reads, with loads_json"""
+    nb_dict = loads_json(json_notebook)
+    major, minor = reader.get_version(nb_dict)
+    if major not in versions:
+        raise NBFormatError("Unsupported nbformat version %s" % major)
+    try:
+        return versions[major].to_notebook_json(nb_dict, minor=minor)
+    except AttributeError as e:
+        raise ValidationError(
+            "The notebook is invalid and is missing an expected key: %s" % e
+        ) from None
+
+
+def validate_notebook(nb):
+    """Validate a notebook, return the validation error message or None"""
+    try:
+        validate(nb)
+    except ValidationError as e:
+        return str(e)
+    return None
+
+
+def validate_notebook_cached(nb, json_notebook):
+    """validate_notebook, remembering the verdict by the sha256 of the notebook's JSON"""
+    if isinstance(json_notebook, str):
+        json_notebook = json_notebook.encode("utf8", "surrogatepass")
+    digest = hashlib.sha256(json_notebook).hexdigest()
+    with _validated_lock:
+        if digest in validated:
+            validated.move_to_end(digest)
+            return validated[digest]
+    error = validate_notebook(nb)
+    with _validated_lock:
+        validated[digest] = error
+        while len(validated) > validated_max_entries:
+            validated.popitem(last=False)
+    return error
+
+
+def parse_notebook(json_notebook, validation="always"):
+    """Parse a notebook from its JSON, as the current nbformat version
+
+    `validation` is one of:
+
+    - always: validate the notebook
+    - cached: validate the notebook, unless the same JSON was validated before
+      (by this process)
+    - never: don't validate the notebook,
+      e.g. because it was validated before rendering
+
+    Like nbformat.reads, only logs validation errors.
+    """
+    nb = convert(read_notebook(json_notebook), current_nbformat)
+    if validation == "always":
+        error = validate_notebook(nb)
+    elif validation == "cached":
+        error = validate_notebook_cached(nb, json_notebook)
+    else:
+        return nb
+    if error is not None:
+        app_log.error("Notebook JSON is invalid: %s", error)
+    return nb
+
+
+def summarize_notebook(
+    json_notebook, tests, validation="always", cell_hashes=True, keep_notebook=False
+):
+    """Parse and validate a notebook, in the render pool
+
+    Returns what the page around the rendered notebook needs,
+    so that the whole notebook never has to be parsed outside the render pool:
+
+    - metadata, nbformat, nbformat_minor: as in the notebook
+    - cell_count: the number of cells
+    - cell_hashes: sha256 of each cell's JSON, for the cell cache,
+      only if `cell_hashes`
+    - formats: the formats that can render the notebook,
+      among `tests`, a dict of format name: test function or None
+      (see formats.default_formats)
+
+    `validation` is as in parse_notebook.
+    If `keep_notebook`, returns the parsed notebook too, as (summary, notebook),
+    to render it without parsing it again.
+    """
+    nb = parse_notebook(json_notebook, validation)
+    formats = []
+    for name, test in tests.items():
+        try:
+            if test is None or test(nb, json_notebook):
+                formats.append(name)
+        except Exception:
+            app_log.info("Failed to test format %s", name, exc_info=True)
+    summary = {
+        "metadata": nb.metadata,
+        "nbformat": nb.nbformat,
+        "nbformat_minor": nb.nbformat_minor,
+        "cell_count": len(nb.cells),
+        "formats": formats,
+    }
+    if cell_hashes:
+        summary["cell_hashes"] = [
+            hashlib.sha256(json.dumps(cell, sort_keys=True).encode("utf8")).hexdigest()
+            for cell in nb.cells
+        ]
+    summary = from_dict(summary)
+    if keep_notebook:
+        return summary, nb
+    return summary
+
+
+def get_exporter(format, config=None):
     exporter = format["exporter"]
 
     if not isinstance(exporter, Exporter):
@@ -31,6 +193,41 @@ def render_notebook(format, nb, url=None, forced_theme=None, config=None):
             app_log.info("instantiating %s" % exporter_cls.__name__)
             exporters[exporter_cls] = exporter_cls(config=config, log=app_log)
         exporter = exporters[exporter_cls]
+    return exporter
+
+
+def warm_up(formats, config=None):
+    """Prepare a render process (or thread) for the first render of each format
+
+    Instantiates the exporters and renders a small notebook in each format,
+    which loads and compiles their templates and imports what they use (e.g. Pygments).
+    """
+    nb = new_notebook(
+        # as written by ipykernel, so script renders import IPython's transformers too
+        metadata={"language_info": {"name": "python", "nbconvert_exporter": "python"}},
+        cells=[
+            new_markdown_cell("# nbviewer\n\n$x^2$"),
+            new_code_cell(
+                "print(1)",
+                execution_count=1,
+                outputs=[new_output("stream", text="1\n")],
+            ),
+        ],
+    )
+    for name, format in formats.items():
+        try:
+            get_exporter(format, config)
+            render_notebook(format, nb, config=config)
+        except Exception:
+            app_log.error("Failed to warm up format %s", name, exc_info=True)
+
+
+def render_notebook(format, nb, url=None, forced_theme=None, config=None):
+    """Render a notebook, given as a NotebookNode or as JSON"""
+    if isinstance(nb, (str, bytes)):
+        nb = parse_notebook(nb, "never")
+
+    exporter = get_exporter(format, config)
 
     css_theme = nb.get("metadata", {}).get("_nbviewer", {}).get("css", None)
 
@@ -60,4 +257,99 @@ def render_notebook(format, nb, url=None, forced_theme=None, config=None):
 
     config = {"download_name": name, "css_theme": css_theme}
 
+    if format.get("extract_outputs"):
+        html, config["outputs"] = extract_outputs(
+            html, format["extract_outputs"], format["outputs_url"]
+        )
+
     return html, config
+
+
+# images inlined as base64 data URIs by nbconvert,
+# both outputs and markdown attachments
+_data_uri_img = re.compile(
+    r'<img\b([^>]*?)\ssrc="data:(image/(?:png|jpeg|gif|webp|svg\+xml));base64,([A-Za-z0-9+/=\s]+)"'
+)
+
+output_extensions = {
+    "image/gif": ".gif",
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/svg+xml": ".svg",
+    "image/webp": ".webp",
+}
+
+
+def extract_outputs(html, threshold, url_prefix):
+    """Replace images inlined as data URIs of at least `threshold` bytes with links
+
+    Images are linked as url_prefix + sha256 + extension, and lazy-loaded.
+    Returns (html, outputs), outputs is a dict of sha256: (mimetype, data)
+    """
+    outputs = {}
+
+    def replace(match):
+        attrs, mimetype, b64 = match.groups()
+        if len(b64) * 3 // 4 < threshold:
+            return match.group(0)
+        try:
+            data = base64.b64decode(b64)
+        except binascii.Error:
+            return match.group(0)
+        sha = hashlib.sha256(data).hexdigest()
+        outputs[sha] = (mimetype, data)
+        if "loading=" not in attrs:
+            attrs += ' loading="lazy"'
+        return '<img%s src="%s%s%s"' % (
+            attrs,
+            url_prefix,
+            sha,
+            output_extensions[mimetype],
+        )
+
+    html = _data_uri_img.sub(replace, html)
+    return html, outputs
+
+
+# separates cells in the output of render_notebook_cells,
+# random so that it can't appear in a notebook
+cell_boundary = "nbviewer-cell-boundary-%s" % uuid.uuid4().hex
+
+
+def render_notebook_cells(
+    format, nb, url=None, forced_theme=None, config=None, cells=None
+):
+    """Render each cell of a notebook separately
+
+    `nb` is a NotebookNode or JSON, `cells` the indices of the cells to render
+    (all of them by default).
+
+    Returns (head, fragments, foot, config):
+    the page is head + the HTML fragment of each cell, in order + foot,
+    so cells rendered by different calls can be put together.
+
+    Cells are rendered in a single export, with raw cells in between as boundaries.
+    Returns None if the output can't be split on them
+    (e.g. a template that doesn't output raw cells as they are).
+    """
+    if isinstance(nb, (str, bytes)):
+        nb = parse_notebook(nb, "never")
+    if cells is None:
+        selected = nb.cells
+    else:
+        selected = [nb.cells[i] for i in cells]
+    n = len(selected)
+    cells = [_boundary_cell()]
+    for cell in selected:
+        cells.extend([cell, _boundary_cell()])
+    html, config = render_notebook(
+        format, from_dict(dict(nb, cells=cells)), url, forced_theme, config
+    )
+    parts = html.split(cell_boundary)
+    if len(parts) != n + 2:
+        return None
+    return parts[0], parts[1:-1], parts[-1], config
+
+
+def _boundary_cell():
+    return new_raw_cell(cell_boundary, metadata={"raw_mimetype": "text/html"})
@@ -0,0 +1,195 @@
+"""Admission control and fair queuing for renders"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import asyncio
+import heapq
+import itertools
+import time
+
+from tornado.log import app_log
+from tornado.web import HTTPError
+
+from .utils import EmptyClass
+
+# cost of a cell, in bytes of notebook JSON, on top of the JSON itself
+cell_cost = 2048
+
+busy_message = "Too many notebooks are being rendered, try again later."
+
+
+def render_cost(json_notebook, cells, summarize=False):
+    """Estimated cost of rendering a notebook with `cells` cells
+
+    With `summarize`, the notebook is also parsed and validated first
+    (see render.summarize_notebook), which costs about as much again as its JSON.
+    """
+    cost = len(json_notebook) + cell_cost * cells
+    if summarize:
+        cost += len(json_notebook)
+    return cost
+
+
+def count_cells(json_notebook):
+    """Estimated number of cells in a notebook, without parsing it"""
+    if isinstance(json_notebook, bytes):
+        return json_notebook.count(b'"cell_type"')
+    return json_notebook.count('"cell_type"')
+
+
+class Ticket(object):
+    """A render's place in the RenderScheduler queue
+
+    Used as a context manager, which gives up the place or the slot on exit.
+    """
+
+    def __init__(self, scheduler, client, cost):
+        self.scheduler = scheduler
+        self.client = client
+        self.cost = cost
+        self.future = asyncio.get_event_loop().create_future()
+        self.queued = time.monotonic()
+        self.started = None
+        self.released = False
+
+    async def wait(self):
+        """Wait for a render slot
+
+        Raises HTTPError(503) if the ticket is pushed out of the queue
+        """
+        await self.future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.scheduler.release(self)
+
+
+class RenderScheduler(object):
+    """Render queue in front of the render pool
+
+    Runs at most `concurrency` renders at a time (the pool's size),
+    the others wait in a queue of at most `max_queue` renders (0 for no limit).
+
+    The queue is served in start-time fair queuing order:
+    each client (IP) is served in turn, in proportion to the cost of its renders,
+    so that no client can fill the queue for everybody,
+    and cheaper renders (small notebooks) get ahead of expensive ones.
+    When the queue is full, the most expensive waiting render is pushed out
+    to make room for a cheaper one.
+
+    Renders expected to wait for longer than `max_wait` seconds (0 for no limit)
+    are refused right away, based on the recent render time per unit of cost.
+
+    Refused and pushed out renders fail with HTTPError(503),
+    which serves the stale page, if there is one (see `cached`).
+    """
+
+    def __init__(self, concurrency, max_queue=0, max_wait=0, statsd=None):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.statsd = statsd or EmptyClass()
+        self.running = 0
+        self.running_cost = 0
+        self.queue = []
+        self.queued = 0
+        # seconds per unit of cost, moving average
+        self.rate = 0
+        # start-time fair queuing state
+        self.virtual_time = 0
+        self.client_finish = {}
+        self._counter = itertools.count()
+
+    def estimate_wait(self, finish):
+        """Estimated wait (seconds) for a render with finish tag `finish`
+
+        i.e. for the running renders and the renders queued ahead of it
+        """
+        if self.running < self.concurrency:
+            return 0
+        ahead = self.running_cost + sum(
+            ticket.cost
+            for f, i, ticket in self.queue
+            if not ticket.released and f <= finish
+        )
+        return ahead * self.rate / self.concurrency
+
+    def schedule(self, client, cost):
+        """Get a Ticket for a render, or raise HTTPError(503) if the queue is too long"""
+        start = max(self.virtual_time, self.client_finish.get(client, 0))
+        finish = start + cost
+        ticket = Ticket(self, client, cost)
+        if self.running < self.concurrency and not self.queued:
+            self._start(ticket)
+            self.client_finish[client] = finish
+            return ticket
+
+        if self.max_wait and self.estimate_wait(finish) > self.max_wait:
+            self.statsd.incr("rendering.queue.refused", 1)
+            raise HTTPError(503, busy_message)
+        if self.max_queue and self.queued >= self.max_queue:
+            last = max(
+                (entry for entry in self.queue if not entry[2].released),
+                key=lambda entry: entry[0],
+            )
+            if last[0] <= finish:
+                self.statsd.incr("rendering.queue.refused", 1)
+                raise HTTPError(503, busy_message)
+            app_log.info("Pushing render for %s out of the queue", last[2].client)
+            self.statsd.incr("rendering.queue.evicted", 1)
+            self._remove(last[2])
+            last[2].future.set_exception(HTTPError(503, busy_message))
+
+        self.client_finish[client] = finish
+        heapq.heappush(self.queue, (finish, next(self._counter), ticket))
+        self.queued += 1
+        self.statsd.gauge("rendering.queue.depth", self.queued)
+        return ticket
+
+    def _remove(self, ticket):
+        ticket.released = True
+        self.queued -= 1
+        self.statsd.gauge("rendering.queue.depth", self.queued)
+
+    def _start(self, ticket):
+        self.running += 1
+        self.running_cost += ticket.cost
+        ticket.started = time.monotonic()
+        self.statsd.timing(
+            "rendering.queue.wait", 1000 * (ticket.started - ticket.queued)
+        )
+        ticket.future.set_result(None)
+
+    def release(self, ticket):
+        """Give up a ticket's place in the queue, or its slot once it's done"""
+        if ticket.released:
+            return
+        if ticket.started is None:
+            self._remove(ticket)
+            return
+        ticket.released = True
+        self.running -= 1
+        self.running_cost -= ticket.cost
+        if ticket.cost:
+            rate = (time.monotonic() - ticket.started) / ticket.cost
+            self.rate = rate if not self.rate else 0.8 * self.rate + 0.2 * rate
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.queue and self.running < self.concurrency:
+            finish, i, ticket = heapq.heappop(self.queue)
+            if ticket.released:
+                continue
+            self.queued -= 1
+            self.statsd.gauge("rendering.queue.depth", self.queued)
+            self.virtual_time = finish - ticket.cost
+            if ticket.future.cancelled():
+                ticket.released = True
+                continue
+            self._start(ticket)
+        if not self.queue:
+            # nothing to be fair about any more
+            self.client_finish.clear()
+            self.virtual_time = 0
@@ -0,0 +1,84 @@
+"""Distributed single-flight locks for coalescing renders across processes"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import asyncio
+import uuid
+
+from tornado.log import app_log
+
+
+class SingleFlight(object):
+    """Render lock shared by every process using the same cache
+
+    Built on the cache's atomic `add`:
+    the process whose `add` succeeds owns the render,
+    and the lock expires after `lease` seconds in case the owner dies.
+    The lock holds a token unique to its owner,
+    so an owner that outlived its lease doesn't release the next owner's lock.
+
+    Other processes poll the cache every `poll_interval` seconds
+    for the owner's result, trying to take over the lock each time,
+    so a failed or crashed owner delays waiters by at most one poll
+    (or by the lease, if the owner died without releasing the lock).
+    """
+
+    def __init__(self, cache, lease=60, poll_interval=0.5):
+        self.cache = cache
+        self.lease = lease
+        self.poll_interval = poll_interval
+
+    def lock_key(self, key):
+        return "render-lock:%s" % key
+
+    async def acquire(self, key):
+        """Try to take the lock for `key`
+
+        Returns the token to release it with, or None if another process holds it.
+        If the cache is unavailable, always succeed
+        so that rendering isn't blocked by cache errors.
+        """
+        token = uuid.uuid4().hex
+        if not self.lease:
+            return token
+        try:
+            if await self.cache.add(self.lock_key(key), token, self.lease):
+                return token
+            return None
+        except Exception:
+            app_log.warning("Failed to acquire render lock for %s", key, exc_info=True)
+            return token
+
+    async def release(self, key, token):
+        """Release the lock for `key`, if it is still held with `token`
+
+        i.e. unless the lease ran out and another process took the lock.
+        """
+        if not self.lease:
+            return
+        try:
+            if await self.cache.get(self.lock_key(key)) == token:
+                await self.cache.delete(self.lock_key(key))
+        except Exception:
+            app_log.warning("Failed to release render lock for %s", key, exc_info=True)
+
+    async def wait(self, key, check):
+        """Wait for another process to finish rendering `key`
+
+        `check` is an async callable returning the result once it is available.
+
+        Returns (result, token):
+        result is the first non-None value from `check`,
+        or None if the lock became free (or its lease ran out) first,
+        in which case we now hold the lock, with `token`.
+        Waits for as long as other processes hold the lock,
+        each for at most the lease.
+        """
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            result = await check()
+            if result is not None:
+                return result, None
+            token = await self.acquire(key)
+            if token is not None:
+                return None, token
@@ -48,12 +48,24 @@ def test_generate_config():
     os.remove(cfg_file)
     assert cfg_file in out
     assert "NBViewer.name" not in cfg_text  # This shouldn't be configurable
+    assert "NBViewer.admin_token" in cfg_text
     assert "NBViewer.answer_yes" in cfg_text
     assert "NBViewer.base_url" in cfg_text
     assert "NBViewer._base_url" not in cfg_text  # This shouldn't be configurable
     assert "NBViewer.binder_base_url" in cfg_text
+    assert "NBViewer.cache_codec" in cfg_text
+    assert "NBViewer.cache_content_encodings" in cfg_text
+    assert "NBViewer.cache_disk_limit" in cfg_text
     assert "NBViewer.cache_expiry_max" in cfg_text
     assert "NBViewer.cache_expiry_min" in cfg_text
+    assert "NBViewer.cache_l1_expiry" in cfg_text
+    assert "NBViewer.cache_l1_memory_limit" in cfg_text
+    assert "NBViewer.cache_max_entries" in cfg_text
+    assert "NBViewer.cache_memory_limit" in cfg_text
+    assert "NBViewer.cache_path" in cfg_text
+    assert "NBViewer.cache_stale_if_error" in cfg_text
+    assert "NBViewer.cache_stale_while_revalidate" in cfg_text
+    assert "NBViewer.cache_stats_interval" in cfg_text
     assert "NBViewer.client" in cfg_text
     assert "NBViewer.config_file" in cfg_text
     assert "NBViewer.content_security_policy" in cfg_text
@@ -62,6 +74,7 @@ def test_generate_config():
     assert "NBViewer.generate_config" in cfg_text
     assert "NBViewer.host" in cfg_text
     assert "NBViewer.index" in cfg_text
+    assert "NBViewer.inline_render_max_bytes" in cfg_text
     assert "NBViewer.ipywidgets_base_url" in cfg_text
     assert "NBViewer.jupyter_js_widgets_version" in cfg_text
     assert "NBViewer.jupyter_widgets_html_manager_version" in cfg_text
@@ -69,11 +82,16 @@ def test_generate_config():
     assert "NBViewer.local_handler" in cfg_text
     assert "NBViewer.localfile_follow_symlinks" in cfg_text
     assert "NBViewer.localfiles" in cfg_text
+    assert "NBViewer.loop_lag_interval" in cfg_text
     assert "NBViewer.mathjax_url" in cfg_text
     assert "NBViewer.max_cache_uris" in cfg_text
     assert "NBViewer.mc_threads" in cfg_text
+    assert "NBViewer.memcache_client" in cfg_text
+    assert "NBViewer.memcache_pool_size" in cfg_text
     assert "NBViewer.no_cache" in cfg_text
     assert "NBViewer.no_check_certificate" in cfg_text
+    assert "NBViewer.notebook_validation" in cfg_text
+    assert "NBViewer.output_extract_threshold" in cfg_text
     assert "NBViewer.port" in cfg_text
     assert "NBViewer.processes" in cfg_text
     assert "NBViewer.providers" in cfg_text
@@ -82,7 +100,16 @@ def test_generate_config():
     assert "NBViewer.proxy_port" in cfg_text
     assert "NBViewer.rate_limit" in cfg_text
     assert "NBViewer.rate_limit_interval" in cfg_text
+    assert "NBViewer.render_cache_expiry" in cfg_text
+    assert "NBViewer.render_failure_expiry" in cfg_text
+    assert "NBViewer.render_kill_timeout" in cfg_text
+    assert "NBViewer.render_lock_lease" in cfg_text
+    assert "NBViewer.render_lock_poll_interval" in cfg_text
+    assert "NBViewer.render_memory_limit" in cfg_text
+    assert "NBViewer.render_queue_max_wait" in cfg_text
+    assert "NBViewer.render_queue_size" in cfg_text
     assert "NBViewer.render_timeout" in cfg_text
+    assert "NBViewer.render_worker_max_tasks" in cfg_text
     assert "NBViewer.sslcert" in cfg_text
     assert "NBViewer.sslkey" in cfg_text
     assert "NBViewer.static_path" in cfg_text
@@ -93,7 +120,15 @@ def test_generate_config():
     assert "NBViewer.statsd_host" in cfg_text
     assert "NBViewer.statsd_port" in cfg_text
     assert "NBViewer.statsd_prefix" in cfg_text
+    assert "NBViewer.stream_renders" in cfg_text
     assert "NBViewer.template_path" in cfg_text
+    assert "NBViewer.thread_render_max_bytes" in cfg_text
+    assert "NBViewer.thread_render_max_cells" in cfg_text
+    assert "NBViewer.warm_access_log" in cfg_text
+    assert "NBViewer.warm_concurrency" in cfg_text
+    assert "NBViewer.warm_interval" in cfg_text
+    assert "NBViewer.warm_top" in cfg_text
+    assert "NBViewer.warm_urls_file" in cfg_text
     assert (
         "NBViewer.default_endpoint" not in cfg_text
     )  # Shouldn't be configurable, is a property
@@ -103,5 +138,25 @@ def test_generate_config():
     assert "NBViewer.frontpage_setup" not in cfg_text
     assert "NBViewer.pool" not in cfg_text
     assert "NBViewer.rate_limiter" not in cfg_text
+    assert "NBViewer.warmer" not in cfg_text
+    assert "NBViewer.cache_backend" not in cfg_text
+    assert "NBViewer.counter_cache" not in cfg_text
+    assert "NBViewer.cache_stats" not in cfg_text.replace("cache_stats_interval", "")
     assert "NBViewer.static_paths" not in cfg_text
     assert "NBViewer.template_paths" not in cfg_text
+
+
+def test_disk_cache_counters(tmp_path, monkeypatch):
+    from nbviewer.app import NBViewer
+    from nbviewer.cache import AsyncLRUCache
+
+    for name in ("MEMCACHIER_SERVERS", "MEMCACHE_SERVERS", "NBCACHE_PORT"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(
+        sys, "argv", ["nbviewer", "--cache-path=%s" % (tmp_path / "cache.sqlite")]
+    )
+    app = NBViewer()
+    # rate limits and render locks don't write to the disk cache
+    assert isinstance(app.counter_cache, AsyncLRUCache)
+    assert app.rate_limiter.cache is app.counter_cache
+    assert app.single_flight.cache is app.counter_cache
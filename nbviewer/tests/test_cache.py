@@ -0,0 +1,419 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+from tornado import web
+from tornado.log import app_log
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from nbviewer import cache
+from nbviewer.cache import AsyncLayeredCache
+from nbviewer.cache import AsyncLRUCache
+from nbviewer.cache import AsyncSQLiteCache
+from nbviewer.cache import cache_namespace
+from nbviewer.cache import decompress
+from nbviewer.cache import DummyAsyncCache
+from nbviewer.cache import get_codec
+from nbviewer.cache import InstrumentedCache
+from nbviewer.cache import LRUStore
+from nbviewer.cache import MultipartMixin
+from nbviewer.cache import pack_record
+from nbviewer.cache import unpack_record
+from nbviewer.handlers import CacheStatsHandler
+
+
+def test_lru_evicts_by_bytes():
+    store = LRUStore(max_bytes=10)
+    store.set("a", b"xxxx")
+    store.set("b", b"xxxx")
+    assert store.get("a") == b"xxxx"
+    # "b" is now least recently used
+    store.set("c", b"xxxx")
+    assert store.get("b") is None
+    assert store.get("a") == b"xxxx"
+    assert store.get("c") == b"xxxx"
+    assert store.nbytes == 8
+
+
+def test_lru_evicts_by_entries():
+    store = LRUStore(max_entries=2)
+    for key in "abc":
+        store.set(key, key.encode())
+    assert len(store) == 2
+    assert "a" not in store
+
+
+def test_lru_rejects_oversized_value():
+    store = LRUStore(max_bytes=4)
+    store.set("a", b"xx")
+    assert not store.set("a", b"xxxxx")
+    assert store.get("a") is None
+    assert store.nbytes == 0
+
+
+def test_lru_overwrite_updates_size():
+    store = LRUStore()
+    store.set("a", b"x" * 10)
+    store.set("a", b"x" * 3)
+    assert store.nbytes == 3
+    assert len(store) == 1
+
+
+def test_lru_expiry():
+    now = [1000.0]
+    with mock.patch.object(cache, "monotonic", lambda: now[0]):
+        store = LRUStore()
+        store.set("short", b"x", 10)
+        store.set("long", b"x", 100)
+        store.set("forever", b"x")
+        # overwriting must not be expired by the old deadline
+        store.set("short", b"y", 50)
+        now[0] += 20
+        assert store.get("short") == b"y"
+        now[0] += 40
+        assert store.get("short") is None
+        assert store.get("long") == b"x"
+        now[0] += 1e6
+        assert store.get("long") is None
+        assert store.get("forever") == b"x"
+        assert store.nbytes == 1
+
+
+def test_lru_absolute_expiry():
+    store = LRUStore()
+    # large expiry values are unix timestamps, like memcached
+    store.set("past", b"x", int(time.time()) - 10)
+    store.set("future", b"x", int(time.time()) + 3600)
+    assert store.get("past") is None
+    assert store.get("future") == b"x"
+
+
+def test_lru_incr_add_delete():
+    store = LRUStore()
+    assert store.incr("n") is None
+    assert store.add("n", 1, 60)
+    assert not store.add("n", 5, 60)
+    assert store.incr("n") == 2
+    assert store.delete("n")
+    assert not store.delete("n")
+
+
+class AsyncLRUCacheTest(AsyncTestCase):
+    @gen_test
+    async def test_get_set(self):
+        c = AsyncLRUCache(max_bytes=100)
+        assert await c.get("k") is None
+        assert await c.set("k", b"value")
+        assert await c.get("k") == b"value"
+        assert await c.add("k", b"other") is False
+        assert await c.add("n", 1)
+        assert await c.incr("n") == 2
+
+    @gen_test
+    async def test_dummy_limit(self):
+        c = DummyAsyncCache(limit=2)
+        for key in "abc":
+            await c.set(key, key)
+        assert await c.get("a") is None
+        assert await c.get("c") == "c"
+
+
+class AsyncLayeredCacheTest(AsyncTestCase):
+    @gen_test
+    async def test_l1_populated_from_l2(self):
+        l2 = AsyncLRUCache()
+        c = AsyncLayeredCache(l2)
+        await l2.set("k", b"value")
+        assert "k" not in c.l1
+        assert await c.get("k") == b"value"
+        assert c.l1.get("k") == b"value"
+        # served from L1 even if L2 loses it
+        l2.store.delete("k")
+        assert await c.get("k") == b"value"
+
+    @gen_test
+    async def test_set_writes_both_tiers(self):
+        l2 = AsyncLRUCache()
+        c = AsyncLayeredCache(l2)
+        await c.set("k", b"value", 60)
+        assert c.l1.get("k") == b"value"
+        assert await l2.get("k") == b"value"
+
+    @gen_test
+    async def test_counters_bypass_l1(self):
+        l2 = AsyncLRUCache()
+        c = AsyncLayeredCache(l2)
+        assert await c.add("n", 1, 60)
+        assert await c.incr("n") == 2
+        assert await c.incr("n") == 3
+        assert "n" not in c.l1
+
+
+class AsyncSQLiteCacheTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    @gen_test
+    async def test_persistent(self):
+        c = AsyncSQLiteCache(self.path)
+        assert await c.get("k") is None
+        assert await c.set("k", b"value", 60)
+        assert await c.get("k") == b"value"
+        # a new instance (e.g. after restart) sees the same data
+        c = AsyncSQLiteCache(self.path)
+        assert await c.get("k") == b"value"
+        assert c.nbytes == 5
+
+    @gen_test
+    async def test_expiry(self):
+        c = AsyncSQLiteCache(self.path)
+        await c.set("past", b"x", int(time.time()) - 10)
+        await c.set("future", b"x", int(time.time()) + 3600)
+        await c.set("forever", b"x")
+        assert await c.get("past") is None
+        assert await c.get("future") == b"x"
+        assert await c.get("forever") == b"x"
+
+    @gen_test
+    async def test_evicts_least_recently_read(self):
+        c = AsyncSQLiteCache(self.path, max_bytes=10, low_water=1, atime_granularity=0)
+        await c.set("a", b"xxxx")
+        await c.set("b", b"xxxx")
+        assert await c.get("a") == b"xxxx"
+        await c.set("c", b"xxxx")
+        assert await c.get("b") is None
+        assert await c.get("a") == b"xxxx"
+        assert await c.get("c") == b"xxxx"
+        assert c.nbytes == 8
+        assert not await c.set("big", b"x" * 11)
+
+    @gen_test
+    async def test_atime_granularity(self):
+        c = AsyncSQLiteCache(self.path)
+        await c.set("k", b"x")
+        c._db.execute("UPDATE cache SET atime = 0")
+        assert await c.get("k") == b"x"
+        (atime,) = c._db.execute("SELECT atime FROM cache").fetchone()
+        assert atime > 0
+        # read again within the granularity: no write
+        changes = c._db.total_changes
+        assert await c.get("k") == b"x"
+        assert c._db.total_changes == changes
+
+    @gen_test
+    async def test_add_incr_delete(self):
+        c = AsyncSQLiteCache(self.path)
+        assert await c.incr("n") is None
+        assert await c.add("n", 1, 60)
+        assert not await c.add("n", 1, 60)
+        assert await c.incr("n") == 2
+        assert await c.get("n") == 2
+        assert await c.delete("n")
+        assert not await c.delete("n")
+        assert c.nbytes == 0
+
+
+def test_codec_roundtrip():
+    data = b"notebook " * 1000
+    codec = get_codec("zlib")
+    compressed = codec.compress(data)
+    assert len(compressed) < len(data)
+    assert decompress(compressed) == data
+    # anything other than compressed data is rejected
+    with pytest.raises(ValueError):
+        decompress(data)
+    with pytest.raises(ValueError):
+        get_codec("nope")
+
+
+def test_record_roundtrip():
+    data = pack_record({"headers": {"Content-Type": "text/html"}}, "<p>é</p>")
+    header, body = unpack_record(data)
+    assert header == {"headers": {"Content-Type": "text/html"}}
+    assert isinstance(body, memoryview)
+    # the body is a view on the record, not a copy
+    assert body.obj is data
+    assert bytes(body) == "<p>é</p>".encode("utf8")
+
+
+def test_record_legacy_and_version():
+    assert unpack_record(pickle.dumps({"body": "x"})) is None
+    data = bytearray(pack_record({}, b"x"))
+    data[4] = 99
+    with pytest.raises(ValueError):
+        unpack_record(bytes(data))
+
+
+class MultipartCodecTest(AsyncTestCase):
+    """MultipartMixin over an in-memory dict standing in for memcache"""
+
+    class DictMultipartCache(MultipartMixin):
+        def __init__(self, **kwargs):
+            self.data = {}
+            super().__init__(**kwargs)
+
+        async def get_multi(self, keys):
+            return {key: self.data[key] for key in keys if key in self.data}
+
+        async def set_multi(self, values, *args):
+            self.data.update(values)
+            return []
+
+    @gen_test
+    async def test_offloaded_codec(self):
+        pool = mock.Mock(wraps=ThreadPoolExecutor(1))
+        c = self.DictMultipartCache(
+            chunk_size=100, codec_pool=pool, offload_threshold=10
+        )
+        value = b"x" * 5000
+        await c.set("key", value)
+        assert await c.get("key") == value
+        # one compress, one decompress
+        assert pool.submit.call_count == 2
+
+    @gen_test
+    async def test_small_values_inline(self):
+        pool = mock.Mock(wraps=ThreadPoolExecutor(1))
+        c = self.DictMultipartCache(codec_pool=pool)
+        await c.set("key", b"small")
+        assert await c.get("key") == b"small"
+        assert not pool.submit.called
+
+    @gen_test
+    async def test_manifest(self):
+        c = self.DictMultipartCache(chunk_size=100)
+        value = os.urandom(1000)
+        await c.set("key", value)
+        manifest = json.loads(c.data[b"key"])
+        assert manifest["codec"] == "zlib"
+        assert len(manifest["chunks"]) > 1
+        assert all(k.encode() in c.data for k in manifest["chunks"])
+
+    @gen_test
+    async def test_missing_chunk_is_miss(self):
+        c = self.DictMultipartCache(chunk_size=100)
+        await c.set("key", os.urandom(1000))
+        manifest = json.loads(c.data[b"key"])
+        # e.g. a chunk evicted by memcached
+        del c.data[manifest["chunks"][-1].encode()]
+        assert await c.get("key") is None
+
+    @gen_test
+    async def test_no_torn_reads(self):
+        c = self.DictMultipartCache(chunk_size=100)
+        old, new = os.urandom(1000), os.urandom(1000)
+        await c.set("key", old)
+        old_manifest = c.data[b"key"]
+        await c.set("key", new)
+        # a reader holding the old manifest still gets a consistent old value
+        c.data[b"key"] = old_manifest
+        assert await c.get("key") == old
+        c.data[b"key"] = json.dumps(
+            dict(
+                json.loads(old_manifest), chunks=json.loads(old_manifest)["chunks"][:-1]
+            )
+        ).encode()
+        # mixing chunk lists is caught by the checksum
+        assert await c.get("key") is None
+
+    @gen_test
+    async def test_shared_chunks(self):
+        c = self.DictMultipartCache(chunk_size=100)
+        value = os.urandom(1000)
+        await c.set("a", value)
+        n = len(c.data)
+        await c.set("b", value)
+        # only the new manifest is added
+        assert len(c.data) == n + 1
+        assert await c.get("b") == value
+
+
+def test_cache_namespace():
+    assert cache_namespace("page:abc") == "page"
+    assert cache_namespace(b"upstream:abc") == "upstream"
+    assert cache_namespace("rate-limit:1.2.3.4:abc") == "rate-limit"
+    assert cache_namespace("abc") == "other"
+
+
+class InstrumentedCacheTest(AsyncTestCase):
+    @gen_test
+    async def test_stats(self):
+        c = InstrumentedCache(AsyncLayeredCache(AsyncLRUCache(), max_bytes=6))
+        assert await c.get("page:a") is None
+        await c.set("page:a", b"xxxx")
+        assert await c.get("page:a") == b"xxxx"
+        await c.set("page:b", b"xxxx")
+        await c.add("rate-limit:x", 1, 60)
+        assert not await c.add("rate-limit:x", 1, 60)
+        stats = c.stats()
+        page = stats["namespaces"]["page"]
+        assert page["hits"] == 1
+        assert page["misses"] == 1
+        assert page["sets"] == 2
+        assert page["bytes_written"] == 8
+        assert page["bytes_read"] == 4
+        assert page["hit_ratio"] == 0.5
+        assert page["get_latency"]["count"] == 2
+        assert stats["namespaces"]["rate-limit"]["not_stored"] == 1
+        backend = stats["backend"]
+        assert backend["type"] == "AsyncLayeredCache"
+        assert backend["l1"]["hits"] == 1
+        assert backend["l1"]["evictions"] == 1
+        assert backend["l2"]["entries"] == 3
+        # backend attributes are still reachable
+        assert c.l2 is c.cache.l2
+
+    @gen_test
+    async def test_errors(self):
+        class BrokenCache(object):
+            async def get(self, key):
+                raise OSError("down")
+
+        c = InstrumentedCache(BrokenCache())
+        with pytest.raises(OSError):
+            await c.get("page:a")
+        assert c.stats()["namespaces"]["page"]["errors"] == 1
+
+
+class CacheStatsHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application(
+            [("/_stats/cache", CacheStatsHandler)],
+            admin_token="secret",
+            cache=InstrumentedCache(AsyncLRUCache()),
+            content_security_policy="",
+            default_format="html",
+            hub_base_url=None,
+            log=app_log,
+        )
+
+    def test_requires_token(self):
+        r = self.fetch("/_stats/cache")
+        assert r.code == 403
+        r = self.fetch("/_stats/cache", headers={"Authorization": "token wrong"})
+        assert r.code == 403
+
+    def test_stats(self):
+        r = self.fetch("/_stats/cache", headers={"Authorization": "token secret"})
+        assert r.code == 200
+        stats = json.loads(r.body)
+        assert stats["backend"]["type"] == "AsyncLRUCache"
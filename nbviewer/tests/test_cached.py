@@ -0,0 +1,865 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+import asyncio
+import base64
+import gzip
+import hashlib
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nbconvert import HTMLExporter  # type: ignore
+from nbformat import v4
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.log import app_log
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import bind_unused_port
+from tornado.testing import gen_test
+
+from nbviewer.cache import AsyncLayeredCache
+from nbviewer.cache import AsyncLRUCache
+from nbviewer.cache import pack_record
+from nbviewer.cache import unpack_record
+from nbviewer.handlers import OutputHandler
+from nbviewer.pool import SupervisedProcessPool
+from nbviewer.providers.base import BaseHandler
+from nbviewer.providers.base import cached
+from nbviewer.providers.base import RenderingHandler
+from nbviewer.render import parse_notebook
+from nbviewer.render import render_notebook
+from nbviewer.render import warm_up
+from nbviewer.ratelimit import RateLimiter
+from nbviewer.scheduler import RenderScheduler
+from nbviewer.singleflight import SingleFlight
+from nbviewer.utils import EmptyClass
+from nbviewer.warmer import refresh_header
+
+
+class CountingHandler(BaseHandler):
+    """Renders a counter, or fails with settings['fail']"""
+
+    @cached
+    async def get(self):
+        self.settings["renders"] += 1
+        await asyncio.sleep(0)
+        if self.settings["fail"]:
+            raise web.HTTPError(self.settings["fail"])
+        await self.cache_and_finish("render %i" % self.settings["renders"])
+
+    def write_error(self, status_code, **kwargs):
+        self.write("error %i" % status_code)
+
+
+class LargePageHandler(BaseHandler):
+    """Renders a page big enough to be compressed"""
+
+    @cached
+    async def get(self):
+        self.settings["renders"] += 1
+        await self.cache_and_finish("line %i\n" % self.settings["renders"] * 1000)
+
+
+class SlowCountingHandler(BaseHandler):
+    """Renders a counter shared by several applications, slowly"""
+
+    @cached
+    async def get(self):
+        self.settings["renders"][0] += 1
+        await asyncio.sleep(0.1)
+        await self.cache_and_finish("render %i" % self.settings["renders"][0])
+
+
+class UncachedHandler(BaseHandler):
+    def get(self):
+        self.finish("uncached")
+
+
+class CachedTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.cache = AsyncLRUCache()
+        return web.Application(
+            [
+                ("/page", CountingHandler),
+                ("/large", LargePageHandler),
+                ("/uncached", UncachedHandler),
+            ],
+            admin_token="secret",
+            cache=self.cache,
+            cache_content_encodings=["gzip"],
+            cache_expiry_min=60,
+            cache_expiry_max=60,
+            cache_stale_while_revalidate=60,
+            cache_stale_if_error=600,
+            content_security_policy="",
+            default_format="html",
+            hub_base_url=None,
+            log=app_log,
+            rate_limiter=RateLimiter(limit=0, interval=60, cache=self.cache),
+            single_flight=SingleFlight(self.cache, lease=5, poll_interval=0.01),
+            statsd_host=None,
+            fail=0,
+            renders=0,
+        )
+
+    @property
+    def settings(self):
+        return self._app.settings
+
+    def cached_keys(self, prefix="page:"):
+        return [key for key in self.cache.store._data if key.startswith(prefix)]
+
+    def cached_record(self, prefix="page:"):
+        (key,) = self.cached_keys(prefix)
+        return unpack_record(self.cache.store.get(key))
+
+    def expire(self, age):
+        """Make the cached page stale by `age` seconds"""
+        for key in self.cached_keys("page"):
+            header, body = unpack_record(self.cache.store.get(key))
+            header["expires"] = time.time() - age
+            self.cache.store.set(key, pack_record(header, body))
+
+    async def get(self):
+        return await self.http_client.fetch(self.get_url("/page"), raise_error=False)
+
+    async def wait_for_renders(self, n):
+        for i in range(100):
+            if self.settings["renders"] >= n:
+                return
+            await asyncio.sleep(0.01)
+        assert False, "Expected %i renders, got %i" % (n, self.settings["renders"])
+
+    @gen_test
+    async def test_fresh_hit(self):
+        r = await self.get()
+        assert r.body == b"render 1"
+        r = await self.get()
+        assert r.body == b"render 1"
+        assert self.settings["renders"] == 1
+
+    @gen_test
+    async def test_stale_while_revalidate(self):
+        await self.get()
+        self.expire(10)
+        r = await self.get()
+        # stale page served, refreshed in the background
+        assert r.code == 200
+        assert r.body == b"render 1"
+        await self.wait_for_renders(2)
+        # wait for the refreshed page to be stored
+        await asyncio.sleep(0.01)
+        r = await self.get()
+        assert r.body == b"render 2"
+        assert self.settings["renders"] == 2
+
+    @gen_test
+    async def test_warmer_refresh(self):
+        await self.get()
+        headers = {"Authorization": "token secret", refresh_header: "30"}
+        r = await self.http_client.fetch(self.get_url("/page"), headers=headers)
+        # expires in 60s, left alone
+        assert r.body == b"render 1"
+        await asyncio.sleep(0.05)
+        assert self.settings["renders"] == 1
+
+        self.expire(-10)
+        # not from the warmer
+        headers["Authorization"] = "token wrong"
+        await self.http_client.fetch(self.get_url("/page"), headers=headers)
+        await asyncio.sleep(0.05)
+        assert self.settings["renders"] == 1
+
+        headers["Authorization"] = "token secret"
+        r = await self.http_client.fetch(self.get_url("/page"), headers=headers)
+        assert r.body == b"render 1"
+        await self.wait_for_renders(2)
+        await asyncio.sleep(0.01)
+        r = await self.get()
+        assert r.body == b"render 2"
+
+    @gen_test
+    async def test_single_revalidation(self):
+        await self.get()
+        self.expire(10)
+        responses = await asyncio.gather(*(self.get() for i in range(5)))
+        assert [r.body for r in responses] == [b"render 1"] * 5
+        await asyncio.sleep(0.05)
+        assert self.settings["renders"] == 2
+
+    @gen_test
+    async def test_stale_if_error(self):
+        await self.get()
+        self.expire(120)
+        self.settings["fail"] = 502
+        r = await self.get()
+        assert r.code == 200
+        assert r.body == b"render 1"
+
+    @gen_test
+    async def test_not_found_is_not_masked(self):
+        await self.get()
+        self.expire(120)
+        self.settings["fail"] = 404
+        r = await self.get()
+        assert r.code == 404
+
+    @gen_test
+    async def test_too_stale(self):
+        await self.get()
+        self.expire(1200)
+        self.settings["fail"] = 502
+        r = await self.get()
+        assert r.code == 502
+
+    @gen_test
+    async def test_wait_for_other_process(self):
+        key = "page:" + hashlib.sha1(b"/page").hexdigest()
+        # another process holds the render lock
+        assert await self.settings["single_flight"].acquire(key)
+        request = asyncio.ensure_future(self.get())
+        await asyncio.sleep(0.05)
+        assert not request.done()
+        page = pack_record({"headers": {}, "expires": time.time() + 60}, "other")
+        await self.cache.set(key, page)
+        r = await request
+        assert r.body == b"other"
+        assert self.settings["renders"] == 0
+
+    @gen_test
+    async def test_take_over_released_lock(self):
+        key = "page:" + hashlib.sha1(b"/page").hexdigest()
+        single_flight = self.settings["single_flight"]
+        token = await single_flight.acquire(key)
+        assert token
+        request = asyncio.ensure_future(self.get())
+        await asyncio.sleep(0.05)
+        # the other process failed without caching anything
+        await single_flight.release(key, token)
+        r = await request
+        assert r.body == b"render 1"
+        # and released the lock again
+        assert await single_flight.acquire(key)
+
+    @gen_test
+    async def test_release_own_lock_only(self):
+        single_flight = self.settings["single_flight"]
+        token = await single_flight.acquire("k")
+        # the lease ran out, and another process took the lock
+        await self.cache.delete(single_flight.lock_key("k"))
+        assert await single_flight.acquire("k")
+        await single_flight.release("k", token)
+        assert await single_flight.acquire("k") is None
+
+    @gen_test
+    async def test_pickle_ignored(self):
+        key = "page:" + hashlib.sha1(b"/page").hexdigest()
+        page = {"headers": {"Content-Type": "text/plain"}, "body": "pickled"}
+        await self.cache.set(key, pickle.dumps(page))
+        r = await self.get()
+        # a miss, never unpickled
+        assert r.body == b"render 1"
+        assert self.settings["renders"] == 1
+
+    async def get_large(self, accept_encoding):
+        return await self.http_client.fetch(
+            self.get_url("/large"),
+            headers={"Accept-Encoding": accept_encoding},
+            decompress_response=False,
+        )
+
+    @gen_test
+    async def test_precompressed(self):
+        expected = b"line 1\n" * 1000
+        for i in range(2):
+            r = await self.get_large("gzip, deflate")
+            assert r.headers["Content-Encoding"] == "gzip"
+            assert r.headers["Vary"] == "Accept-Encoding"
+            assert gzip.decompress(r.body) == expected
+        assert self.settings["renders"] == 1
+        header, body = self.cached_record()
+        assert list(header["encodings"]) == ["identity", "gzip"]
+        assert header["encodings"]["identity"] == len(expected)
+
+    @gen_test
+    async def test_precompressed_identity(self):
+        await self.get_large("gzip")
+        r = await self.get_large("identity")
+        assert "Content-Encoding" not in r.headers
+        assert r.headers["Vary"] == "Accept-Encoding"
+        assert r.body == b"line 1\n" * 1000
+
+    @gen_test
+    async def test_small_page_not_compressed(self):
+        await self.get()
+        header, body = self.cached_record()
+        assert "encodings" not in header
+
+    @gen_test
+    async def test_etag(self):
+        r = await self.get()
+        etag = r.headers["Etag"]
+        assert etag == '"%s"' % hashlib.sha1(b"render 1").hexdigest()
+        r = await self.http_client.fetch(
+            self.get_url("/page"), headers={"If-None-Match": etag}, raise_error=False
+        )
+        assert r.code == 304
+        assert r.body == b""
+        assert r.headers["Etag"] == etag
+        r = await self.http_client.fetch(
+            self.get_url("/page"), headers={"If-None-Match": '"other"'}
+        )
+        assert r.code == 200
+        assert r.body == b"render 1"
+        assert self.settings["renders"] == 1
+
+    @gen_test
+    async def test_not_modified_from_meta(self):
+        r = await self.get()
+        # the page itself isn't loaded
+        for key in self.cached_keys("page:"):
+            self.cache.store.delete(key)
+        r = await self.http_client.fetch(
+            self.get_url("/page"),
+            headers={"If-None-Match": r.headers["Etag"]},
+            raise_error=False,
+        )
+        assert r.code == 304
+        assert self.settings["renders"] == 1
+
+    @gen_test
+    async def test_stale_etag(self):
+        r = await self.get()
+        self.expire(1200)
+        r = await self.http_client.fetch(
+            self.get_url("/page"), headers={"If-None-Match": r.headers["Etag"]}
+        )
+        # re-rendered
+        assert r.code == 200
+        assert r.body == b"render 2"
+
+    @gen_test
+    async def test_precompressed_etag(self):
+        r = await self.get_large("gzip")
+        etag = r.headers["Etag"]
+        assert etag.endswith('-gzip"')
+        r = await self.get_large("identity")
+        assert r.headers["Etag"] == etag.replace("-gzip", "")
+        r = await self.http_client.fetch(
+            self.get_url("/large"),
+            headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+            raise_error=False,
+        )
+        assert r.code == 304
+
+    @gen_test
+    async def test_head(self):
+        await self.http_client.fetch(self.get_url("/large"))
+        r = await self.http_client.fetch(self.get_url("/large"), method="HEAD")
+        assert r.body == b""
+        assert self.settings["renders"] == 1
+        for key in self.cached_keys("page:"):
+            self.cache.store.delete(key)
+        for accept_encoding in ("identity", "gzip"):
+            r = await self.http_client.fetch(
+                self.get_url("/large"),
+                method="HEAD",
+                headers={"Accept-Encoding": accept_encoding},
+                decompress_response=False,
+            )
+            assert r.code == 200
+            assert r.body == b""
+            header, body = self.cached_record("page-meta:")
+            encoding = r.headers.get("Content-Encoding", "identity")
+            assert int(r.headers["Content-Length"]) == header["encodings"][encoding]
+        assert self.settings["renders"] == 1
+
+    @gen_test
+    async def test_head_not_rendered(self):
+        r = await self.http_client.fetch(
+            self.get_url("/large"), method="HEAD", raise_error=False
+        )
+        assert r.code == 405
+        assert self.settings["renders"] == 0
+
+    @gen_test
+    async def test_head_not_allowed(self):
+        r = await self.http_client.fetch(
+            self.get_url("/uncached"), method="HEAD", raise_error=False
+        )
+        assert r.code == 405
+
+
+class MultiProcessTest(AsyncHTTPTestCase):
+    """Applications with their own L1 cache in front of a shared cache, like processes"""
+
+    processes = 3
+
+    def get_app(self):
+        self.l2 = AsyncLRUCache()
+        self.renders = [0]
+        self.servers = []
+        self.ports = []
+        apps = [self.make_app() for i in range(self.processes)]
+        for app in apps[1:]:
+            sock, port = bind_unused_port()
+            server = HTTPServer(app)
+            server.add_sockets([sock])
+            self.servers.append(server)
+            self.ports.append(port)
+        return apps[0]
+
+    def make_app(self):
+        cache = AsyncLayeredCache(self.l2)
+        return web.Application(
+            [("/page", SlowCountingHandler)],
+            cache=cache,
+            cache_expiry_min=60,
+            cache_expiry_max=60,
+            cache_stale_while_revalidate=0,
+            cache_stale_if_error=600,
+            content_security_policy="",
+            default_format="html",
+            hub_base_url=None,
+            log=app_log,
+            rate_limiter=RateLimiter(limit=0, interval=60, cache=cache),
+            single_flight=SingleFlight(self.l2, lease=5, poll_interval=0.01),
+            statsd_host=None,
+            renders=self.renders,
+        )
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super().tearDown()
+
+    @gen_test
+    async def test_rendered_once(self):
+        key = "page:" + hashlib.sha1(b"/page").hexdigest()
+        # every process has a stale copy in its L1
+        stale = pack_record({"headers": {}, "expires": time.time() - 10}, "stale")
+        for app in [self._app] + [server.request_callback for server in self.servers]:
+            await app.settings["cache"].set(key, stale, 600)
+        urls = [self.get_url("/page")] + [
+            "http://127.0.0.1:%i/page" % port for port in self.ports
+        ]
+        responses = await asyncio.gather(*(self.http_client.fetch(url) for url in urls))
+        assert [r.body for r in responses] == [b"render 1"] * self.processes
+        assert self.renders == [1]
+
+
+class FormatBaseHandler(RenderingHandler):
+    def get(self, path):
+        self.finish(self.format_base)
+
+
+class FormatBaseTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application(
+            [
+                (
+                    "/format/script/(.*)",
+                    FormatBaseHandler,
+                    {"format_prefix": "/format/script"},
+                ),
+                ("/(.*)", FormatBaseHandler),
+            ],
+            base_url="/",
+            content_security_policy="",
+            default_format="html",
+            hub_base_url=None,
+            statsd_host=None,
+        )
+
+    def test_flush_cache_not_linked(self):
+        for path in ("/url/a.ipynb", "/format/script/url/a.ipynb"):
+            r = self.fetch(path + "?flush_cache=1&x=1")
+            assert r.body == b"/url/a.ipynb?x=1"
+
+
+NOTEBOOK = """{
+ "cells": [{"cell_type": "markdown", "id": "c", "metadata": {}, "source": ["# %s"]}],
+ "metadata": {},
+ "nbformat": 4,
+ "nbformat_minor": 5
+}"""
+
+
+class NotebookHandler(RenderingHandler):
+    """Renders settings['notebooks'][name], counting nbconvert runs"""
+
+    @cached
+    async def get(self, path, name):
+        await self.finish_notebook(self.settings["notebooks"][name], path)
+
+    async def render_nbhtml(self, nb, download_url, msg, json_notebook):
+        self.settings["renders"] += 1
+        return "<h1>%s</h1>" % parse_notebook(json_notebook).cells[0].source
+
+    def render_notebook_template(self, body, nb, download_url, json_notebook):
+        return "%s from %s" % (body, download_url)
+
+
+class RenderCacheTest(AsyncHTTPTestCase):
+    handlers = [("/(.*/(.*))", NotebookHandler)]
+    formats = {"html": {}}
+
+    def get_app(self):
+        self.cache = AsyncLRUCache()
+        return web.Application(
+            self.handlers,
+            cache=self.cache,
+            config={},
+            content_security_policy="",
+            default_format="html",
+            formats=self.formats,
+            hub_base_url=None,
+            index=EmptyClass(),
+            log=app_log,
+            notebooks={"a": NOTEBOOK % "a", "b": NOTEBOOK % "b"},
+            pool=None,
+            rate_limiter=RateLimiter(limit=0, interval=60, cache=self.cache),
+            render_cache_expiry=60,
+            render_scheduler=RenderScheduler(1),
+            single_flight=SingleFlight(self.cache, lease=0),
+            statsd_host=None,
+            renders=0,
+        )
+
+    @property
+    def settings(self):
+        return self._app.settings
+
+    async def get(self, path):
+        r = await self.http_client.fetch(self.get_url(path))
+        return r.body.decode("utf8")
+
+    @gen_test
+    async def test_same_notebook_rendered_once(self):
+        assert await self.get("/github/a") == "<h1># a</h1> from github/a"
+        assert await self.get("/url/a") == "<h1># a</h1> from url/a"
+        assert self.settings["renders"] == 1
+        # parsed in the render pool once, with the render
+        assert (
+            len(
+                [
+                    key
+                    for key in self.cache.store._data
+                    if key.startswith("render-summary:")
+                ]
+            )
+            == 1
+        )
+        assert await self.get("/github/b") == "<h1># b</h1> from github/b"
+        assert self.settings["renders"] == 2
+
+    @gen_test
+    async def test_parsed_in_turn(self):
+        scheduler = self.settings["render_scheduler"]
+        # another render has the only slot
+        ticket = scheduler.schedule("1.2.3.4", 1)
+        request = asyncio.ensure_future(self.get("/github/a"))
+        await asyncio.sleep(0.1)
+        assert not [
+            key for key in self.cache.store._data if key.startswith("render-summary:")
+        ]
+        assert scheduler.queued == 1
+        scheduler.release(ticket)
+        assert await request == "<h1># a</h1> from github/a"
+
+    @gen_test
+    async def test_version_change(self):
+        await self.get("/github/a")
+        self.settings["render_cache_version"] = "other"
+        await self.get("/url/a")
+        assert self.settings["renders"] == 2
+
+    @gen_test
+    async def test_disabled(self):
+        self.settings["render_cache_expiry"] = 0
+        await self.get("/github/a")
+        await self.get("/url/a")
+        assert self.settings["renders"] == 2
+        assert not [key for key in self.cache.store._data if key.startswith("render:")]
+
+
+class CellNotebookHandler(NotebookHandler):
+    """Renders settings['notebooks'][name] with nbconvert"""
+
+    render_nbhtml = RenderingHandler.render_nbhtml
+
+
+class CellCacheTest(AsyncHTTPTestCase):
+    handlers = [("/(.*/(.*))", CellNotebookHandler)]
+    formats = {"html": {"exporter": HTMLExporter(), "cell_cache": True}}
+    get_app = RenderCacheTest.get_app
+    get = RenderCacheTest.get
+    settings = RenderCacheTest.settings
+
+    def cached_cells(self):
+        return sorted(
+            key for key in self.cache.store._data if key.startswith("render-cell:")
+        )
+
+    @gen_test
+    async def test_changed_cell(self):
+        nb = v4.new_notebook(
+            cells=[v4.new_markdown_cell("cell %i" % i) for i in range(3)]
+        )
+        self.settings["notebooks"]["a"] = v4.writes(nb)
+        await self.get("/github/a")
+        cells = self.cached_cells()
+        assert len(cells) == 3
+
+        nb.cells[1].source = "changed"
+        self.settings["notebooks"]["a"] = v4.writes(nb)
+        page = await self.get("/url/a")
+        assert len(self.cached_cells()) == 4
+        assert set(cells) < set(self.cached_cells())
+        html, config = render_notebook(self.settings["formats"]["html"], nb)
+        assert page == "%s from url/a" % html
+
+
+class OutputsTest(AsyncHTTPTestCase):
+    handlers = [
+        (r"/_outputs/([0-9a-f]{64})(?:\.\w+)?", OutputHandler),
+        ("/(.*/(.*))", CellNotebookHandler),
+    ]
+    formats = CellCacheTest.formats
+    get = RenderCacheTest.get
+    settings = RenderCacheTest.settings
+
+    def get_app(self):
+        app = RenderCacheTest.get_app(self)
+        app.settings["base_url"] = "/"
+        app.settings["output_extract_threshold"] = 1024
+        return app
+
+    @gen_test
+    async def test_extracted_image(self):
+        image = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 8
+        data = {"image/png": base64.b64encode(image).decode("ascii")}
+        nb = v4.new_notebook(
+            cells=[
+                v4.new_code_cell(outputs=[v4.new_output("display_data", data=data)])
+                for i in range(2)
+            ]
+        )
+        self.settings["notebooks"]["a"] = v4.writes(nb)
+        page = await self.get("/github/a")
+        assert 'src="data:image/png' not in page
+        sha = hashlib.sha256(image).hexdigest()
+        assert page.count('loading="lazy" src="/_outputs/%s.png"' % sha) == 2
+
+        r = await self.http_client.fetch(self.get_url("/_outputs/%s.png" % sha))
+        assert r.body == image
+        assert r.headers["Content-Type"] == "image/png"
+        assert "immutable" in r.headers["Cache-Control"]
+
+        r = await self.http_client.fetch(
+            self.get_url("/_outputs/%s.png" % ("0" * 64)), raise_error=False
+        )
+        assert r.code == 404
+
+
+class StreamingNotebookHandler(NotebookHandler):
+    """Records whether the page was sent before rendering, or fails with settings['fail']"""
+
+    async def render_nbhtml(self, nb, download_url, msg, json_notebook):
+        self.settings["streamed"] = self._headers_written
+        if self.settings["fail"]:
+            raise web.HTTPError(self.settings["fail"], "render failed")
+        return await super().render_nbhtml(nb, download_url, msg, json_notebook)
+
+    def render_notebook_template(self, body, nb, download_url, json_notebook):
+        return "<header>%s</header>%s<footer></footer>" % (download_url, body)
+
+
+class StreamTest(AsyncHTTPTestCase):
+    handlers = [("/(.*/(.*))", StreamingNotebookHandler)]
+    formats = RenderCacheTest.formats
+    get = RenderCacheTest.get
+    settings = RenderCacheTest.settings
+
+    def get_app(self):
+        app = RenderCacheTest.get_app(self)
+        app.settings["cache_expiry_min"] = 60
+        app.settings["cache_expiry_max"] = 120
+        app.settings["fail"] = None
+        app.settings["stream_renders"] = True
+        return app
+
+    @gen_test
+    async def test_streamed(self):
+        page = "<header>github/a</header><h1># a</h1><footer></footer>"
+        assert await self.get("/github/a") == page
+        assert self.settings["streamed"]
+        # cached whole
+        r = await self.http_client.fetch(self.get_url("/github/a"))
+        assert r.body.decode("utf8") == page
+        assert r.headers["Etag"] == '"%s"' % hashlib.sha1(r.body).hexdigest()
+        assert self.settings["renders"] == 1
+
+    @gen_test
+    async def test_error_after_stream(self):
+        self.settings["fail"] = 500
+        r = await self.http_client.fetch(self.get_url("/github/a"))
+        # the error comes with a 200 status, which must not be cached
+        assert r.headers["Cache-Control"] == "no-cache"
+        page = r.body.decode("utf8")
+        assert page.startswith("<header>github/a</header>")
+        assert '<div class="alert alert-danger">render failed</div>' in page
+        assert page.endswith("<footer></footer>")
+        assert not [key for key in self.cache.store._data if key.startswith("page:")]
+
+    cached_keys = CachedTest.cached_keys
+    expire = CachedTest.expire
+
+    @gen_test
+    async def test_not_streamed_with_stale_fallback(self):
+        page = await self.get("/github/a")
+        self.settings["cache_stale_if_error"] = 60
+        self.settings["render_cache_expiry"] = 0
+        self.settings["fail"] = 500
+        self.expire(1)
+        r = await self.http_client.fetch(self.get_url("/github/a"))
+        assert r.body.decode("utf8") == page
+        assert not self.settings["streamed"]
+
+
+def slow_render(format, nb, url, config):
+    time.sleep(10)
+
+
+class KilledNotebookHandler(NotebookHandler):
+    """Renders too slowly for the pool"""
+
+    async def render_nbhtml(self, nb, download_url, msg, json_notebook):
+        self.settings["renders"] += 1
+        return await self.run_renderer(slow_render, nb, download_url, msg)
+
+
+class RenderFailureTest(AsyncHTTPTestCase):
+    handlers = [("/(.*/(.*))", KilledNotebookHandler)]
+    formats = RenderCacheTest.formats
+    settings = RenderCacheTest.settings
+
+    def get_app(self):
+        app = RenderCacheTest.get_app(self)
+        # warm_up imports what parsing needs before the (short) timeout applies
+        self.pool = SupervisedProcessPool(
+            1, timeout=0.2, check_interval=0.05, initializer=warm_up, initargs=({},)
+        )
+        self.pool.wait_ready(10)
+        app.settings["pool"] = self.pool
+        app.settings["render_failure_expiry"] = 60
+        return app
+
+    def tearDown(self):
+        self.pool.shutdown()
+        super().tearDown()
+
+    @gen_test
+    async def test_killed_render_not_retried(self):
+        for path in ("/github/a", "/url/a"):
+            r = await self.http_client.fetch(self.get_url(path), raise_error=False)
+            assert r.code == 503
+        assert self.settings["renders"] == 1
+        r = await self.http_client.fetch(self.get_url("/github/b"), raise_error=False)
+        assert r.code == 503
+        assert self.settings["renders"] == 2
+
+
+def pid_render(format, nb, url, config):
+    return "%i %s %s" % (
+        os.getpid(),
+        threading.current_thread().name,
+        "json" if isinstance(nb, (str, bytes)) else "parsed",
+    )
+
+
+class RoutingNotebookHandler(NotebookHandler):
+    """Renders the pid and thread name of the process that rendered it"""
+
+    async def render_nbhtml(self, nb, download_url, msg, json_notebook, parsed=None):
+        return await self.run_renderer(
+            pid_render,
+            json_notebook if parsed is None else parsed,
+            download_url,
+            msg,
+        )
+
+    def render_notebook_template(self, body, nb, download_url, json_notebook):
+        return body
+
+
+class RoutingTest(AsyncHTTPTestCase):
+    handlers = [
+        ("/script/(.*/(.*))", RoutingNotebookHandler, {"format": "script"}),
+        ("/inline/(.*/(.*))", RoutingNotebookHandler, {"format": "inline"}),
+        ("/(.*/(.*))", RoutingNotebookHandler),
+    ]
+    formats = {
+        "html": {},
+        "script": {"thread_render": True},
+        "inline": {"inline_render": True, "thread_render": True},
+    }
+    settings = RenderCacheTest.settings
+
+    def get_app(self):
+        app = RenderCacheTest.get_app(self)
+        self.pool = SupervisedProcessPool(1)
+        app.settings.update(
+            pool=self.pool,
+            render_cache_expiry=0,
+            thread_pool=ThreadPoolExecutor(1),
+            inline_render_max_bytes=1000,
+            thread_render_max_bytes=1000,
+            thread_render_max_cells=1,
+            thread_render_scheduler=RenderScheduler(1),
+        )
+        app.settings["notebooks"]["large"] = NOTEBOOK % ("x" * 1000)
+        app.settings["notebooks"]["cells"] = v4.writes(
+            v4.new_notebook(cells=[v4.new_markdown_cell() for i in range(2)])
+        )
+        return app
+
+    def tearDown(self):
+        self.pool.shutdown()
+        super().tearDown()
+
+    async def get_pid(self, path):
+        r = await self.http_client.fetch(self.get_url(path))
+        return int(r.body.split()[0])
+
+    async def get_thread(self, path):
+        r = await self.http_client.fetch(self.get_url(path))
+        return r.body.decode("utf8").split()[1]
+
+    async def get_input(self, path):
+        r = await self.http_client.fetch(self.get_url(path))
+        return r.body.decode("utf8").split()[2]
+
+    @gen_test
+    async def test_routing(self):
+        assert await self.get_pid("/github/a") == os.getpid()
+        assert await self.get_pid("/github/large") != os.getpid()
+        assert await self.get_pid("/github/cells") != os.getpid()
+        assert await self.get_pid("/script/github/large") == os.getpid()
+
+    @gen_test
+    async def test_inline(self):
+        main = threading.current_thread().name
+        assert await self.get_thread("/inline/github/a") == main
+        # too large for the event loop
+        assert await self.get_thread("/inline/github/large") != main
+        assert await self.get_thread("/script/github/a") != main
+        # parsed once, for the summary and the render
+        assert await self.get_input("/inline/github/b") == "parsed"
+        assert await self.get_input("/script/github/b") == "json"
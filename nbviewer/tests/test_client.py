@@ -0,0 +1,58 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+import pickle
+from io import BytesIO
+
+from tornado.httpclient import HTTPRequest
+from tornado.httpclient import HTTPResponse
+from tornado.httputil import HTTPHeaders
+from tornado.log import app_log
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from nbviewer.cache import AsyncLRUCache
+from nbviewer.cache import unpack_record
+from nbviewer.client import NBViewerAsyncHTTPClient
+
+
+class CachedResponseTest(AsyncTestCase):
+    def make_client(self):
+        client = NBViewerAsyncHTTPClient(log=app_log, client=object())
+        client.cache = AsyncLRUCache()
+        return client
+
+    def make_response(self):
+        headers = HTTPHeaders()
+        headers.add("ETag", '"abc"')
+        headers.add("Link", "<a>; rel=next")
+        headers.add("Link", "<b>; rel=last")
+        return HTTPResponse(
+            HTTPRequest("https://example.com/nb.ipynb"),
+            200,
+            headers=headers,
+            buffer=BytesIO(b'{"cells": []}'),
+            effective_url="https://example.com/nb.ipynb",
+        )
+
+    @gen_test
+    async def test_roundtrip(self):
+        client = self.make_client()
+        await client._cache_response("upstream:x", "x", self.make_response())
+        # stored as a record, not a pickle
+        assert unpack_record(await client.cache.get("upstream:x")) is not None
+        response = await client._get_cached_response("upstream:x", "x")
+        assert response.code == 200
+        assert response.body == b'{"cells": []}'
+        assert response.headers["ETag"] == '"abc"'
+        assert response.headers.get_list("Link") == ["<a>; rel=next", "<b>; rel=last"]
+        assert response.effective_url == "https://example.com/nb.ipynb"
+
+    @gen_test
+    async def test_pickle_ignored(self):
+        client = self.make_client()
+        await client.cache.set("upstream:x", pickle.dumps(self.make_response()))
+        assert await client._get_cached_response("upstream:x", "x") is None
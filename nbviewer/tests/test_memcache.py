@@ -0,0 +1,219 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+import asyncio
+import os
+import zlib
+
+import pytest
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from nbviewer.cache import AsyncMultipartAioMemcache
+from nbviewer.cache import pylibmc
+from nbviewer.memcache import _decode_value
+from nbviewer.memcache import _encode_value
+from nbviewer.memcache import _read_line
+from nbviewer.memcache import AioMemcacheClient
+from nbviewer.memcache import MemcacheError
+
+VALUES = [b"bytes", "ünicode", 5, 2**70, True, False, {"a": 1}]
+
+
+@pytest.mark.skipif(pylibmc is None, reason="requires pylibmc")
+def test_pylibmc_flags():
+    mc = pylibmc.Client(["127.0.0.1:1"])
+    for value in VALUES:
+        assert _encode_value(value) == mc.serialize(value)
+        assert _decode_value(*mc.serialize(value)) == value
+        assert mc.deserialize(*_encode_value(value)) == value
+
+
+def test_zlib():
+    data, flags = _encode_value("ünicode")
+    assert _decode_value(zlib.compress(data), flags | 8) == "ünicode"
+
+
+class FakeMemcached(object):
+    """Minimal in-process memcached speaking the text protocol
+
+    Supports get (multi-key), set, add, incr, delete and ASCII auth.
+    Expiry is ignored.
+    """
+
+    def __init__(self, credentials=None):
+        self.data = {}
+        self.credentials = credentials
+        self.commands = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        authenticated = self.credentials is None
+        try:
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                parts = line.split()
+                cmd = parts[0]
+                self.commands.append(cmd)
+                if cmd in (b"set", b"add"):
+                    key, flags, size = parts[1], parts[2], int(parts[4])
+                    data = (await reader.readexactly(size + 2))[:-2]
+                    if not authenticated:
+                        if data == self.credentials:
+                            authenticated = True
+                            writer.write(b"STORED\r\n")
+                        else:
+                            writer.write(b"CLIENT_ERROR authentication failure\r\n")
+                        continue
+                    if cmd == b"add" and key in self.data:
+                        writer.write(b"NOT_STORED\r\n")
+                    else:
+                        self.data[key] = (flags, data)
+                        writer.write(b"STORED\r\n")
+                elif not authenticated:
+                    writer.write(b"CLIENT_ERROR unauthenticated\r\n")
+                elif cmd == b"get":
+                    for key in parts[1:]:
+                        if key in self.data:
+                            flags, data = self.data[key]
+                            writer.write(
+                                b"VALUE %s %s %i\r\n%s\r\n"
+                                % (key, flags, len(data), data)
+                            )
+                    writer.write(b"END\r\n")
+                elif cmd == b"incr":
+                    key = parts[1]
+                    if key in self.data:
+                        flags, data = self.data[key]
+                        data = b"%i" % (int(data) + int(parts[2]))
+                        self.data[key] = (flags, data)
+                        writer.write(data + b"\r\n")
+                    else:
+                        writer.write(b"NOT_FOUND\r\n")
+                elif cmd == b"delete":
+                    if self.data.pop(parts[1], None) is None:
+                        writer.write(b"NOT_FOUND\r\n")
+                    else:
+                        writer.write(b"DELETED\r\n")
+                else:
+                    writer.write(b"ERROR\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+
+class AioMemcacheTest(AsyncTestCase):
+    credentials = None
+
+    def setUp(self):
+        super().setUp()
+        self.memcached = FakeMemcached(self.credentials)
+        self.io_loop.run_sync(self.memcached.start)
+
+    def tearDown(self):
+        self.memcached.stop()
+        super().tearDown()
+
+    def make_client(self, cls=AioMemcacheClient, **kwargs):
+        return cls(["127.0.0.1:%i" % self.memcached.port], **kwargs)
+
+    @gen_test
+    async def test_get_set(self):
+        mc = self.make_client()
+        assert await mc.get("missing") is None
+        assert await mc.set("k", b"value")
+        assert await mc.get("k") == b"value"
+        assert await mc.set("s", "ünicode")
+        assert await mc.get("s") == "ünicode"
+        assert await mc.set("d", {"a": 1})
+        assert await mc.get("d") == {"a": 1}
+        mc.close()
+
+    @gen_test
+    async def test_add_incr_delete(self):
+        mc = self.make_client()
+        assert await mc.add("n", 1, 60)
+        assert not await mc.add("n", 1, 60)
+        assert await mc.incr("n") == 2
+        assert await mc.get("n") == 2
+        assert await mc.incr("missing") is None
+        assert await mc.delete("n")
+        assert not await mc.delete("n")
+        mc.close()
+
+    @gen_test
+    async def test_pipelined(self):
+        mc = self.make_client(pool_size=1)
+        values = {("k%i" % i): os.urandom(100) for i in range(50)}
+        failed = await mc.set_multi(values)
+        assert failed == []
+        results = await asyncio.gather(*(mc.get(key) for key in values))
+        assert results == list(values.values())
+        assert len(mc.servers[0].connections) == 1
+        mc.close()
+
+    @gen_test
+    async def test_get_multi_single_command(self):
+        mc = self.make_client()
+        await mc.set_multi({"a": b"1", "b": b"2"})
+        self.memcached.commands.clear()
+        values = await mc.get_multi(["a", "b", "c"])
+        assert values == {b"a": b"1", b"b": b"2"}
+        assert self.memcached.commands == [b"get"]
+        mc.close()
+
+    @gen_test
+    async def test_error_reply(self):
+        mc = self.make_client()
+        try:
+            await mc._request(mc.servers[0], b"bogus\r\n", _read_line)
+        except MemcacheError:
+            pass
+        else:
+            assert False, "Expected MemcacheError"
+        # the connection is still usable
+        assert await mc.set("k", b"v")
+        mc.close()
+
+    @gen_test
+    async def test_multipart(self):
+        mc = self.make_client(AsyncMultipartAioMemcache, chunk_size=64)
+        value = os.urandom(1000)
+        await mc.set("big", value)
+        assert await mc.get("big") == value
+        assert len(self.memcached.data) > 1
+        # one get for the manifest, one for all the chunks
+        self.memcached.commands.clear()
+        assert await mc.get("big") == value
+        assert self.memcached.commands == [b"get", b"get"]
+        mc.close()
+
+
+class AioMemcacheAuthTest(AioMemcacheTest):
+    credentials = b"user secret"
+
+    def make_client(self, cls=AioMemcacheClient, **kwargs):
+        return super().make_client(cls, username="user", password="secret", **kwargs)
+
+    @gen_test
+    async def test_bad_credentials(self):
+        mc = AioMemcacheClient(
+            ["127.0.0.1:%i" % self.memcached.port], username="user", password="wrong"
+        )
+        try:
+            await mc.get("k")
+        except MemcacheError:
+            pass
+        else:
+            assert False, "Expected MemcacheError"
+        mc.close()
@@ -0,0 +1,178 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+import errno
+import glob
+import os
+import sys
+import time
+
+import pytest
+
+from nbviewer.pool import RemoteTraceback
+from nbviewer.pool import RenderKilled
+from nbviewer.pool import shared_dir
+from nbviewer.pool import SharedPayload
+from nbviewer.pool import SupervisedProcessPool
+
+
+warm = False
+
+
+def warm_up(value):
+    global warm
+    warm = value
+
+
+def is_warm():
+    return warm
+
+
+def getpid():
+    return os.getpid()
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def allocate(n):
+    data = bytearray(n)
+    time.sleep(10)
+    return len(data)
+
+
+def echo(text, data):
+    return text.upper(), data, len(text)
+
+
+def crash_with(text):
+    os._exit(1)
+
+
+def fail():
+    raise ValueError("bad notebook")
+
+
+def crash():
+    os._exit(1)
+
+
+@pytest.fixture
+def pool():
+    pool = SupervisedProcessPool(1, timeout=1, max_rss=200 * 2**20, check_interval=0.1)
+    yield pool
+    pool.shutdown()
+
+
+def test_result(pool):
+    pid = pool.submit(getpid).result()
+    assert pid != os.getpid()
+    # same worker
+    assert pool.submit(getpid).result() == pid
+
+
+def test_exception(pool):
+    with pytest.raises(ValueError) as e:
+        pool.submit(fail).result()
+    assert isinstance(e.value.__cause__, RemoteTraceback)
+    assert "bad notebook" in str(e.value.__cause__)
+
+
+def test_timeout(pool):
+    pid = pool.submit(getpid).result()
+    with pytest.raises(RenderKilled) as e:
+        pool.submit(sleep, 10).result()
+    assert e.value.reason == "timeout"
+    # replaced
+    assert pool.submit(getpid).result() != pid
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="reads /proc")
+def test_memory(pool):
+    with pytest.raises(RenderKilled) as e:
+        pool.submit(allocate, 400 * 2**20).result()
+    assert e.value.reason == "memory"
+    assert pool.submit(sleep, 0).result() == 0
+
+
+def test_crash(pool):
+    with pytest.raises(RenderKilled) as e:
+        pool.submit(crash).result()
+    assert e.value.reason == "died"
+    assert pool.submit(sleep, 0).result() == 0
+
+
+def shared_files():
+    return glob.glob(os.path.join(shared_dir, "nbviewer-%i-*" % os.getpid()))
+
+
+def test_shared_payloads(pool):
+    text = "é" * 2**17
+    data = os.urandom(2**17)
+    assert pool.submit(echo, text, data).result() == (text.upper(), data, 2**17)
+    assert pool.submit(echo, "small", b"small").result() == ("SMALL", b"small", 5)
+    assert shared_files() == []
+
+
+def test_shared_cleanup_after_crash(pool):
+    with pytest.raises(RenderKilled):
+        pool.submit(crash_with, "x" * 2**17).result()
+    assert shared_files() == []
+
+
+def test_shared_memory_full(monkeypatch):
+    def put(cls, path, value):
+        open(path, "wb").close()
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(SharedPayload, "put", classmethod(put))
+    pool = SupervisedProcessPool(1)
+    try:
+        text = "x" * 2**17
+        # passed through the pipe instead
+        assert pool.submit(echo, text, b"").result() == (text.upper(), b"", 2**17)
+        assert shared_files() == []
+    finally:
+        pool.shutdown()
+
+
+def test_initializer():
+    pool = SupervisedProcessPool(2, initializer=warm_up, initargs=(True,))
+    try:
+        assert pool.wait_ready(10)
+        assert pool.submit(is_warm).result()
+        assert not warm
+    finally:
+        pool.shutdown()
+
+
+def hang():
+    time.sleep(10)
+
+
+def test_start_timeout():
+    pool = SupervisedProcessPool(1, initializer=hang, start_timeout=0.5)
+    try:
+        assert pool.wait_ready(10)
+        # the hung worker was killed, and its replacement hangs too
+        with pytest.raises(RenderKilled) as e:
+            pool.submit(getpid).result(10)
+        assert e.value.reason == "died"
+    finally:
+        pool.shutdown()
+
+
+def test_recycle():
+    pool = SupervisedProcessPool(1, initializer=warm_up, initargs=(True,), max_tasks=2)
+    try:
+        pids = [pool.submit(getpid).result() for i in range(5)]
+        assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+        # new workers are initialized too
+        assert pool.submit(is_warm).result()
+    finally:
+        pool.shutdown()
@@ -0,0 +1,165 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+from nbconvert import HTMLExporter  # type: ignore
+from nbconvert import ScriptExporter
+from nbformat import from_dict
+from nbformat import v4
+from nbformat import writes
+
+from nbviewer import formats
+from nbviewer import render
+from nbviewer.render import extract_outputs
+from nbviewer.render import parse_notebook
+from nbviewer.render import render_notebook
+from nbviewer.render import render_notebook_cells
+from nbviewer.render import summarize_notebook
+
+
+def make_notebook():
+    return v4.new_notebook(
+        metadata={"language_info": {"name": "python"}},
+        cells=[
+            v4.new_markdown_cell("# Title\n\n$$x^2$$"),
+            v4.new_code_cell(
+                "print('hi')",
+                execution_count=1,
+                outputs=[v4.new_output("stream", text="hi\n")],
+            ),
+            v4.new_raw_cell("raw"),
+            v4.new_code_cell(
+                "1",
+                outputs=[
+                    v4.new_output("execute_result", data={"text/html": "<b>1</b>"})
+                ],
+            ),
+        ],
+    )
+
+
+def test_render_notebook_cells():
+    format = {"exporter": HTMLExporter()}
+    nb = make_notebook()
+    html, config = render_notebook(format, nb, "nb.ipynb")
+    head, fragments, foot, config = render_notebook_cells(format, nb, "nb.ipynb")
+    assert len(fragments) == len(nb.cells)
+    assert head + "".join(fragments) + foot == html
+
+    # a subset of cells renders to the same fragments
+    partial = from_dict(dict(nb, cells=[nb.cells[1]]))
+    head2, fragments2, foot2, config = render_notebook_cells(
+        format, partial, "nb.ipynb"
+    )
+    assert (head2, fragments2, foot2) == (head, [fragments[1]], foot)
+
+
+def test_extract_outputs():
+    big = "A" * 2000
+    small = "B" * 100
+    html = (
+        '<img alt="x" src="data:image/png;base64,%s"/>'
+        '<img src="data:image/png;base64,%s"/>'
+        '<img loading="eager" src="data:image/jpeg;base64,%s"/>'
+    ) % (big, small, big)
+    html, outputs = extract_outputs(html, 1024, "/_outputs/")
+    # identical images are stored once
+    assert len(outputs) == 1
+    ((sha, (mimetype, data)),) = outputs.items()
+    assert data == b"\0" * 1500
+    assert html == (
+        '<img alt="x" loading="lazy" src="/_outputs/%s.png"/>'
+        '<img src="data:image/png;base64,%s"/>'
+        '<img loading="eager" src="/_outputs/%s.jpg"/>'
+    ) % (sha, small, sha)
+
+
+def test_summarize_notebook():
+    nb = make_notebook()
+    summary = summarize_notebook(
+        v4.writes(nb), {"html": None, "slides": formats.test_slides}
+    )
+    assert summary.metadata == nb.metadata
+    assert summary.nbformat == 4
+    assert len(summary.cell_hashes) == 4
+    assert len(set(summary.cell_hashes)) == 4
+    assert summary.formats == ["html"]
+    assert summary.cell_count == 4
+
+
+def test_summarize_notebook_inline():
+    nb = make_notebook()
+    summary, parsed = summarize_notebook(
+        v4.writes(nb), {}, "never", cell_hashes=False, keep_notebook=True
+    )
+    assert summary.cell_count == 4
+    assert "cell_hashes" not in summary
+    assert parsed == nb
+
+
+def test_render_cells_from_json():
+    format = {"exporter": HTMLExporter()}
+    nb = make_notebook()
+    head, fragments, foot, config = render_notebook_cells(format, nb, "nb.ipynb")
+    result = render_notebook_cells(format, v4.writes(nb), "nb.ipynb", cells=[1, 3])
+    assert result[1] == [fragments[1], fragments[3]]
+
+
+def test_parse_notebook_nan():
+    # NaN is valid for nbformat (and the json module), but not for orjson
+    nb = make_notebook()
+    nb.metadata["nan"] = float("nan")
+    nb = parse_notebook(writes(nb))
+    assert nb.metadata["nan"] != nb.metadata["nan"]
+    assert nb.cells[0].source.startswith("# Title")
+
+
+def test_parse_notebook_cached_validation(caplog, monkeypatch):
+    calls = []
+    validate_notebook = render.validate_notebook
+
+    def validate(nb):
+        calls.append(nb)
+        return validate_notebook(nb)
+
+    monkeypatch.setattr(render, "validate_notebook", validate)
+    monkeypatch.setattr(render, "validated", type(render.validated)())
+    nb = make_notebook()
+    nb.cells[1].outputs[0].unexpected = True
+    json_notebook = writes(nb, version=4)
+    caplog.clear()
+    for i in range(2):
+        assert parse_notebook(json_notebook, "cached").cells[1].outputs
+    assert len(calls) == 1
+    # the verdict is cached too
+    assert caplog.text.count("Notebook JSON is invalid") == 2
+
+    parse_notebook(json_notebook.encode("utf8"), "cached")
+    parse_notebook(json_notebook, "never")
+    assert len(calls) == 1
+    parse_notebook(json_notebook)
+    assert len(calls) == 2
+
+
+def test_code_exporter():
+    nb = make_notebook()
+    nb.cells.append(v4.new_code_cell("%matplotlib inline\n!ls", execution_count=2))
+    nb.cells.append(
+        v4.new_raw_cell("x = 1", metadata={"raw_mimetype": "text/x-python"})
+    )
+    nb.cells.append(
+        v4.new_code_cell("hidden", metadata={"transient": {"remove_source": True}})
+    )
+    for metadata in [
+        {"language_info": {"name": "python", "nbconvert_exporter": "python"}},
+        {"language_info": {"name": "julia", "mimetype": "application/julia"}},
+        {},
+    ]:
+        nb.metadata = from_dict(metadata)
+        exporter = formats.CodeExporter()
+        # not falling back on ScriptExporter
+        assert not exporter.configured()
+        code, resources = exporter.from_notebook_node(nb)
+        assert code == ScriptExporter().from_notebook_node(nb)[0]
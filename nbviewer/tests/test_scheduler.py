@@ -0,0 +1,102 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+import pytest
+from tornado import web
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from nbviewer.scheduler import count_cells
+from nbviewer.scheduler import render_cost
+from nbviewer.scheduler import RenderScheduler
+
+
+class RenderSchedulerTest(AsyncTestCase):
+    def started(self, tickets):
+        return [name for name, ticket in tickets if ticket.future.done()]
+
+    def run_next(self, tickets):
+        """Finish the running render, return the next one"""
+        (running,) = [
+            (name, ticket)
+            for name, ticket in tickets
+            if ticket.future.done() and not ticket.released
+        ]
+        tickets.remove(running)
+        self.scheduler.release(running[1])
+        started = [
+            name
+            for name, ticket in tickets
+            if ticket.future.done() and not ticket.released
+        ]
+        return started[0] if started else None
+
+    @gen_test
+    async def test_fair_and_cheap_first(self):
+        self.scheduler = RenderScheduler(1)
+        first = self.scheduler.schedule("a", 100)
+        await first.wait()
+        tickets = [("first", first)]
+        for name, client, cost in [
+            ("a1", "a", 100),
+            ("a2", "a", 100),
+            ("a3", "a", 100),
+            ("b1", "b", 100),
+            ("c1", "c", 10),
+        ]:
+            tickets.append((name, self.scheduler.schedule(client, cost)))
+        assert self.started(tickets) == ["first"]
+        order = []
+        while tickets:
+            name = self.run_next(tickets)
+            if name:
+                order.append(name)
+        # a already had its turn with the first render
+        assert order == ["c1", "b1", "a1", "a2", "a3"]
+        assert self.scheduler.running == 0
+        assert self.scheduler.queued == 0
+
+    @gen_test
+    async def test_full_queue(self):
+        self.scheduler = RenderScheduler(1, max_queue=1)
+        first = self.scheduler.schedule("a", 100)
+        big = self.scheduler.schedule("a", 1000)
+        small = self.scheduler.schedule("b", 10)
+        with pytest.raises(web.HTTPError) as e:
+            await big.wait()
+        assert e.value.status_code == 503
+        with pytest.raises(web.HTTPError):
+            self.scheduler.schedule("c", 1000)
+        self.scheduler.release(first)
+        await small.wait()
+
+    @gen_test
+    async def test_long_wait(self):
+        self.scheduler = RenderScheduler(1, max_wait=8)
+        # 1 second per unit of cost
+        self.scheduler.rate = 1
+        first = self.scheduler.schedule("a", 5)
+        second = self.scheduler.schedule("b", 5)
+        # behind both
+        with pytest.raises(web.HTTPError):
+            self.scheduler.schedule("c", 20)
+        # given up
+        self.scheduler.release(second)
+        assert self.scheduler.queued == 0
+        third = self.scheduler.schedule("c", 5)
+        self.scheduler.release(first)
+        await third.wait()
+
+
+def test_render_cost():
+    json_notebook = '{"cells": [{"cell_type": "code"}, {"cell_type": "raw"}]}'
+    cells = count_cells(json_notebook)
+    assert cells == count_cells(json_notebook.encode("utf8")) == 2
+    cost = render_cost(json_notebook, cells)
+    # parsing costs about as much as the JSON
+    assert render_cost(json_notebook, cells, summarize=True) == cost + len(
+        json_notebook
+    )
@@ -5,6 +5,8 @@
 #  Distributed under the terms of the BSD License.  The full license is in
 #  the file COPYING, distributed as part of this software.
 # -----------------------------------------------------------------------------
+import pytest
+
 from nbviewer import utils
 from nbviewer.providers import default_rewrites
 from nbviewer.providers import provider_uri_rewrites
@@ -100,3 +102,20 @@ def test_quote():
         quoted = utils.quote(s)
         assert quoted == expected
         assert type(quoted) == type(expected)
+
+
+def test_negotiate_encoding():
+    negotiate = utils.negotiate_encoding
+    assert negotiate("gzip, deflate, br", ["br", "gzip"]) == "br"
+    assert negotiate("gzip, deflate", ["br", "gzip"]) == "gzip"
+    assert negotiate("br;q=0.5, gzip", ["br", "gzip"]) == "gzip"
+    assert negotiate("gzip;q=0, *", ["gzip"]) is None
+    assert negotiate("*", ["br", "gzip"]) == "br"
+    assert negotiate("", ["br", "gzip"]) is None
+    assert negotiate("identity", ["gzip"]) is None
+
+
+def test_available_content_encodings():
+    assert "gzip" in utils.available_content_encodings(["br", "gzip"])
+    with pytest.raises(ValueError):
+        utils.available_content_encodings(["compress"])
@@ -0,0 +1,114 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import gen_test
+
+from nbviewer.cache import AsyncLRUCache
+from nbviewer.ratelimit import RateLimiter
+from nbviewer.warmer import CacheWarmer
+from nbviewer.warmer import read_url_list
+from nbviewer.warmer import refresh_header
+from nbviewer.warmer import top_access_log_uris
+
+ACCESS_LOG = """\
+[I 200101 12:00:00 log:62] 200 GET /github/a/b/blob/main/x.ipynb (1.2.3.4) 10.00ms
+[I 200101 12:00:01 log:62] 200 GET /github/a/b/blob/main/x.ipynb (1.2.3.5) 1.00ms
+[I 200101 12:00:02 log:62] 200 GET /gist/c/123 (1.2.3.4) 1.00ms
+[W 200101 12:00:03 log:62] 404 GET /github/a/b/blob/main/y.ipynb (1.2.3.4) 1.00ms referer="None" user-agent="x"
+[D 200101 12:00:04 log:62] 200 GET /static/build/styles.css (1.2.3.4) 1.00ms
+[I 200101 12:00:05 log:62] 200 GET /url/example.com/z.ipynb?flush_cache=1 (1.2.3.4) 1.00ms
+"""
+
+
+def test_top_access_log_uris():
+    uris = top_access_log_uris(ACCESS_LOG.splitlines())
+    assert uris == ["/github/a/b/blob/main/x.ipynb", "/gist/c/123"]
+    assert top_access_log_uris(ACCESS_LOG.splitlines(), top=1) == [
+        "/github/a/b/blob/main/x.ipynb"
+    ]
+
+
+def test_top_access_log_uris_base_url():
+    lines = [
+        line.replace(" GET /", " GET /nbviewer/") for line in ACCESS_LOG.splitlines()
+    ]
+    lines.append("[I 200101 12:00:06 log:62] 200 GET /other/x.ipynb (1.2.3.4) 1.00ms")
+    uris = top_access_log_uris(lines, base_url="/nbviewer/")
+    assert uris == ["/github/a/b/blob/main/x.ipynb", "/gist/c/123"]
+
+
+def test_read_url_list(tmp_path):
+    path = tmp_path / "urls.txt"
+    path.write_text("/github/a/b\n\n# comment\n/gist/c/123  # popular\n")
+    assert read_url_list(str(path)) == ["/github/a/b", "/gist/c/123"]
+
+
+class RateLimitedHandler(web.RequestHandler):
+    async def get(self, name):
+        await self.settings["rate_limiter"].check(self)
+        self.settings["requests"].append(
+            (self.request.uri, self.request.headers.get(refresh_header))
+        )
+        self.write(name)
+
+
+class CacheWarmerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        limiter = RateLimiter(
+            limit=3, interval=60, cache=AsyncLRUCache(), exempt_token="secret"
+        )
+        return web.Application(
+            [
+                ("/page/(.*)", RateLimitedHandler),
+                ("/nbviewer/page/(.*)", RateLimitedHandler),
+            ],
+            rate_limiter=limiter,
+            requests=[],
+        )
+
+    @gen_test
+    async def test_warm(self):
+        warmer = CacheWarmer(self.get_url("/page/"), concurrency=2, token="secret")
+        uris = ["a", "b", "c", "d", "a"]
+        results = await warmer.warm(uris)
+        # duplicates are dropped, and the token bypasses the rate limit
+        assert [(uri, code) for uri, code, seconds in results] == [
+            ("a", 200),
+            ("b", 200),
+            ("c", 200),
+            ("d", 200),
+        ]
+
+    @gen_test
+    async def test_warm_base_url(self):
+        lines = [
+            "[I 200101 12:00:00 log:62] 200 GET /nbviewer/page/%s (1.2.3.4) 1.00ms"
+            % name
+            for name in ("a", "b")
+        ]
+        uris = top_access_log_uris(lines, base_url="/nbviewer/")
+        warmer = CacheWarmer(self.get_url("/nbviewer/"), token="secret")
+        results = await warmer.warm(uris)
+        assert [code for uri, code, seconds in results] == [200, 200]
+        assert sorted(uri for uri, refresh in self._app.settings["requests"]) == [
+            "/nbviewer/page/a",
+            "/nbviewer/page/b",
+        ]
+
+    @gen_test
+    async def test_rate_limited_without_token(self):
+        warmer = CacheWarmer(self.get_url("/page/"), token="wrong")
+        results = await warmer.warm(["a", "b", "c"])
+        assert [code for uri, code, seconds in results].count(429) == 1
+
+    @gen_test
+    async def test_refresh(self):
+        warmer = CacheWarmer(self.get_url("/page/"), token="secret", refresh=60)
+        await warmer.warm(["a"])
+        # the page itself, not ?flush_cache, so that it's cached as visitors see it
+        assert self._app.settings["requests"] == [("/page/a", "60")]
@@ -4,10 +4,12 @@
 #  Distributed under the terms of the BSD License.  The full license is in
 #  the file COPYING, distributed as part of this software.
 # -----------------------------------------------------------------------------
+import asyncio
 import json
 import os
 import re
 import time
+import zlib
 from base64 import decodebytes
 from base64 import encodebytes
 from contextlib import contextmanager
@@ -18,6 +20,16 @@ from urllib.parse import urlencode
 from urllib.parse import urlparse
 from urllib.parse import urlunparse
 
+try:
+    import brotli  # type: ignore
+except ModuleNotFoundError:
+    brotli = None  # type: ignore
+
+try:
+    import zstandard  # type: ignore
+except ModuleNotFoundError:
+    zstandard = None  # type: ignore
+
 STRIP_PARAMS = ["client_id", "client_secret", "access_token"]
 
 HERE = os.path.dirname(__file__)
@@ -254,6 +266,78 @@ def base64_encode(s):
     return encoded.decode("ascii")
 
 
+def _gzip(data):
+    # same level as tornado's GZipContentEncoding
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _brotli(data):
+    return brotli.compress(data, mode=brotli.MODE_TEXT, quality=5)
+
+
+def _zstd(data):
+    return zstandard.ZstdCompressor(level=6).compress(data)
+
+
+# HTTP content encodings that can be stored precompressed,
+# in order of preference when a client accepts several
+content_encoders = {"br": _brotli, "zstd": _zstd, "gzip": _gzip}
+
+
+def available_content_encodings(encodings):
+    """Filter a list of content encodings to those that can be used
+
+    br and zstd require the brotli and zstandard packages.
+    Raises ValueError for unknown encodings.
+    """
+    available = []
+    for name in encodings:
+        if name not in content_encoders:
+            raise ValueError("Unknown content encoding: %r" % name)
+        if name == "br" and brotli is None:
+            continue
+        if name == "zstd" and zstandard is None:
+            continue
+        available.append(name)
+    return available
+
+
+def compress_content(data, encoding):
+    """Compress bytes with an HTTP content encoding"""
+    return content_encoders[encoding](data)
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """Pick the content encoding to send for an Accept-Encoding header
+
+    `encodings` are the encodings we have, in order of preference.
+    Returns None if the client accepts none of them.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        accepted[name] = q
+    best = None
+    best_q = 0
+    for name in encodings:
+        q = accepted.get(name, accepted.get("*", 0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
 @contextmanager
 def time_block(message, logger, debug_limit=1):
     """context manager for timing a block
@@ -269,3 +353,41 @@ def time_block(message, logger, debug_limit=1):
     dt = time.time() - tic
     log = logger.info if dt > debug_limit else logger.debug
     log("%s in %.2f ms", message, 1e3 * dt)
+
+
+class LoopLagMonitor(object):
+    """Measure how late the event loop runs scheduled callbacks
+
+    Anything blocking the event loop (compression, parsing, rendering
+    in the loop thread) shows up as lag. Each measurement is sent to statsd
+    as the `loop.lag` timing, and lag above `warn_limit` seconds is logged.
+    """
+
+    def __init__(self, interval, statsd, logger, warn_limit=0.1):
+        self.interval = interval
+        self.statsd = statsd
+        self.log = logger
+        self.warn_limit = warn_limit
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self._expected = loop.time() + self.interval
+        self._handle = loop.call_at(self._expected, self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        lag = max(asyncio.get_event_loop().time() - self._expected, 0)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.statsd.timing("loop.lag", 1e3 * lag)
+        if lag > self.warn_limit:
+            self.log.warning("Event loop blocked for %.2f ms", 1e3 * lag)
+        self.start()
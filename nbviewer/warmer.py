@@ -0,0 +1,256 @@
+# -----------------------------------------------------------------------------
+#  Copyright (C) Jupyter Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+# -----------------------------------------------------------------------------
+"""Pre-warming the page cache
+
+Renders a list of pages through a running nbviewer,
+so that the most-viewed pages are cached before visitors ask for them
+(e.g. after a deploy or a cache flush).
+
+Pages can come from the frontpage, a file with one URL per line,
+or the most requested URLs in nbviewer's access log.
+"""
+import asyncio
+import re
+import time
+from collections import Counter
+
+from tornado import httpclient
+from tornado.log import app_log
+from traitlets import Bool
+from traitlets import Float
+from traitlets import Int
+from traitlets import Unicode
+from traitlets.config import Application
+
+from .utils import url_path_join
+
+# matches the request part of log_request lines, e.g.
+# [I 2020-01-01 12:00:00.000 NBViewer] 200 GET /github/org/repo/blob/main/nb.ipynb (1.2.3.4) 1.23ms
+_access_log_pattern = re.compile(r"\b200 GET (/\S*) \(")
+
+# header asking for cached pages expiring within some seconds to be re-rendered,
+# see BaseHandler.refresh_within
+refresh_header = "X-Nbviewer-Refresh-Within"
+
+# URLs that are never rendered pages
+_skip_prefixes = ("/static/", "/favicon", "/robots.txt", "/create", "/_")
+
+
+def read_url_list(path):
+    """Read a file with one URL path per line, ignoring blank lines and #comments"""
+    uris = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                uris.append(line)
+    return uris
+
+
+def top_access_log_uris(lines, top=100, base_url="/"):
+    """Find the `top` most requested pages in access log lines
+
+    Logged URIs include nbviewer's `base_url`, which is stripped,
+    so that they are relative to it, like other pages to warm.
+    """
+    prefix = base_url.rstrip("/")
+    counts = Counter()
+    for line in lines:
+        match = _access_log_pattern.search(line)
+        if not match:
+            continue
+        uri = match.group(1)
+        if prefix:
+            if uri != prefix and not uri.startswith(prefix + "/"):
+                continue
+            uri = uri[len(prefix) :] or "/"
+        if uri.startswith(_skip_prefixes) or "flush_cache" in uri:
+            continue
+        counts[uri] += 1
+    return [uri for uri, count in counts.most_common(top)]
+
+
+class CacheWarmer(object):
+    """Request pages from nbviewer at bounded concurrency
+
+    Pages are requested through the normal handlers, which cache the results.
+    With `refresh`, cached pages expiring within `refresh` seconds
+    are re-rendered (once across processes, see SingleFlight),
+    so they can be refreshed before they expire. Other cached pages are left as they are.
+
+    `token` is sent in the Authorization header,
+    and exempts warming requests from the rate limit.
+    It is required for `refresh`.
+    """
+
+    def __init__(
+        self, base_url, concurrency=4, token="", refresh=0, timeout=300, log=None
+    ):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.token = token
+        self.refresh = refresh
+        self.timeout = timeout
+        self.log = log or app_log
+        self.http_client = None
+        self._handle = None
+
+    async def warm_one(self, uri, semaphore):
+        """Request one page, return (uri, status code, seconds)"""
+        url = url_path_join(self.base_url, uri)
+        headers = {"User-Agent": "nbviewer-warmer"}
+        if self.token:
+            headers["Authorization"] = "token %s" % self.token
+        if self.refresh:
+            headers[refresh_header] = str(self.refresh)
+        async with semaphore:
+            tic = time.monotonic()
+            try:
+                response = await self.http_client.fetch(
+                    url,
+                    headers=headers,
+                    request_timeout=self.timeout,
+                    raise_error=False,
+                )
+                code = response.code
+            except Exception as e:
+                self.log.error("Warming %s failed: %s", uri, e)
+                code = 599
+            toc = time.monotonic()
+        log = self.log.info if code == 200 else self.log.warning
+        log("Warmed %s: %i in %.0fms", uri, code, 1e3 * (toc - tic))
+        return uri, code, toc - tic
+
+    async def warm(self, uris):
+        """Warm a list of pages, return a list of (uri, status code, seconds)"""
+        if self.http_client is None:
+            self.http_client = httpclient.AsyncHTTPClient()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # keep the order, drop duplicates
+        uris = list(dict.fromkeys(uris))
+        self.log.info("Warming %i pages", len(uris))
+        tic = time.monotonic()
+        results = await asyncio.gather(*(self.warm_one(uri, semaphore) for uri in uris))
+        failed = sum(1 for uri, code, seconds in results if code != 200)
+        self.log.info(
+            "Warmed %i pages (%i failed) in %.1fs",
+            len(uris),
+            failed,
+            time.monotonic() - tic,
+        )
+        return results
+
+    def start(self, get_uris, interval):
+        """Warm the pages returned by get_uris() every `interval` seconds"""
+
+        async def warm():
+            try:
+                await self.warm(get_uris())
+            except Exception:
+                self.log.error("Cache warming failed", exc_info=True)
+            self._handle = loop.call_later(
+                interval, lambda: asyncio.ensure_future(warm())
+            )
+
+        loop = asyncio.get_event_loop()
+        self._handle = loop.call_soon(lambda: asyncio.ensure_future(warm()))
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class WarmApp(Application):
+    """Warm the cache of a running nbviewer"""
+
+    name = "nbviewer-warm"
+
+    description = """Render pages in a running nbviewer so that they are cached.
+
+    Pages are taken from the frontpage, --urls-file, and the most requested
+    pages in --access-log. Set NBViewer.admin_token in the config of both the
+    server and the warmer to exempt warming requests from the rate limit.
+    """
+
+    aliases = {
+        "access-log": "WarmApp.access_log",
+        "concurrency": "WarmApp.concurrency",
+        "refresh": "WarmApp.refresh",
+        "top": "WarmApp.top",
+        "url": "WarmApp.url",
+        "urls-file": "WarmApp.urls_file",
+    }
+
+    flags = {
+        "no-frontpage": (
+            {"WarmApp": {"frontpage": False}},
+            "Do not warm the frontpage links.",
+        ),
+    }
+
+    access_log = Unicode(
+        default_value="",
+        help="Path to an nbviewer access log. The most requested pages are warmed.",
+    ).tag(config=True)
+
+    concurrency = Int(
+        default_value=4, help="Number of pages to request at the same time."
+    ).tag(config=True)
+
+    frontpage = Bool(default_value=True, help="Warm the frontpage links.").tag(
+        config=True
+    )
+
+    refresh = Float(
+        default_value=0,
+        help="Re-render cached pages expiring within this many seconds. Requires NBViewer.admin_token.",
+    ).tag(config=True)
+
+    top = Int(
+        default_value=100,
+        help="Number of most requested pages from the access log to warm.",
+    ).tag(config=True)
+
+    url = Unicode(
+        default_value="http://127.0.0.1:5000/",
+        help="URL of the running nbviewer to warm, including its NBViewer.base_url.",
+    ).tag(config=True)
+
+    urls_file = Unicode(
+        default_value="", help="Path to a file of pages to warm, one per line."
+    ).tag(config=True)
+
+    def get_uris(self):
+        uris = []
+        if self.frontpage and self.parent is not None:
+            uris.extend(sorted(self.parent.max_cache_uris))
+        if self.urls_file:
+            uris.extend(read_url_list(self.urls_file))
+        if self.access_log:
+            base_url = self.parent._base_url if self.parent is not None else "/"
+            with open(self.access_log, errors="replace") as f:
+                uris.extend(top_access_log_uris(f, self.top, base_url))
+        return uris
+
+    def start(self):
+        token = self.parent.admin_token if self.parent is not None else ""
+        warmer = CacheWarmer(
+            self.url,
+            concurrency=self.concurrency,
+            token=token,
+            refresh=self.refresh,
+            log=self.log,
+        )
+        uris = self.get_uris()
+        if not uris:
+            self.exit("No pages to warm.")
+        results = asyncio.run(warmer.warm(uris))
+        for uri, code, seconds in sorted(results, key=lambda r: -r[2]):
+            print("%3i %8.0fms %s" % (code, 1e3 * seconds, uri or "/"))
+        if any(code != 200 for uri, code, seconds in results):
+            self.exit(1)